@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import socket
+import threading
+import random
+import yaml
+
+import pptop.injection
+
+from pptop.channel import Channel
+
+loaders = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+iters = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+# by default, use the window from the default config
+if len(sys.argv) > 3:
+    batch_window = float(sys.argv[3]) or None
+else:
+    with open(os.path.dirname(pptop.injection.__file__) +
+              '/config/pptop.yml') as fh:
+        batch_window = float(yaml.safe_load(fh).get('batch-window', 0)) or None
+# fast-lane commands must not wait for heavy ones (p90, ms)
+fast_cmds = ('.status', '.gs', '.test')
+fast_p90_max = 20
+
+injections = [{
+    'id': 'heavy',
+    'i': '''
+def injection(**kwargs):
+    import time
+    time.sleep(0.05)
+    return [(x, str(x)) for x in range(10000)]
+'''
+}, {
+    'id': 'chunked',
+    'i': '''
+def injection(**kwargs):
+    import time
+    for i in range(10):
+        time.sleep(0.005)
+        yield [(x, str(x)) for x in range(i * 1000, (i + 1) * 1000)]
+'''
+}, {
+    'id': 'light',
+    'i': '''
+def injection(**kwargs):
+    return [(x, str(x)) for x in range(100)]
+'''
+}]
+
+cmds = ['.status', '.gs', '.test', 'heavy', 'chunked', 'light']
+
+# injection, which counts its loads and unloads
+counted = {
+    'id': 'counted',
+    'l': '''
+def injection_load(**kwargs):
+    mg.counted_loads = getattr(mg, 'counted_loads', 0) + 1
+''',
+    'u': '''
+def injection_unload(**kwargs):
+    mg.counted_unloads = getattr(mg, 'counted_unloads', 0) + 1
+''',
+    'i': '''
+def injection(**kwargs):
+    return mg.counted_loads
+'''
+}
+
+
+def connect(cpid):
+    '''
+    Start agent and connect to it
+    '''
+    sock_path = '/tmp/.pptop.{}'.format(cpid)
+    pptop.injection.start(cpid)
+    while not os.path.exists(sock_path):
+        time.sleep(0.01)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(sock_path)
+    protocol = ord(client.recv(1))
+    channel = Channel(client, protocol, batch_window=batch_window)
+    channel.start()
+    return channel
+
+
+def wait_clients(n, timeout=15):
+    t = time.time()
+    while pptop.injection.g.clients != n:
+        if time.time() - t > timeout:
+            raise RuntimeError('clients: {}, expected: {}'.format(
+                pptop.injection.g.clients, n))
+        time.sleep(0.01)
+
+
+cpid = 1000000 + os.getpid()
+channel = connect(cpid)
+
+for i in injections:
+    channel.command('.inject', i)
+
+latencies = {}
+first_chunk = []
+server_times = {}
+lock = threading.Lock()
+
+
+def loader():
+    for z in range(iters):
+        cmd = random.choice(cmds)
+        t_start = time.time()
+        first = []
+        req = channel.request(
+            cmd,
+            on_chunk=(lambda b: first or first.append(time.time()))
+            if cmd == 'chunked' else None)
+        result = req.wait(channel.timeout)
+        if cmd == 'chunked':
+            assert len(result) == 10000
+            with lock:
+                first_chunk.append(first[0] - t_start)
+        with lock:
+            latencies.setdefault(cmd, []).append(time.time() - t_start)
+            server_times.setdefault(cmd, []).append(
+                (req.queue_time, req.exec_time))
+
+
+def percentile(data, p):
+    return data[min(int(len(data) * p / 100), len(data) - 1)] * 1000
+
+
+print('{} loaders, {} requests each, batch window: {}'.format(
+    loaders, iters, batch_window))
+
+t_start = time.time()
+threads = [threading.Thread(target=loader) for x in range(loaders)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+spent = time.time() - t_start
+
+print('{:>8}  {:>6}  {:>9}  {:>9}  {:>9}  {:>9}  {:>9}  {:>9}'.format(
+    'cmd', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queue ms',
+    'exec ms'))
+for cmd in cmds:
+    data = sorted(latencies.get(cmd, []))
+    if data:
+        st = server_times[cmd]
+        print('{:>8}  {:>6}  {:9.3f}  {:9.3f}  {:9.3f}  {:9.3f}  {:9.3f}  {:9.3f}'.
+              format(cmd, len(data), percentile(data, 50),
+                     percentile(data, 90), percentile(data, 99),
+                     data[-1] * 1000,
+                     sum(x[0] for x in st) / len(st) * 1000,
+                     sum(x[1] for x in st) / len(st) * 1000))
+if first_chunk:
+    print('chunked: first batch in {:.3f} ms avg'.format(
+        sum(first_chunk) / len(first_chunk) * 1000))
+print('total: {:.3f} s, {:.1f} req/s, {} frames, {} batches'.format(
+    spent, loaders * iters / spent, channel.frames_received,
+    channel.batches_sent))
+
+# agents in the same process share injections: clients of different agents
+# must not take each other's references
+channel.command('.inject', counted)
+channel2 = connect(cpid + 1000000)
+channel2.command('.inject', counted)
+channel2.command('counted')
+channel2.request('.bye')
+channel2.close()
+wait_clients(1)
+mg = pptop.injection.g
+if mg.counted_loads != 1 or getattr(mg, 'counted_unloads', 0):
+    raise RuntimeError('shared injection reloaded: {} loads, {} unloads'.format(
+        mg.counted_loads, getattr(mg, 'counted_unloads', 0)))
+if channel.command('counted') != 1:
+    raise RuntimeError('shared injection is broken')
+print('two agents: shared injection ok')
+
+channel.request('.bye')
+channel.close()
+
+for cmd in fast_cmds:
+    data = sorted(latencies.get(cmd, []))
+    if data and percentile(data, 90) > fast_p90_max:
+        raise RuntimeError('{} p90 {:.3f} ms exceeds {} ms'.format(
+            cmd, percentile(data, 90), fast_p90_max))
@@ -0,0 +1,43 @@
+import time
+import socket
+import threading
+
+from pptop.framing import Framer
+
+sizes = [1, 5, 10, 25, 50, 100]
+
+
+def echo(sock):
+    framer = Framer(sock)
+    while True:
+        frame = framer.recv()
+        if frame is None:
+            break
+        framer.send(frame[0], frame[1])
+
+
+def test_framer(size):
+    framer.send(1, payload[:size])
+    frame_id, data = framer.recv()
+    assert len(data) == size
+
+
+c, s = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+t = threading.Thread(target=echo, args=(s,))
+t.daemon = True
+t.start()
+
+framer = Framer(c)
+payload = memoryview(b'x' * sizes[-1] * 1000000)
+
+print('frame round trip')
+
+for mb in sizes:
+    t_start = time.time()
+    iters = 5
+    for z in range(iters):
+        test_framer(mb * 1000000)
+    spent = (time.time() - t_start) / iters
+    print('{:>4} MB: {:8.3f} ms, {:.3f} ms/MB'.format(mb, spent * 1000,
+                                                      spent * 1000 / mb))
+c.close()
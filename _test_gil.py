@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import socket
+import inspect
+import threading
+
+import pptop.injection
+import pptop.plugins.threads as threads_plugin
+
+from pptop.channel import Channel
+from pptop import packers
+
+num_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+iters = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+active = True
+
+
+def idle():
+    while active:
+        time.sleep(0.1)
+
+
+def ticker(result):
+    # target request thread: measure how late it wakes up
+    while active:
+        t = time.perf_counter()
+        time.sleep(0.001)
+        result.append(time.perf_counter() - t - 0.001)
+
+
+for i in range(num_threads):
+    t = threading.Thread(target=idle)
+    t.daemon = True
+    t.start()
+
+
+def test(budget, cpid):
+    sock_path = '/tmp/.pptop.{}'.format(cpid)
+    pptop.injection.start(cpid)
+    while not os.path.exists(sock_path):
+        time.sleep(0.01)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(sock_path)
+    channel = Channel(client, ord(client.recv(1)))
+    channel.start()
+    hello = packers.supported_codecs()
+    hello['gil'] = budget / 1000
+    channel.command('.hello', hello)
+    channel.command('.inject', {
+        'id': 'threads',
+        'i': inspect.getsource(threads_plugin.injection)
+    })
+    lags = []
+    t = threading.Thread(target=ticker, args=(lags,))
+    t.start()
+    t_start = time.time()
+    for i in range(iters):
+        channel.command('threads')
+    spent = (time.time() - t_start) / iters
+    global active
+    active = False
+    t.join()
+    active = True
+    gil = channel.command('.gil')
+    lags.sort()
+    print('budget {:>7.1f} ms: collect {:8.3f} ms, longest slice {:7.3f} ms, '
+          'target lag p99 {:7.3f} ms, max {:7.3f} ms'.format(
+              budget, spent * 1000, gil['max'],
+              lags[int(len(lags) * 0.99)] * 1000, lags[-1] * 1000))
+    channel.request('.bye')
+    channel.close()
+    time.sleep(0.5)
+
+
+print('{} threads, {} iterations'.format(num_threads, iters))
+for i, budget in enumerate((1000, 5, 1)):
+    test(budget, 1000000 + os.getpid() * 10 + i)
+    pptop.injection._gil.max = 0
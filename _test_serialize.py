@@ -0,0 +1,36 @@
+import time
+
+from pptop.injection import safe_serialize
+
+sizes = [10, 1000, 100000, 1000000]
+iters = 20
+
+
+def bench(name, obj):
+    t_start = time.time()
+    for i in range(iters):
+        result = safe_serialize(obj)
+    spent = (time.time() - t_start) / iters
+    print('{:>20}: {:9.3f} ms, result: {} chars'.format(
+        name, spent * 1000, len(str(result))))
+
+
+# marker of truncated dict must not replace a real key
+for keys in (['...', 'a', 'b'], ['a', '...', '....', 'b']):
+    result = safe_serialize(dict((k, k) for k in keys), max_items=len(keys) - 1)
+    for k in keys[:-1]:
+        assert result[k] == k, result
+    assert len(result) == len(keys), result
+    assert '({} items)'.format(len(keys)) in result.values(), result
+print('dict truncation marker ok')
+
+print('safe_serialize, {} iterations'.format(iters))
+
+for size in sizes:
+    print('{} items'.format(size))
+    bench('list', list(range(size)))
+    bench('tuple', tuple(range(size)))
+    bench('set', set(range(size)))
+    bench('dict', {i: str(i) for i in range(size)})
+    bench('nested', [{'a': list(range(100)), 'b': 'x' * 100}] * size)
+    bench('string', 'x' * size * 10)
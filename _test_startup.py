@@ -0,0 +1,101 @@
+import os
+import re
+import sys
+import pty
+import time
+import fcntl
+import struct
+import select
+import signal
+import termios
+import tempfile
+import subprocess
+
+iters = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+plugin = sys.argv[2] if len(sys.argv) > 2 else 'threads'
+
+dir_me = os.path.dirname(os.path.realpath(__file__))
+pptop = [sys.executable, dir_me + '/bin/pptop']
+
+env = os.environ.copy()
+env['PYTHONPATH'] = dir_me
+env['TERM'] = 'xterm-256color'
+
+target = tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False)
+target.write('''
+import time
+while True:
+    time.sleep(0.1)
+''')
+target.close()
+
+# bottom bar with pickle protocol is drawn
+first_frame = re.compile(rb'P:\d')
+
+
+def run_version():
+    t = time.time()
+    subprocess.run(pptop + ['-V'], env=env, stdout=subprocess.DEVNULL)
+    return time.time() - t
+
+
+def run_exec():
+    t = time.time()
+    subprocess.run(pptop + ['-J', '-x', '-', target.name],
+                   env=env,
+                   input=b'out = 1',
+                   stdout=subprocess.DEVNULL)
+    return time.time() - t
+
+
+def run_interactive():
+    t = time.time()
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.execve(sys.executable, pptop + ['-d', plugin, target.name], env)
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', 50, 200, 0, 0))
+    out = b''
+    result = None
+    deadline = t + 30
+    while time.time() < deadline:
+        if select.select([fd], [], [], 0.1)[0]:
+            try:
+                out += os.read(fd, 65536)
+            except OSError:
+                break
+            if first_frame.search(out):
+                result = time.time() - t
+                break
+    # F10
+    os.write(fd, b'\x1b[21~')
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        if os.waitpid(pid, os.WNOHANG)[0]:
+            break
+        if select.select([fd], [], [], 0.1)[0]:
+            try:
+                os.read(fd, 65536)
+            except OSError:
+                pass
+    else:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    os.close(fd)
+    if result is None:
+        raise RuntimeError('first frame not drawn')
+    return result
+
+
+print('{} iterations, default plugin: {}'.format(iters, plugin))
+print('{:>14}  {:>9}  {:>9}  {:>9}'.format('', 'min ms', 'avg ms', 'max ms'))
+try:
+    for name, fn in (('-V', run_version), ('-x', run_exec),
+                     ('first frame', run_interactive)):
+        data = [fn() for i in range(iters)]
+        print('{:>14}  {:9.3f}  {:9.3f}  {:9.3f}'.format(
+            name,
+            min(data) * 1000,
+            sum(data) / len(data) * 1000,
+            max(data) * 1000))
+finally:
+    os.unlink(target.name)
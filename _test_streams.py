@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import socket
+import logging
+import inspect
+import threading
+
+import pptop.injection
+import pptop.plugins.log as log_plugin
+
+from pptop.channel import Channel
+from pptop import packers
+
+records = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+ring_size = int(sys.argv[2]) if len(sys.argv) > 2 else 16 * 1024 * 1024
+
+logger = logging.getLogger('pptop_test')
+
+
+def connect(cpid, shm):
+    sock_path = '/tmp/.pptop.{}'.format(cpid)
+    pptop.injection.start(cpid)
+    while not os.path.exists(sock_path):
+        time.sleep(0.01)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(sock_path)
+    channel = Channel(client, ord(client.recv(1)))
+    channel.start()
+    hello = packers.supported_codecs()
+    if shm:
+        hello['shm'] = {'size': ring_size}
+    result = channel.command('.hello', hello)
+    if result.get('shm'):
+        channel.attach_ring(result['shm'])
+    return channel
+
+
+def test(transport, cpid):
+    channel = connect(cpid, transport == 'shm')
+    channel.command(
+        '.inject', {
+            'id': 'log',
+            'l': inspect.getsource(log_plugin.injection_load),
+            'i': inspect.getsource(log_plugin.injection),
+            'u': inspect.getsource(log_plugin.injection_unload)
+        })
+    received = []
+    dropped = []
+    done = threading.Event()
+
+    def on_push(items, d):
+        received.append(len(items))
+        dropped.append(d)
+
+    channel.subscribe('log', on_push, {'buffer': records})
+    logging.getLogger().setLevel(logging.INFO)
+    t_start = time.time()
+    for i in range(records):
+        logger.info('record %s', i)
+    t_emit = time.time() - t_start
+    while sum(received) + sum(dropped) + channel.ring_overruns < records:
+        time.sleep(0.001)
+    spent = time.time() - t_start
+    print('{:>6}: emit {:8.3f} ms, delivered {:8.3f} ms, {:>7} received, '
+          '{} dropped, {} overruns, {} frames'.format(
+              transport, t_emit * 1000, spent * 1000, sum(received),
+              sum(dropped), channel.ring_overruns, channel.frames_pushed))
+    channel.request('.bye')
+    channel.close()
+    time.sleep(0.5)
+
+
+print('{} log records'.format(records))
+logging.getLogger().addHandler(logging.NullHandler())
+for i, transport in enumerate(('socket', 'shm')):
+    test(transport, 1000000 + os.getpid() * 10 + i)
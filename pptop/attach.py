@@ -0,0 +1,343 @@
+'''
+Attaching to processes
+
+Agent injection with persistent gdb/MI controller, launching programs with
+agent, resident agent lookup and connection handshake.
+
+The module is used by interactive client as well as by one-shot commands, so
+it must not import curses, plugins or task supervisor.
+'''
+
+import getpass
+import glob
+import os
+import pickle
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+from pptop.gdbmi import GDB, dl_libs
+from pptop.injection import resident_address
+from pptop.logger import config as log_config, log, log_traceback
+from pptop.exceptions import CriticalException
+
+socket_timeout = 15
+
+injection_timeout = 3
+
+python_names = ['python', 'python2', 'python3']
+
+# persistent gdb/MI controllers, one per thread
+_gdb = {}
+_gdb_lock = threading.Lock()
+
+
+def is_python_process(p):
+    '''
+    Check if process is Python process of the current user (any user if
+    started as root), pptop itself is excluded
+
+    Args:
+        p: psutil.Process object
+    '''
+    name = p.name().split('.', 1)[0]
+    fname = p.exe().rsplit('/', 1)[-1].split('.', 1)[0]
+    if name not in python_names and fname not in python_names:
+        return False
+    if p.pid == os.getpid():
+        return False
+    return not os.getuid() or p.username() == getpass.getuser()
+
+
+def find_lib(name):
+    '''
+    Find first library matching pattern
+    '''
+    for d in sys.path:
+        lib = glob.glob('{}/{}'.format(d, name))
+        if lib:
+            return lib[0]
+
+
+def init_inject(method=None):
+    '''
+    Choose inject method
+
+    Args:
+        method: None / 'auto', 'native', 'loadcffi' or 'unsafe'
+
+    Returns:
+        tuple (inject method, inject library)
+    '''
+    if method is None or method == 'auto':
+        lib = find_lib('__pptop_injector.*.so')
+        if lib:
+            return 'native', lib
+        lib = find_lib('_cffi_backend.*.so')
+        if lib:
+            return 'loadcffi', lib
+        return 'unsafe', None
+    elif method == 'native':
+        lib = find_lib('__pptop_injector.*.so')
+        if not lib:
+            raise RuntimeError(
+                '__pptop_injector shared library not found.' +
+                ' reinstall package or select different inject method')
+        return method, lib
+    elif method == 'loadcffi':
+        lib = find_lib('_cffi_backend.*.so')
+        if not lib:
+            raise RuntimeError(
+                '_cffi_backend shared library not found.' +
+                ' install "cffi" package or select different inject method')
+        return method, lib
+    else:
+        return 'unsafe', None
+
+
+def find_gdb(path=None):
+    '''
+    Find gdb and check if processes can be attached
+
+    Returns:
+        path to gdb
+    '''
+    gdb = path if path else shutil.which('gdb')
+    if not gdb or not os.path.isfile(gdb):
+        raise RuntimeError('gdb not found')
+    # check yama ptrace scope
+    try:
+        with open('/proc/sys/kernel/yama/ptrace_scope') as fd:
+            yps = int(fd.read().strip())
+    except:
+        yps = None
+    if yps:
+        raise RuntimeError(
+            'yama ptrace scope is on. ' +
+            'disable with "sudo sysctl -w kernel.yama.ptrace_scope=0"')
+    return gdb
+
+
+def get_gdb_controller(gdb):
+    '''
+    Get persistent gdb/MI controller of the current thread, start it if not
+    started yet
+
+    Returns:
+        tuple (controller, spawn time)
+    '''
+    thread_id = threading.get_ident()
+    with _gdb_lock:
+        ctl = _gdb.get(thread_id)
+    if ctl is not None and ctl.is_alive():
+        return ctl, 0
+    ctl = GDB(gdb, timeout=socket_timeout * 3)
+    with _gdb_lock:
+        _gdb[thread_id] = ctl
+    return ctl, ctl.spawn_time
+
+
+def drop_gdb_controller(ctl):
+    '''
+    Close controller of the current thread, e.g. if its state is unknown after
+    failure, the next call of get_gdb_controller starts a new one
+    '''
+    thread_id = threading.get_ident()
+    with _gdb_lock:
+        if _gdb.get(thread_id) is ctl:
+            del _gdb[thread_id]
+    ctl.close()
+
+
+def stop_gdb_controller():
+    with _gdb_lock:
+        controllers = list(_gdb.values())
+        _gdb.clear()
+    for ctl in controllers:
+        ctl.close()
+
+
+def format_attach_timings(timings):
+    return ', '.join(
+        '{} {:.3f}'.format(k, v) for k, v in timings.items()) + ' sec'
+
+
+def inject_server(pid, gdb, method, lib, protocol, key=None):
+    '''
+    Inject server with persistent gdb/MI controller
+
+    Args:
+        key: agent socket key (default: client PID)
+
+    Returns:
+        dict of attach phase timings (seconds)
+    '''
+    libpath = os.path.abspath(os.path.dirname(__file__) + '/..')
+    if key is None:
+        key = os.getpid()
+    timings = OrderedDict()
+    ctl, timings['spawn'] = get_gdb_controller(gdb)
+    try:
+        timings['attach'] = ctl.attach(pid)
+        if method in ['native', 'loadcffi']:
+            timings['dlopen'] = ctl.call(
+                'call (void)dlopen("{}", 2)'.format(lib), libs=dl_libs)
+        if method == 'native':
+            timings['call'] = ctl.call(
+                'call (int)__pptop_start_injection("{}",{},{},"{}")'.format(
+                    libpath, key, protocol,
+                    log_config.fname if log_config.fname else ''),
+                libs=re.escape(os.path.basename(lib)))
+        else:
+            t = time.time()
+            ctl.call('set $pptop_gil = (PyGILState_STATE)PyGILState_Ensure()',
+                     libs='libpython')
+            ctl.call(('call (int)PyRun_SimpleString("' +
+                      'import sys\\nif \\"{path}\\" not in sys.path: ' +
+                      'sys.path.insert(0,\\"{path}\\")\\n' +
+                      'import pptop.injection;pptop.injection.start(' +
+                      '{mypid},{protocol}{lg})")').format(
+                          path=libpath,
+                          mypid=key,
+                          lg='' if not log_config.fname else
+                          ',lg=\\"{}\\"'.format(log_config.fname),
+                          protocol=protocol))
+            ctl.call('call (void)PyGILState_Release($pptop_gil)')
+            timings['call'] = time.time() - t
+        timings['detach'] = ctl.detach()
+    except:
+        # detaches the process if still attached
+        drop_gdb_controller(ctl)
+        raise
+    log('attached to {}: {}'.format(pid, format_attach_timings(timings)))
+    return timings
+
+
+def launch(fname,
+           python=None,
+           args=None,
+           wait=None,
+           protocol=None,
+           output=subprocess.PIPE):
+    '''
+    Launch program with agent
+
+    Args:
+        output: stdout/stderr of program (default: pipes, which must be
+                drained by caller)
+
+    Returns:
+        subprocess.Popen object
+    '''
+    if not python:
+        python = shutil.which('python3')
+        if not python:
+            raise RuntimeError(
+                'python3 not found in path, please specify manually')
+    cmd = (python, '-m', 'pptop.injection', fname, str(os.getpid()))
+    if wait is not None:
+        cmd += ('-w', str(wait))
+    if protocol is not None:
+        cmd += ('-p', str(protocol))
+    if args:
+        cmd += ('-a', args)
+    if log_config.fname:
+        cmd += ('--log', log_config.fname)
+    log('starting child process')
+    return subprocess.Popen(cmd,
+                            shell=False,
+                            stdout=output,
+                            stderr=output)
+
+
+def connect_resident(pid):
+    '''
+    Connect to resident agent of the process
+
+    Returns:
+        connected socket or None if there's no resident agent
+    '''
+    path = resident_address.format(pid)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(socket_timeout)
+    try:
+        sock.connect(path)
+        return sock
+    except:
+        log_traceback()
+        sock.close()
+        # the agent is gone
+        try:
+            os.unlink(path)
+        except:
+            pass
+        return None
+
+
+def connect(sock, key=None):
+    '''
+    Connect to just injected or launched agent, wait until it starts
+    listening
+
+    Args:
+        key: agent socket key (default: client PID)
+    '''
+    sock.settimeout(socket_timeout)
+    sock_path = '/tmp/.pptop.{}'.format(os.getpid() if key is None else key)
+    for i in range(injection_timeout * 10):
+        if os.path.exists(sock_path):
+            break
+        time.sleep(0.1)
+    try:
+        sock.connect(sock_path)
+    except:
+        log_traceback()
+        raise RuntimeError('Unable to connect to process')
+
+
+def handshake(sock, protocol, force=False):
+    '''
+    Receive agent pickle protocol
+
+    Returns:
+        pickle protocol to use
+    '''
+    frame = b''
+    time_start = time.time()
+    while len(frame) < 1:
+        data = sock.recv(1)
+        if data:
+            frame += data
+            if time.time() > time_start + socket_timeout:
+                raise CriticalException('Socket timeout')
+    server_protocol = struct.unpack('b', frame)[0]
+    if server_protocol < protocol:
+        if force:
+            raise RuntimeError(
+                'Process doesn\'t support protocol {}'.format(protocol))
+        log('Falling back to protocol {}'.format(server_protocol))
+        return server_protocol
+    return protocol
+
+
+def check_protocol(protocol):
+    '''
+    Check requested pickle protocol
+
+    Returns:
+        protocol to use
+    '''
+    if protocol is None:
+        return pickle.HIGHEST_PROTOCOL
+    if protocol > pickle.HIGHEST_PROTOCOL or protocol < 1:
+        raise ValueError('Protocol {} is not supported'.format(protocol))
+    return protocol
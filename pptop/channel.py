@@ -0,0 +1,523 @@
+'''
+Client channel to injection server
+
+Requests are multiplexed over a single socket: any number of requests can be
+in flight at once, responses are matched to requests by frame id, which
+server returns back in response frames.
+
+Chunked responses (continuation frames) are concatenated, requests with chunk
+callbacks are never batched.
+
+Frames, pushed by server for subscribed streams, are routed to subscription
+callbacks. If shared memory ring is attached, stream items are read from the
+ring instead.
+
+If batch window is set, periodic requests, issued within the window, are
+coalesced and sent to server as a single .batch command.
+'''
+
+import threading
+import pickle
+import socket
+import time
+
+from pptop.framing import Framer, FLAG_MORE, FRAME_ID_MASK
+from pptop.injection import (response_meta, batch_header, batch_item,
+                             push_frame_id)
+from pptop import packers
+from pptop import shm
+from pptop.exceptions import CriticalException
+from pptop.logger import log, log_traceback
+
+# received frames counter is displayed modulo this value
+frame_counter_reset = 1000
+
+# shared memory ring poll interval (seconds)
+ring_poll_interval = 0.05
+
+# interactive, service and fast-lane commands are never delayed for batching:
+# the server runs a batch in its connection thread only if all batched
+# commands are fast, so a fast command, batched with a heavy one, would wait
+# for the whole batch in the task queue
+no_batch_commands = ('.hello', '.inject', '.x', '.exec', '.obj', '.ready',
+                     '.bye', '.batch', '.bench', '.subscribe', '.unsubscribe',
+                     '.test', '.status', '.gs', '.path', '.le', '.gil',
+                     '.overhead')
+
+
+class Request:
+    '''
+    Request in flight
+    '''
+
+    def __init__(self, channel, frame_id, cmd, params=None, on_chunk=None):
+        self.channel = channel
+        self.frame_id = frame_id
+        self.cmd = cmd
+        self.params = params
+        self.on_chunk = on_chunk
+        self.chunks = None
+        self.time_start = time.time()
+        self.time_chunk = None
+        self.time_end = None
+        self.status = None
+        self.data = None
+        self.error = None
+        self.cancelled = False
+        self.queue_time = None  # server-side, seconds
+        self.exec_time = None  # server-side, seconds
+        self.serialize_time = None  # server-side, seconds
+        self.payload_size = None  # bytes, before compression
+        self.completed = threading.Event()
+
+    def _complete(self, status=None, data=None, meta=None, error=None):
+        if meta is not None:
+            self.queue_time = meta[0] / 1000000
+            self.exec_time = meta[1] / 1000000
+            self.serialize_time = meta[2] / 1000000
+            self.payload_size = meta[3]
+            self.channel._account(self)
+        self.status = status
+        self.data = data
+        self.error = error
+        self.time_end = time.time()
+        self.completed.set()
+
+    def _chunk(self, status, data):
+        if status != 0 or self.cancelled:
+            return
+        batch = packers.loads(data)
+        if self.chunks is None:
+            self.chunks = []
+        self.chunks.extend(batch)
+        self.time_chunk = time.time()
+        if self.on_chunk:
+            try:
+                self.on_chunk(batch)
+            except:
+                log_traceback()
+
+    def cancel(self):
+        '''
+        Cancel request, its response is dropped when received
+        '''
+        self.cancelled = True
+        self.channel._cancel(self)
+
+    def wait(self, timeout=None):
+        '''
+        Wait for response
+
+        Returns:
+            decoded response or True if command has no response data
+
+        Raises:
+            TimeoutError: if timeout is reached (request is cancelled)
+            RuntimeError: if command failed
+            CriticalException: if channel is broken
+        '''
+        time_chunk = None
+        while not self.completed.wait(timeout):
+            # chunked response is in progress
+            if self.time_chunk == time_chunk:
+                self.cancel()
+                raise TimeoutError('{} timeout'.format(self.cmd))
+            time_chunk = self.time_chunk
+        if self.error:
+            raise self.error
+        if self.status != 0:
+            log('injector command error, code: {}'.format(self.status))
+            raise RuntimeError('Injector command error')
+        result = packers.loads(self.data) if len(self.data) else True
+        if self.chunks is not None:
+            self.chunks.extend(result)
+            result = self.chunks
+            self.chunks = None
+        return result
+
+    @property
+    def latency(self):
+        return (self.time_end or time.time()) - self.time_start
+
+
+class BatchRequest(Request):
+    '''
+    Requests, sent to server as a single .batch command
+    '''
+
+    def __init__(self, channel, requests):
+        super().__init__(channel, None, '.batch',
+                         [(r.cmd, {} if r.params is None else r.params)
+                          for r in requests])
+        self.requests = requests
+
+    def _complete(self, status=None, data=None, meta=None, error=None):
+        # the batch itself is not accounted, its requests are
+        super()._complete(status=status, data=data, error=error)
+        if error or status != 0:
+            for req in self.requests:
+                req._complete(status=status, data=b'', error=error)
+            return
+        pos = batch_header.size
+        for req in self.requests:
+            s, l, t_exec, t_serialize = batch_item.unpack(
+                data[pos:pos + batch_item.size])
+            pos += batch_item.size
+            if not req.cancelled:
+                req._complete(status=ord(s),
+                              data=data[pos:pos + l],
+                              meta=(meta[0], t_exec, t_serialize, l) +
+                              meta[4:])
+            pos += l
+
+
+class Channel:
+    '''
+    Multiplexed request channel
+
+    Args:
+        sock: connected socket, after handshake is completed
+        protocol: pickle protocol
+        timeout: default request timeout
+        batch_window: coalesce requests, issued within the window (seconds)
+    '''
+
+    def __init__(self, sock, protocol, timeout=15, batch_window=None):
+        self.sock = sock
+        self.protocol = protocol
+        self.timeout = timeout
+        self.batch_window = batch_window
+        self.framer = Framer(sock, timeout=timeout)
+        self.frame_id = 0
+        self.frames_received = 0
+        self.batches_sent = 0
+        self.frames_pushed = 0
+        # from the latest response trailer
+        self.runner_status = None
+        self.stdout_pending = 0
+        # total server exec and serialize time (seconds), the latest cost of
+        # commands: (exec time, serialize time, payload size)
+        self.target_time = 0
+        self.cmd_stats = {}
+        self.pending = {}
+        # ids of cancelled requests, reserved until their responses arrive
+        self.cancelled = set()
+        self.subscriptions = {}
+        self.ring = None
+        self.ring_streams = []
+        self.error = None
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.batch = []
+        self.batch_lock = threading.Lock()
+        self.batch_event = threading.Event()
+        self.reader = threading.Thread(name='__pptop_channel_reader',
+                                       target=self._read_loop)
+        self.reader.daemon = True
+        self.batcher = threading.Thread(name='__pptop_channel_batcher',
+                                        target=self._batch_loop)
+        self.batcher.daemon = True
+
+    def start(self):
+        # the reader blocks until frame is received, request timeouts are
+        # handled by waiters
+        self.sock.settimeout(None)
+        self.reader.start()
+        if self.batch_window:
+            self.batcher.start()
+
+    def _next_frame_id(self):
+        while True:
+            self.frame_id += 1
+            if self.frame_id > FRAME_ID_MASK:
+                # 0 is reserved for server push frames
+                self.frame_id = 1
+            if self.frame_id not in self.pending and \
+                    self.frame_id not in self.cancelled:
+                return self.frame_id
+
+    def _send(self, req):
+        frame = (req.cmd.encode(),)
+        if req.params is not None:
+            frame += (b'\xff', pickle.dumps(req.params,
+                                            protocol=self.protocol))
+        with self.lock:
+            if self.error:
+                raise self.error
+            req.frame_id = self._next_frame_id()
+            self.pending[req.frame_id] = req
+        try:
+            with self.send_lock:
+                self.framer.send(req.frame_id, *frame)
+        except:
+            log_traceback()
+            self._fail(CriticalException('Injector is gone'))
+            raise self.error
+
+    def request(self, cmd, params=None, on_chunk=None):
+        '''
+        Send request without waiting for response
+
+        Args:
+            cmd: command
+            params: command params
+            on_chunk: function(batch), called by channel reader thread for
+                each batch of chunked response, except the last one
+
+        Returns:
+            Request object
+        '''
+        req = Request(self, None, cmd, params, on_chunk)
+        if self.batch_window and cmd not in no_batch_commands and \
+                on_chunk is None:
+            with self.batch_lock:
+                if self.error:
+                    raise self.error
+                self.batch.append(req)
+            self.batch_event.set()
+        else:
+            self._send(req)
+        return req
+
+    def command(self, cmd, params=None, timeout=None, on_chunk=None):
+        '''
+        Execute command and wait for its response
+        '''
+        return self.request(cmd, params, on_chunk).wait(
+            self.timeout if timeout is None else timeout)
+
+    def batch_command(self, cmds, timeout=None):
+        '''
+        Execute commands as a single .batch command, never delayed
+
+        Args:
+            cmds: list of (cmd, params)
+
+        Returns:
+            list of requests, completed or failed
+        '''
+        requests = [Request(self, None, cmd, params) for cmd, params in cmds]
+        req = BatchRequest(self, requests)
+        self._send(req)
+        if not req.completed.wait(self.timeout if timeout is None else timeout):
+            req.cancel()
+            raise TimeoutError('.batch timeout')
+        if req.error:
+            raise req.error
+        return requests
+
+    def subscribe(self, stream_id, callback, params=None):
+        '''
+        Subscribe to server stream
+
+        Args:
+            stream_id: plugin id or .gs for stdout/stderr
+            callback: function(items, dropped), called by channel reader
+                thread when items are pushed
+            params: stream params (items, latency, buffer)
+        '''
+        p = params.copy() if params else {}
+        p['id'] = stream_id
+        if self.ring:
+            if stream_id not in self.ring_streams:
+                self.ring_streams.append(stream_id)
+            p['shm'] = True
+            p['n'] = self.ring_streams.index(stream_id)
+        self.subscriptions[stream_id] = callback
+        try:
+            self.command('.subscribe', p)
+        except:
+            self.subscriptions.pop(stream_id, None)
+            raise
+
+    def unsubscribe(self, stream_id):
+        '''
+        Unsubscribe from server stream
+        '''
+        self.subscriptions.pop(stream_id, None)
+        self.command('.unsubscribe', {'id': stream_id})
+
+    def _push(self, data):
+        stream_id, items, dropped = packers.loads(data)
+        callback = self.subscriptions.get(stream_id)
+        if callback:
+            try:
+                callback(items, dropped)
+            except:
+                log_traceback()
+        else:
+            log('push frame for stream {} dropped, not subscribed'.format(
+                stream_id))
+
+    def attach_ring(self, path):
+        '''
+        Attach shared memory ring, created by server
+        '''
+        self.ring = shm.Ring(path)
+        # both sides have the ring mapped, the file is not required anymore
+        self.ring.unlink()
+        t = threading.Thread(name='__pptop_channel_ring_reader',
+                             target=self._ring_loop)
+        t.daemon = True
+        t.start()
+
+    def _ring_loop(self):
+        while not self.error:
+            try:
+                records = self.ring.read()
+            except:
+                if not self.error:
+                    log_traceback()
+                return
+            if records:
+                items = {}
+                for n, kind, data in records:
+                    if kind == shm.KIND_TEXT:
+                        i = [data.decode('utf-8', 'replace')]
+                    else:
+                        i = packers.loads(data)
+                    items.setdefault(n, []).extend(i)
+                for n, i in items.items():
+                    callback = self.subscriptions.get(self.ring_streams[n])
+                    if callback:
+                        try:
+                            callback(i, 0)
+                        except:
+                            log_traceback()
+            time.sleep(ring_poll_interval)
+
+    @property
+    def ring_overruns(self):
+        '''
+        Records, dropped by server because shared memory ring was full
+        '''
+        return self.ring.overruns if self.ring else 0
+
+    def _batch_loop(self):
+        while not self.error:
+            self.batch_event.wait()
+            # let other requests of the same tick join the batch
+            time.sleep(self.batch_window)
+            with self.batch_lock:
+                self.batch_event.clear()
+                requests = [r for r in self.batch if not r.cancelled]
+                self.batch = []
+            try:
+                if len(requests) == 1:
+                    self._send(requests[0])
+                elif requests:
+                    self._send(BatchRequest(self, requests))
+                    self.batches_sent += 1
+            except:
+                # channel is failed, requests are completed with error
+                for req in requests:
+                    req._complete(error=self.error)
+
+    def _account(self, req):
+        key = req.cmd
+        if key == '.delta':
+            key = req.params['id']
+        self.cmd_stats[key] = (req.exec_time, req.serialize_time,
+                               req.payload_size)
+        self.target_time += req.exec_time + req.serialize_time
+
+    def _meta(self, data):
+        meta = response_meta.unpack(data[len(data) - response_meta.size:])
+        self.runner_status = meta[4]
+        self.stdout_pending = meta[5]
+        return meta
+
+    def _cancel(self, req):
+        with self.lock:
+            if self.pending.get(req.frame_id) is req:
+                del self.pending[req.frame_id]
+                self.cancelled.add(req.frame_id)
+
+    def _fail(self, error):
+        with self.lock:
+            if not self.error:
+                self.error = error
+            pending = list(self.pending.values())
+            self.pending.clear()
+            self.cancelled.clear()
+        with self.batch_lock:
+            pending += self.batch
+            self.batch = []
+        self.batch_event.set()
+        for req in pending:
+            req._complete(error=self.error)
+
+    def _read_loop(self):
+        try:
+            while True:
+                frame = self.framer.recv(detach=True)
+                if frame is None:
+                    if not self.error:
+                        log('critical: no data from injector')
+                    self._fail(CriticalException('Injector error'))
+                    return
+                frame_id, data = frame
+                more = frame_id & FLAG_MORE
+                frame_id &= FRAME_ID_MASK
+                meta = self._meta(data)
+                if frame_id == push_frame_id:
+                    self.frames_pushed += 1
+                    self._push(data[1:len(data) - response_meta.size])
+                    continue
+                with self.lock:
+                    if more:
+                        req = self.pending.get(frame_id)
+                    else:
+                        self.frames_received += 1
+                        req = self.pending.pop(frame_id, None)
+                        if req is None:
+                            self.cancelled.discard(frame_id)
+                if req:
+                    meta_pos = len(data) - response_meta.size
+                    if more:
+                        req._chunk(data[0], data[1:meta_pos])
+                        continue
+                    req._complete(status=data[0],
+                                  data=data[1:meta_pos],
+                                  meta=meta)
+                else:
+                    log('frame {} dropped, request is cancelled'.format(
+                        frame_id))
+        except:
+            if not self.error:
+                log_traceback()
+            self._fail(CriticalException('Injector is gone'))
+
+    @property
+    def octets(self):
+        '''
+        Bytes received on wire
+        '''
+        return self.framer.octets_received
+
+    @property
+    def octets_raw(self):
+        '''
+        Bytes received, after decompression
+        '''
+        return self.framer.octets_received_raw
+
+    def close(self):
+        self._fail(CriticalException('Channel closed'))
+        # close doesn't interrupt the reader, blocked in recv, so server
+        # wouldn't notice the client is gone until its socket timeout
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except:
+            pass
+        if self.reader.is_alive() and \
+                self.reader is not threading.current_thread():
+            self.reader.join(self.timeout)
+        if self.ring:
+            # let ring reader finish
+            time.sleep(ring_poll_interval)
+            self.ring.close()
@@ -0,0 +1,561 @@
+'''
+Command line interface
+
+Arguments are parsed and one-shot commands (-x, --bench-attach) are executed
+without loading interactive client: curses, plugins, psutil and task
+supervisor are imported only if pptop is started in interactive mode.
+'''
+
+import argparse
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import textwrap
+import time
+
+from collections import OrderedDict
+
+import yaml
+
+from pptop import attach
+from pptop import packers
+from pptop.channel import Channel
+from pptop.gdbmi import dl_libs
+# client and agent are always released together
+from pptop.injection import __injection_version__ as __version__
+from pptop.logger import config as log_config, log, log_traceback, init_logging
+
+# client start time, for startup benchmarks
+time_started = time.time()
+
+dir_me = os.path.dirname(os.path.realpath(__file__))
+
+display = {'colors': True}
+
+
+def colored(text, color=None, on_color=None, attrs=None):
+    if not display['colors']:
+        return str(text)
+    try:
+        import neotermcolor as termcolor
+        return termcolor.colored(str(text),
+                                 color=color,
+                                 on_color=on_color,
+                                 attrs=attrs)
+    except:
+        return str(text)
+
+
+def err(text):
+    return colored(text, color='red', attrs=['bold'])
+
+
+def print_json(obj):
+    from pyaltt2.json import jprint
+    jprint(obj, colored=display['colors'])
+
+
+def get_arg_parser():
+    ap = argparse.ArgumentParser(description='ppTOP version %s' %
+                                 __version__)
+    ap.add_argument('-V',
+                    '--version',
+                    help='Print version and exit',
+                    action='store_true')
+    ap.add_argument('-R',
+                    '--raw',
+                    help='Raw mode (disable colors and unicode glyphs)',
+                    action='store_true')
+    ap.add_argument('--disable-glyphs',
+                    help='disable unicode glyphs',
+                    action='store_true')
+    ap.add_argument('file',
+                    nargs='?',
+                    help='File, PID file or PID',
+                    metavar='FILE/PID')
+    ap.add_argument('-a', '--args', metavar='ARGS', help='Child args (quoted)')
+    ap.add_argument('-G',
+                    '--group',
+                    help='Attach to process and its Python child processes ' +
+                    '(pre-fork servers), show aggregated data',
+                    action='store_true')
+    ap.add_argument('--python',
+                    metavar='FILE',
+                    help='Python interpreter to launch file')
+    ap.add_argument('-O',
+                    '--output-file',
+                    metavar='FILE',
+                    help='Write stdout/stderr of launched program to file ' +
+                    '(rotated)')
+    ap.add_argument('--gdb', metavar='FILE', help='Path to gdb')
+    ap.add_argument('-p',
+                    '--protocol',
+                    metavar='VER',
+                    type=int,
+                    help=textwrap.dedent('''Pickle protocol, default is highest.
+                4: Python 3.4+,
+                3: Python 3.0+,
+                2: Python 2.3+,
+                1: vintage'''))
+    ap.add_argument('--inject-method',
+                    choices=['auto', 'native', 'loadcffi', 'unsafe'],
+                    help='Inject method')
+    ap.add_argument('-g',
+                    '--grab-stdout',
+                    help='Grab stdout/stderr of injected process',
+                    action='store_true')
+    ap.add_argument(
+        '-w',
+        '--wait',
+        metavar='SEC',
+        type=float,
+        help='If file is specified, wait seconds to start main code')
+    ap.add_argument(
+        '-f',
+        '--config-file',
+        help='Alternative config file (default: ~/.pptop/pptop.yml)',
+        metavar='CONFIG',
+        dest='config')
+    ap.add_argument('-d',
+                    '--default',
+                    help='Default plugin to launch',
+                    metavar='PLUGIN',
+                    dest='plugin')
+    ap.add_argument(
+        '-o',
+        '--plugin-option',
+        help='Override plugin config option, e.g. threads.filter=mythread',
+        metavar='NAME=VALUE',
+        action='append',
+        dest='plugin_options')
+    ap.add_argument('--log', metavar='FILE', help='Send debug log to file')
+    ap.add_argument(
+        '-x',
+        '--exec',
+        help='Exec code from a file ("-" for stdin) and exit '
+            ' (the code can put result to "out" var)',
+        metavar='FILE',
+        dest='_exec')
+    ap.add_argument(
+        '--pids',
+        help='Exec code in many processes in parallel (fleet mode), ' +
+        'print merged JSON: PIDs, comma-separated, or regex, matched ' +
+        'against command lines of Python processes',
+        metavar='LIST|PATTERN')
+    ap.add_argument('--workers',
+                    metavar='N',
+                    type=int,
+                    default=8,
+                    help='Fleet mode: max parallel injections (default: 8)')
+    ap.add_argument('-J',
+                    '--json',
+                    help='Output exec result as JSON',
+                    action='store_true')
+    ap.add_argument('-D',
+                    '--detach',
+                    help='Keep agent resident after exit, with plugins ' +
+                    'collecting data, next sessions reattach with no gdb',
+                    action='store_true')
+    ap.add_argument('--stop-agent',
+                    help='Stop resident agent of process (PID) and exit',
+                    action='store_true')
+    ap.add_argument('-B',
+                    '--budget',
+                    metavar='PCT',
+                    type=float,
+                    help='Overhead budget: CPU time of agent, %% of one ' +
+                    'CPU core, plugins are throttled if exceeded (0 - off)')
+    ap.add_argument('--bench-attach',
+                    help='Benchmark attach phases of process (PID) and ' +
+                    'exit (5 iterations, the process is stopped once per ' +
+                    'iteration by gdb/MI controller and once by gdb --batch)',
+                    action='store_true')
+    ap.add_argument('--bench-codecs',
+                    help='Benchmark payload codecs on plugin responses and exit',
+                    action='store_true')
+    return ap
+
+
+def parse_args():
+    ap = get_arg_parser()
+    try:
+        import argcomplete
+        argcomplete.autocomplete(ap)
+    except:
+        pass
+    return ap.parse_args()
+
+
+def get_pptop_dir():
+    return os.path.expanduser('~/.pptop')
+
+
+def load_config(a):
+    '''
+    Load config, create user config dir with default config if missing
+    '''
+    pptop_dir = get_pptop_dir()
+    if a.config:
+        config_file = a.config
+        use_default_config = False
+    else:
+        config_file = pptop_dir + '/pptop.yml'
+        use_default_config = True
+    if use_default_config and not os.path.isfile(config_file):
+        log('no user config, setting default')
+        try:
+            os.mkdir(pptop_dir)
+        except:
+            pass
+        if not os.path.isdir(pptop_dir + '/scripts'):
+            shutil.copytree(dir_me + '/config/scripts', pptop_dir + '/scripts')
+        shutil.copy(dir_me + '/config/pptop.yml', pptop_dir + '/pptop.yml')
+        if not os.path.isdir(pptop_dir + '/lib'):
+            os.mkdir(pptop_dir + '/lib')
+    with open(config_file) as fh:
+        config = yaml.safe_load(fh.read())
+    if config.get('display') is None:
+        config['display'] = {}
+    if a.raw:
+        config['display']['colors'] = False
+    if a.raw or a.disable_glyphs:
+        config['display']['glyphs'] = False
+    display['colors'] = config['display'].get('colors', True)
+    return config
+
+
+def get_pid(fname):
+    '''
+    Get PID from command line argument (PID or PID file)
+
+    Returns:
+        PID or None if the argument is a program to launch
+    '''
+    try:
+        return int(fname)
+    except:
+        # probably pid file
+        try:
+            with open(fname) as fh:
+                return int(fh.read(128))
+        except:
+            return None
+
+
+def get_pids(spec):
+    '''
+    Get PIDs of processes for fleet mode
+
+    Args:
+        spec: comma-separated list of PIDs or regular expression, matched
+              against command lines of Python processes of the current user
+
+    Returns:
+        sorted list of PIDs
+    '''
+    try:
+        return sorted(set(int(x) for x in spec.split(',') if x.strip()))
+    except ValueError:
+        pass
+    import psutil
+    regex = re.compile(spec)
+    pids = []
+    for p in psutil.process_iter():
+        try:
+            with p.oneshot():
+                if attach.is_python_process(p) and regex.search(' '.join(
+                        p.cmdline())):
+                    pids.append(p.pid)
+        except psutil.Error:
+            pass
+    return sorted(pids)
+
+
+def read_code(fname):
+    if fname == '-':
+        return sys.stdin.read()
+    else:
+        with open(fname) as fd:
+            return fd.read()
+
+
+def run_code(a, config, code, target, inject=None, key=None):
+    '''
+    Execute code in process
+
+    Args:
+        target: PID, PID file or file to launch
+        inject: tuple (gdb, inject method, inject library), resolved if not
+                specified
+        key: agent socket key (default: client PID)
+
+    Returns:
+        tuple (exec result, timings)
+    '''
+    t = time.time()
+    timings = {}
+    pid = get_pid(target)
+    protocol = attach.check_protocol(a.protocol)
+    sock = None
+    if pid:
+        sock = attach.connect_resident(pid)
+    if sock:
+        log('reattached to resident agent of {}'.format(pid))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if pid:
+            if inject is None:
+                method, lib = attach.init_inject(a.inject_method or
+                                                 config.get('inject-method'))
+                inject = (attach.find_gdb(a.gdb), method, lib)
+            timings['attach'] = dict(
+                attach.inject_server(pid, *inject, protocol=protocol,
+                                     key=key))
+        else:
+            # output of program is not displayed
+            attach.launch(os.path.abspath(target),
+                          python=a.python,
+                          args=a.args,
+                          wait=a.wait,
+                          protocol=a.protocol,
+                          output=subprocess.DEVNULL)
+        attach.connect(sock, key)
+    t_connected = time.time()
+    timings['connect'] = t_connected - t
+    try:
+        protocol = attach.handshake(sock, protocol, a.protocol is not None)
+    except:
+        sock.close()
+        raise
+    channel = Channel(sock, protocol, timeout=attach.socket_timeout)
+    channel.start()
+    try:
+        channel.command('.hello', packers.supported_codecs())
+        result = channel.command('.x', code)
+    finally:
+        channel.close()
+    timings['exec'] = time.time() - t_connected
+    timings['total'] = time.time() - t
+    return result, timings
+
+
+def exec_code(a, config):
+    '''
+    Execute code in process, print the result
+    '''
+    if not a.file:
+        raise RuntimeError('-x requires PID or file')
+    result, timings = run_code(a, config, read_code(a._exec), a.file)
+    log('exec result in {:.3f} sec'.format(time.time() - time_started))
+    if result[0] == 0:
+        if a.json:
+            print_json(result[1])
+        else:
+            print(result[1] if result[1] else '')
+    else:
+        print(err('{}: {}'.format(result[1], result[2])))
+    return 0
+
+
+def exec_fleet(a, config):
+    '''
+    Execute code in many processes in parallel, print merged JSON document
+
+    Agents are injected with own gdb/MI controller per pool worker and listen
+    on sockets, keyed by target PIDs, so injections don't wait for each
+    other
+
+    Returns:
+        0 if code is executed in all processes, 1 if failed in some
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    if a.file:
+        raise RuntimeError('--pids and FILE/PID can not be used together')
+    pids = get_pids(a.pids)
+    if not pids:
+        raise RuntimeError('no processes found')
+    code = read_code(a._exec)
+    inject = None
+    if not all(
+            os.path.exists(attach.resident_address.format(pid))
+            for pid in pids):
+        method, lib = attach.init_inject(a.inject_method or
+                                         config.get('inject-method'))
+        inject = (attach.find_gdb(a.gdb), method, lib)
+
+    def run(pid):
+        r = {'pid': pid, 'out': None, 'error': None}
+        t = time.time()
+        try:
+            result, r['time'] = run_code(a,
+                                         config,
+                                         code,
+                                         str(pid),
+                                         inject=inject,
+                                         key=pid)
+            if result[0] == 0:
+                r['out'] = result[1]
+            else:
+                r['error'] = '{}: {}'.format(result[1], result[2])
+        except Exception as e:
+            log_traceback()
+            r['error'] = '{}: {}'.format(e.__class__.__name__, e)
+            r['time'] = {'total': time.time() - t}
+        return r
+
+    t = time.time()
+    workers = min(a.workers, len(pids))
+    log('fleet: {} processes, {} workers'.format(len(pids), workers))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, pids))
+    failed = len([r for r in results if r['error'] is not None])
+    doc = {
+        'pids': pids,
+        'ok': len(pids) - failed,
+        'failed': failed,
+        'workers': workers,
+        'time': time.time() - t,
+        'results': results
+    }
+    log('fleet exec results in {:.3f} sec'.format(time.time() - time_started))
+    print_json(doc)
+    return 1 if failed else 0
+
+
+def stop_agent(a):
+    '''
+    Stop resident agent of process, plugins it keeps are unloaded
+    '''
+    pid = get_pid(a.file) if a.file else None
+    if not pid:
+        raise RuntimeError('--stop-agent requires PID')
+    sock = attach.connect_resident(pid)
+    if not sock:
+        raise RuntimeError('no resident agent in process {}'.format(pid))
+    try:
+        protocol = attach.handshake(sock, attach.check_protocol(a.protocol),
+                                    a.protocol is not None)
+    except:
+        sock.close()
+        raise
+    channel = Channel(sock, protocol, timeout=attach.socket_timeout)
+    channel.start()
+    try:
+        channel.command('.hello', packers.supported_codecs())
+        channel.request('.bye', {'stop': True})
+    finally:
+        channel.close()
+    log('resident agent of {} stopped'.format(pid))
+    return 0
+
+
+def bench_attach(a, config, iters=5):
+    '''
+    Benchmark attach phases of persistent gdb/MI controller against gdb,
+    spawned per attach
+
+    Nothing is injected: the inject library is loaded (as on injection) on
+    the first iteration only, so its reference count in the target isn't
+    increased on every attach, and a harmless function is called. The target
+    is stopped during every attach
+    '''
+    pid = get_pid(a.file) if a.file else None
+    if not pid:
+        raise RuntimeError('--bench-attach requires PID')
+    gdb = attach.find_gdb(a.gdb)
+    method, lib = attach.init_inject(a.inject_method or
+                                     config.get('inject-method'))
+    results = OrderedDict((k, []) for k in ('spawn', 'attach', 'dlopen',
+                                            'call', 'detach', 'total',
+                                            'gdb --batch'))
+    for i in range(iters):
+        t = time.time()
+        ctl, spawn = attach.get_gdb_controller(gdb)
+        if not i:
+            results['spawn'].append(spawn)
+        try:
+            results['attach'].append(ctl.attach(pid))
+            if not i and method in ['native', 'loadcffi']:
+                results['dlopen'].append(
+                    ctl.call('call (void)dlopen("{}", 2)'.format(lib),
+                             libs=dl_libs))
+            results['call'].append(ctl.call('call (int)getpid()'))
+            results['detach'].append(ctl.detach())
+        except:
+            attach.drop_gdb_controller(ctl)
+            raise
+        results['total'].append(time.time() - t)
+        t = time.time()
+        proc = subprocess.Popen(
+            [gdb, '-p',
+             str(pid), '--batch', '--eval-command=call (int)getpid()'],
+            shell=False,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        proc.communicate()
+        results['gdb --batch'].append(time.time() - t)
+    if a.json:
+        print_json([{
+            'phase': k,
+            'min': min(v),
+            'avg': sum(v) / len(v),
+            'max': max(v),
+        } for k, v in results.items() if v])
+        return 0
+    import rapidtables
+    table = []
+    for k, v in results.items():
+        d = OrderedDict()
+        d['phase'] = k
+        if v:
+            d['min ms'] = '{:.3f}'.format(min(v) * 1000)
+            d['avg ms'] = '{:.3f}'.format(sum(v) / len(v) * 1000)
+            d['max ms'] = '{:.3f}'.format(max(v) * 1000)
+        else:
+            d['min ms'] = d['avg ms'] = d['max ms'] = '-'
+        table.append(d)
+    print(rapidtables.make_table(table))
+    return 0
+
+
+def main():
+    '''
+    Parse arguments, run one-shot command or start interactive client
+
+    Returns:
+        exit code
+    '''
+    a = parse_args()
+    if a.version:
+        print('ppTOP version %s' % __version__)
+        return 0
+    if a.log:
+        log_config.fname = a.log
+        log_config.name = 'client:{}'.format(os.getpid())
+        init_logging()
+    if a.pids and not a._exec:
+        raise RuntimeError('--pids requires -x')
+    if a.workers < 1:
+        raise ValueError('--workers must be positive')
+    if a.stop_agent:
+        return stop_agent(a)
+    if a._exec or a.bench_attach:
+        log('initializing')
+        config = load_config(a)
+        try:
+            if a._exec and a.pids:
+                return exec_fleet(a, config)
+            elif a._exec:
+                return exec_code(a, config)
+            else:
+                return bench_attach(a, config)
+        except:
+            log_traceback()
+            raise
+        finally:
+            attach.stop_gdb_controller()
+    from pptop.core import start
+    return start(a)
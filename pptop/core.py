@@ -19,25 +19,22 @@ import sys
 import curses
 import neotasker
 import socket
-import struct
 import yaml
 import logging
 import inspect
 import threading
 import psutil
 import os
-import getpass
-import subprocess
 import importlib
 import signal
 import uuid
 import time
 import pickle
-import shutil
-import argparse
+import json
 import collections
 import readline
-import textwrap
+import select
+import rapidtables
 
 import neotermcolor as termcolor
 
@@ -66,10 +63,24 @@ from pptop.ui.console import resize_term, resize_handler
 from pptop.ui.console import prompt, print_message, scr, palette, glyph
 from pptop.ui.console import hide_cursor, show_cursor
 
-from pptop.logger import config as log_config, log, log_traceback, init_logging
+from pptop.logger import log, log_traceback
 
 from pptop.exceptions import CriticalException
 
+from pptop.channel import Channel, frame_counter_reset
+
+from pptop.attach import socket_timeout
+from pptop.attach import connect_resident, stop_gdb_controller
+
+from pptop import attach
+from pptop import cli
+
+from pptop.injection import client_threads
+from pptop.injection import source_hash
+
+from pptop import packers
+from pptop import shm
+
 logging.getLogger('asyncio').setLevel(logging.CRITICAL)
 logging.getLogger('neotasker').setLevel(100)
 
@@ -111,29 +122,24 @@ events_by_key = {
     'KEY_F(10)': 'quit',
     ' ': 'reload',
     'CTRL_X': 'reset',
-    'Z': 'cursor-toggle'
+    'Z': 'cursor-toggle',
+    'G': 'group-next'
 }
 
 plugins_autostart = []
 
 bottom_bar_help = {10: 'Quit'}
+bottom_bar_shortcuts = ['KEY_F({})'.format(i) for i in range(1, 11)]
 plugin_shortcuts = {}
 
 plugin_lock = threading.Lock()
 
-stdout_buf_lock = threading.Lock()
-
-socket_timeout = 15
-
-injection_timeout = 3
-
-socket_buf = 8192
+plugin_load_lock = threading.RLock()
 
+stdout_buf_lock = threading.Lock()
 
-class ppLoghandler(logging.Handler):
-
-    def emit(self, record):
-        log(super().format(record))
+# console completions are cached (seconds)
+completion_cache_ttl = 10
 
 
 def after_resize():
@@ -150,7 +156,10 @@ def get_config_dir():
 
 
 def get_plugin(plugin_name):
-    return plugins.get(plugin_name)
+    plugin = plugins.get(plugin_name)
+    if plugin:
+        load_plugin(plugin)
+    return plugin
 
 
 def get_child_info():
@@ -178,6 +187,10 @@ def apply_interval(plugin):
             return
     plugin.stop()
     plugin.start(_interval=new_interval)
+    if _d.governor:
+        # the new interval is stretched by governor as well
+        _d.governor.intervals[plugin.name] = new_interval
+        plugin.delay = new_interval * _d.governor.factor
     plugin.show()
     with scr.lock:
         print_message('Interval changed', color=palette.OK)
@@ -323,12 +336,18 @@ def cli_mode():
         if not text or text.find('.') == -1:
             return None
         o = text.rsplit('.', 1)[0]
-        src = 'try: __result = dir({})\nexcept: pass'.format(o)
-        result = command('.exec', src)
-        if not result or result[0] or not result[1]: return None
-        matches = [
-            s for s in result[1] if ('{}.{}'.format(o, s)).startswith(text)
-        ]
+        # readline calls completer for each match, object attributes are
+        # requested once and cached
+        c = _d.completions.get(o)
+        if c is None or time.time() - c[0] > completion_cache_ttl:
+            try:
+                result = command('.obj', {'op': 'dir', 'expr': o})
+            except:
+                return None
+            if not result or result[0] or not result[1]: return None
+            c = (time.time(), result[1])
+            _d.completions[o] = c
+        matches = [s for s in c[1] if ('{}.{}'.format(o, s)).startswith(text)]
         try:
             return '{}.{}'.format(o, matches[state])
         except IndexError:
@@ -399,6 +418,7 @@ def cli_mode():
                         cmds = [cmd]
                     for cmd in cmds:
                         r = command('.exec', cmd)
+                        _d.completions.clear()
                         if r[0] == -1:
                             print(err('{}: {}'.format(r[1], r[2])))
                         else:
@@ -430,16 +450,10 @@ class ProcesSelector(GenericPlugin):
 
     def load_data(self):
         self.data.clear()
-        px = ['python', 'python2', 'python3']
-        user = getpass.getuser() if os.getuid() else 'root'
         for p in psutil.process_iter():
             try:
                 with p.oneshot():
-                    name = p.name().split('.', 1)[0]
-                    fname = p.exe().rsplit('/', 1)[-1].split('.', 1)[0]
-                    if (name in px or
-                            fname in px) and p.pid != os.getpid() and (
-                                user == 'root' or p.username() == user):
+                    if attach.is_python_process(p):
                         d = OrderedDict()
                         d['pid'] = p.pid
                         d['command line'] = ' '.join(p.cmdline())
@@ -524,56 +538,87 @@ def select_process():
 
 
 ifoctets_lock = threading.Lock()
-client_lock = threading.Lock()
 
 client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
-frame_counter_reset = 1000
 
+def get_channel(pid=None):
+    '''
+    Get channel to process: the specified group member, the focused one or
+    the main process
+    '''
+    g = _d.group
+    if g:
+        if pid is None:
+            pid = g.focus
+        if pid is not None and pid != _d.process.pid:
+            with g.lock:
+                member = g.members.get(pid)
+            if member is None:
+                raise RuntimeError('process {} is not attached'.format(pid))
+            return member.channel
+    return _d.channel
+
+
+def command(cmd, params=None, timeout=None, on_chunk=None, pid=None):
+    return get_channel(pid).command(cmd,
+                                    params,
+                                    timeout=timeout,
+                                    on_chunk=on_chunk)
+
+
+def command_group(cmd, params=None, timeout=None):
+    '''
+    Execute command in all processes of the group, requests are sent at once
 
-def command(cmd, params=None):
-    with client_lock:
-        _d.client_frame_id += 1
-        if _d.client_frame_id >= frame_counter_reset:
-            _d.client_frame_id = 1
-            _d.last_frame_id = 0
+    Returns:
+        dict pid: response, processes, where command failed, are skipped
+    '''
+    channels = [(_d.process.pid, _d.channel)]
+    if _d.group:
+        with _d.group.lock:
+            channels += [
+                (pid, m.channel) for pid, m in _d.group.members.items()
+            ]
+    requests = []
+    for pid, channel in channels:
+        try:
+            requests.append((pid, channel, channel.request(cmd, params)))
+        except:
+            log_traceback()
+    result = OrderedDict()
+    for pid, channel, req in requests:
         try:
-            frame = cmd.encode()
-            if params is not None:
-                frame += b'\xff' + pickle.dumps(params, protocol=_d.protocol)
-            client.sendall(
-                struct.pack('I', len(frame)) +
-                struct.pack('I', _d.client_frame_id) + frame)
-            time_start = time.time()
-            data = client.recv(4)
-            frame_id = struct.unpack('I', client.recv(4))[0]
+            result[pid] = req.wait(
+                channel.timeout if timeout is None else timeout)
         except:
             log_traceback()
-            raise CriticalException('Injector is gone')
-        if not data:
-            log('critical: no data from injector')
-            raise CriticalException('Injector error')
-        l = struct.unpack('I', data)[0]
-        data = b''
-        while len(data) != l:
-            data += client.recv(socket_buf)
-            if time.time() > time_start + socket_timeout:
-                raise CriticalException('Socket timeout')
-        if frame_id != _d.client_frame_id:
-            log('critical: got wrong frame, channel is broken')
-            raise CriticalException('Wrong frame')
-        _d.last_frame_id += 1
-        with ifoctets_lock:
-            _d.ifoctets += len(data) + 8
-            if _d.ifoctets > 1000000000:
-                _d.ifoctets = _d.ifoctets - 1000000000
-        if data[0] != 0:
-            log('injector command error, code: {}'.format(data[0]))
-            raise RuntimeError('Injector command error')
-        return pickle.loads(data[1:]) if len(data) > 1 else True
+    return result
+
+
+def is_group_aggregate():
+    return _d.group is not None and _d.group.focus is None
+
+
+def get_group_processes():
+    '''
+    Get processes of the group, which are displayed: all or the focused one
+    '''
+    g = _d.group
+    with g.lock:
+        if g.focus is None:
+            return [_d.process] + [m.process for m in g.members.values()]
+        member = g.members.get(g.focus)
+    return [member.process if member else _d.process]
+
+
+def subscribe(stream_id, callback, params=None):
+    return _d.channel.subscribe(stream_id, callback, params)
 
 
 def get_process():
+    if _d.group and _d.group.focus is not None:
+        return get_group_processes()[0]
     return _d.process
 
 
@@ -596,6 +641,37 @@ def recalc_info_col_pos():
             _info_col_pos[i] = pos
 
 
+def get_process_stats(p):
+    '''
+    Get process stats for the header, values are summed for process group
+    '''
+    # agent threads of all clients, as reported by agent, if unknown: own
+    # client threads and agent loop
+    agent_threads = _d.agent_threads.get(p.pid) or client_threads + 1
+    with p.oneshot():
+        ct = p.cpu_times()
+        memf = p.memory_full_info()
+        mem = p.memory_info()
+        ioc = p.io_counters()
+        return SimpleNamespace(
+            cpu=p.cpu_percent(),
+            user=ct.user,
+            system=ct.system,
+            # always hide pptop threads
+            threads=p.num_threads() - agent_threads,
+            uss=memf.uss,
+            pss=memf.pss,
+            swap=memf.swap,
+            shared=mem.shared,
+            text=mem.text,
+            data=mem.data,
+            files=len(p.open_files()),
+            read_count=ioc.read_count,
+            read_chars=ioc.read_chars,
+            write_count=ioc.write_count,
+            write_chars=ioc.write_chars)
+
+
 @neotasker.background_worker(delay=1)
 async def show_process_info(p, **kwargs):
 
@@ -630,78 +706,121 @@ async def show_process_info(p, **kwargs):
         width = scr.infowin.getmaxyx()[1]
         status = _d.status
         scr.infowin.clear()
-        with p.oneshot():
-            ct = p.cpu_times()
-            memf = p.memory_full_info()
-            mem = p.memory_info()
-            ioc = p.io_counters()
-            scr.infowin.move(0, 0)
-            scr.infowin.addstr('Process: ')
-            cmdline = format_cmdline(p, _d.need_inject_server)
-            scr.infowin.addstr(cmdline[:width - 25], palette.YELLOW)
-            scr.infowin.addstr(' [')
-            scr.infowin.addstr(
-                str(p.pid), palette.GREEN if status == 1 else palette.GREY_BOLD)
-            scr.infowin.addstr(']')
-            if status == -1:
-                xst = 'WAIT'
-                xstc = palette.GREY_BOLD
-            elif status == 0:
-                xst = 'DONE'
-                xstc = palette.GREY_BOLD
-            elif status == -2:
-                xst = 'ERROR'
-                xstc = palette.ERROR
+        procs = get_group_processes() if _d.group else [p]
+        st = None
+        cmdline = None
+        for proc in procs:
+            try:
+                pst = get_process_stats(proc)
+                if cmdline is None:
+                    cmdline = format_cmdline(proc, _d.need_inject_server)
+            except psutil.NoSuchProcess:
+                if proc is _d.process:
+                    raise
+                # group member is gone
+                continue
+            if st is None:
+                st = pst
             else:
-                xst = None
-            if xst:
-                scr.infowin.addstr(' ' + xst, xstc)
-
-            cpup = p.cpu_percent()
-
-            draw_val(0, 0, 'CPU', '{}%'.format(cpup), palette.BLUE_BOLD)
-            draw_val(1, 0, 'user', ct.user, palette.BOLD)
-            draw_val(2, 0, 'system', ct.system, palette.BOLD)
-            # always hide pptop thread
-            draw_val(3, 0, 'threads', p.num_threads() - 1, palette.MAGENTA)
-
-            # if config['display'].get('glyphs'):
-            # gauge = _vblks[-1] * int(cpup // 25)
-            # i = int(cpup % 25 / 25 * len(_vblks))
-            # if i:
-            # gauge += _vblks[i - 1]
-            # x = _info_col_width[0] + 1
-            # for i, g in enumerate(gauge):
-            # scr.stdscr.addstr(4 - i, x, g * 2,
-            # (palette.GREEN, palette.YELLOW,
-            # palette.RED, palette.RED)[i])
-
-            draw_val(0, 1, 'Memory uss', bytes_to_iso(memf.uss), palette.BOLD)
-            draw_val(1, 1, 'pss', bytes_to_iso(memf.pss), palette.BOLD)
-            draw_val(2, 1, 'swap', bytes_to_iso(memf.swap),
-                     palette.GREY if memf.swap < 1000000 else palette.YELLOW)
-
-            draw_val(0, 2, 'shd', bytes_to_iso(mem.shared), palette.BOLD)
-            draw_val(1, 2, 'txt', bytes_to_iso(mem.text), palette.BOLD)
-            draw_val(2, 2, 'dat', bytes_to_iso(mem.data), palette.BOLD)
-
-            draw_val(0,
-                     3,
-                     'Files:',
-                     len(p.open_files()),
-                     palette.CYAN,
-                     spacer=False)
-
-            draw_val(1,
-                     3,
-                     value='{} {} ({})'.format(glyph.UPLOAD, ioc.read_count,
-                                               bytes_to_iso(ioc.read_chars)),
-                     color=palette.GREEN)
-            draw_val(2,
-                     3,
-                     value='{} {} ({})'.format(glyph.DOWNLOAD, ioc.write_count,
-                                               bytes_to_iso(ioc.write_chars)),
-                     color=palette.BLUE)
+                for k, v in vars(pst).items():
+                    setattr(st, k, getattr(st, k) + v)
+        if st is None:
+            # the focused group member is gone
+            set_group_focus(None)
+            return
+        scr.infowin.move(0, 0)
+        if len(procs) > 1:
+            scr.infowin.addstr('Process group: ')
+        else:
+            scr.infowin.addstr('Process: ')
+        scr.infowin.addstr(cmdline[:width - 25], palette.YELLOW)
+        scr.infowin.addstr(' [')
+        scr.infowin.addstr(
+            str(procs[0].pid),
+            palette.GREEN if status == 1 else palette.GREY_BOLD)
+        scr.infowin.addstr(']')
+        if len(procs) > 1:
+            scr.infowin.addstr(' +{}'.format(len(procs) - 1), palette.CYAN)
+        if status == -1:
+            xst = 'WAIT'
+            xstc = palette.GREY_BOLD
+        elif status == 0:
+            xst = 'DONE'
+            xstc = palette.GREY_BOLD
+        elif status == -2:
+            xst = 'ERROR'
+            xstc = palette.ERROR
+        else:
+            xst = None
+        if xst:
+            scr.infowin.addstr(' ' + xst, xstc)
+
+        draw_val(0, 0, 'CPU', '{}%'.format(round(st.cpu, 1)), palette.BLUE_BOLD)
+        draw_val(1, 0, 'user', round(st.user, 2), palette.BOLD)
+        draw_val(2, 0, 'system', round(st.system, 2), palette.BOLD)
+        draw_val(3, 0, 'threads', st.threads, palette.MAGENTA)
+
+        # if config['display'].get('glyphs'):
+        # gauge = _vblks[-1] * int(cpup // 25)
+        # i = int(cpup % 25 / 25 * len(_vblks))
+        # if i:
+        # gauge += _vblks[i - 1]
+        # x = _info_col_width[0] + 1
+        # for i, g in enumerate(gauge):
+        # scr.stdscr.addstr(4 - i, x, g * 2,
+        # (palette.GREEN, palette.YELLOW,
+        # palette.RED, palette.RED)[i])
+
+        draw_val(0, 1, 'Memory uss', bytes_to_iso(st.uss), palette.BOLD)
+        draw_val(1, 1, 'pss', bytes_to_iso(st.pss), palette.BOLD)
+        draw_val(2, 1, 'swap', bytes_to_iso(st.swap),
+                 palette.GREY if st.swap < 1000000 else palette.YELLOW)
+
+        draw_val(0, 2, 'shd', bytes_to_iso(st.shared), palette.BOLD)
+        draw_val(1, 2, 'txt', bytes_to_iso(st.text), palette.BOLD)
+        draw_val(2, 2, 'dat', bytes_to_iso(st.data), palette.BOLD)
+
+        gil = _d.gil
+        if gil:
+            # the longest GIL hold by pptop collectors in the last second
+            draw_val(3,
+                     1,
+                     'GIL pause',
+                     '{:.2f} ms'.format(gil['tick']),
+                     palette.YELLOW
+                     if gil['tick'] > gil['budget'] else palette.BOLD)
+
+        # target-side cost (exec + serialize) of the current plugin
+        # command and of all commands per second
+        try:
+            with plugin_lock:
+                name = _d.current_plugin['p'].name
+            cost = _d.channel.cmd_stats.get(name)
+        except:
+            cost = None
+        if cost:
+            draw_val(3, 2, 'cmd',
+                     '{:.2f} ms'.format((cost[0] + cost[1]) * 1000),
+                     palette.BOLD)
+        draw_val(3,
+                 3,
+                 value='{} {:.1f} ms/s'.format(glyph.CONNECTION,
+                                              _d.target_load * 1000),
+                 color=palette.YELLOW
+                 if _d.target_load > 0.05 else palette.GREY_BOLD)
+
+        draw_val(0, 3, 'Files:', st.files, palette.CYAN, spacer=False)
+
+        draw_val(1,
+                 3,
+                 value='{} {} ({})'.format(glyph.UPLOAD, st.read_count,
+                                           bytes_to_iso(st.read_chars)),
+                 color=palette.GREEN)
+        draw_val(2,
+                 3,
+                 value='{} {} ({})'.format(glyph.DOWNLOAD, st.write_count,
+                                           bytes_to_iso(st.write_chars)),
+                 color=palette.BLUE)
         with scr.lock:
             scr.infowin.refresh()
             scr.stdscr.refresh()
@@ -727,6 +846,15 @@ async def show_process_info(p, **kwargs):
         return error(e)
 
 
+def format_bw(bw):
+    if bw < 1000:
+        return '{} Bs'.format(bw)
+    elif bw < 1000000:
+        return '{:.0f} kBs'.format(bw / 1000)
+    else:
+        return '{:.0f} MBs'.format(bw / 1000000)
+
+
 @neotasker.background_worker(delay=0.1)
 async def show_bottom_bar(**kwargs):
     try:
@@ -747,19 +875,30 @@ async def show_bottom_bar(**kwargs):
                 i = 'I:' + str(i)
             except:
                 i = ''
-            stats = '{} P:{} {} {:03d}/{:03d} '.format(i, _d.protocol,
-                                                       glyph.CONNECTION,
-                                                       _d.client_frame_id,
-                                                       _d.last_frame_id)
+            gv = _d.governor
+            if gv and gv.reason:
+                # intervals are stretched by overhead governor
+                i = '{} ({} {:.1f}%/{}%)'.format(i, gv.reason, gv.load,
+                                                gv.budget)
+            stats = '{} P:{} {} {:03d}/{:03d} '.format(
+                i, _d.protocol, glyph.CONNECTION, _d.channel.frame_id,
+                _d.channel.frames_received % frame_counter_reset)
+            g = _d.group
+            if g:
+                # focused process of the group
+                stats = 'G:{}/{} '.format(
+                    'all' if g.focus is None else g.focus,
+                    len(g.members) + 1) + stats
+            if _d.channel.ring:
+                # records, dropped because shared memory ring was full
+                stats = 'SHM ovr:{} '.format(_d.channel.ring_overruns) + stats
             with ifoctets_lock:
                 bw = _d.ifbw
-            if bw < 1000:
-                bws = '{} Bs'.format(bw)
-            elif bw < 1000000:
-                bws = '{:.0f} kBs'.format(bw / 1000)
-            else:
-                bws = '{:.0f} MBs'.format(bw / 1000000)
-            bws = bws.rjust(7)
+                bw_raw = _d.ifbw_raw
+            bws = format_bw(bw).rjust(7)
+            if _d.compression:
+                # raw > on wire
+                stats += format_bw(bw_raw) + ' >'
             if bw > 2000000:
                 bwc = palette.BAR_ERROR
             elif bw > 500000:
@@ -770,32 +909,51 @@ async def show_bottom_bar(**kwargs):
                               stats, color)
             scr.stdscr.addstr(bws, bwc)
             scr.stdscr.refresh()
+        if not _d.first_frame:
+            _d.first_frame = True
+            log('first frame in {:.3f} sec'.format(time.time() -
+                                                    cli.time_started))
+            # load plugins with bottom bar shortcuts in background
+            neotasker.spawn(load_plugins, [
+                plugin for plugin in plugins.values()
+                if plugin['shortcut'] in bottom_bar_shortcuts
+            ])
     except:
         pass
 
 
+def sleep_till_tick(interval):
+    '''
+    Sleep till the next interval boundary, so periodic commands of different
+    workers are issued at the same time and coalesced into a single frame
+    '''
+    time.sleep(interval - time.time() % interval)
+
+
 # don't make this async, it should always work in own thread
 @neotasker.background_worker
 def update_status(**kwargs):
     try:
-        _d.status = command('.status')
+        if _d.group:
+            gil = command_group('.gil')
+            _d.gil = gil.get(_d.group.focus or _d.process.pid)
+        else:
+            gil = {_d.process.pid: command('.gil')}
+            _d.gil = gil[_d.process.pid]
+        _d.agent_threads = dict(
+            (pid, r.get('threads')) for pid, r in gil.items())
+        # runner status is sent in trailer of every response
+        _d.status = _d.channel.runner_status
     except:
         log_traceback()
         status = -2
     finally:
-        time.sleep(1)
+        sleep_till_tick(1)
 
 
-@neotasker.background_worker
-def grab_stdout(**kwargs):
-    try:
-        result = command('.gs')
-        with stdout_buf_lock:
-            _d.stdout_buf += result
-    except:
-        log_traceback()
-    finally:
-        time.sleep(0.5)
+def push_stdout(items, dropped):
+    with stdout_buf_lock:
+        _d.stdout_buf += ''.join(items)
 
 
 @neotasker.background_worker
@@ -807,18 +965,272 @@ def print_stdout(**kwargs):
     time.sleep(0.1)
 
 
+# max length of child output line, longer lines are split
+child_output_line_max = 65536
+
+
+def init_child_output(child, cfg, fname=None):
+    '''
+    Start draining stdout/stderr pipes of launched child, so it never blocks
+    on write
+
+    Args:
+        cfg: child-output config
+        fname: output file (default: from config)
+    '''
+    if not fname:
+        fname = cfg.get('file')
+    _d.child_output = SimpleNamespace(
+        lines=collections.deque(maxlen=int(cfg.get('scrollback', 10000))),
+        total=0,
+        shown=0,
+        partial={},
+        streams={
+            child.stdout.fileno(): sys.stdout,
+            child.stderr.fileno(): sys.stderr
+        },
+        lock=threading.Lock(),
+        fname=os.path.abspath(os.path.expanduser(fname)) if fname else None,
+        file=None,
+        size=0,
+        max_size=int(cfg.get('max-size', 10485760)),
+        backups=int(cfg.get('backups', 3)))
+    for fd in _d.child_output.streams:
+        os.set_blocking(fd, False)
+    drain_child_output.start()
+
+
+def write_child_output_file(data):
+    '''
+    Write child output to file, rotate the file when max size is reached
+    '''
+    co = _d.child_output
+    try:
+        if co.file is None:
+            co.file = open(co.fname, 'ab')
+            co.size = co.file.tell()
+        elif co.size + len(data) > co.max_size:
+            co.file.close()
+            co.file = None
+            for i in range(co.backups - 1, 0, -1):
+                if os.path.exists('{}.{}'.format(co.fname, i)):
+                    os.rename('{}.{}'.format(co.fname, i),
+                              '{}.{}'.format(co.fname, i + 1))
+            if co.backups:
+                os.rename(co.fname, co.fname + '.1')
+            else:
+                os.unlink(co.fname)
+            co.file = open(co.fname, 'wb')
+            co.size = 0
+        co.file.write(data)
+        co.file.flush()
+        co.size += len(data)
+    except:
+        log_traceback()
+        # don't try again
+        co.fname = None
+
+
+# don't make this async, it should always work in own thread
+@neotasker.background_worker
+def drain_child_output(**kwargs):
+    co = _d.child_output
+    # partial buffer is set to None on EOF
+    fds = [
+        fd for fd in co.streams
+        if fd not in co.partial or co.partial[fd] is not None
+    ]
+    if not fds:
+        log('child output closed')
+        if co.file:
+            co.file.close()
+        return False
+    for fd in select.select(fds, [], [], 0.5)[0]:
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            continue
+        except:
+            data = b''
+        if co.fname and data:
+            write_child_output_file(data)
+        buf = co.partial.get(fd) or b''
+        if data:
+            lines = (buf + data).split(b'\n')
+            # the last line is incomplete
+            buf = lines.pop()
+            if len(buf) > child_output_line_max:
+                lines.append(buf)
+                buf = b''
+        else:
+            # EOF
+            lines = [buf] if buf else []
+            buf = None
+        co.partial[fd] = buf
+        if lines:
+            with co.lock:
+                co.lines.extend(
+                    (fd, l.decode('utf-8', 'replace')) for l in lines)
+                co.total += len(lines)
+
+
+@neotasker.background_worker
+def print_child_output(**kwargs):
+    co = _d.child_output
+    with co.lock:
+        n = min(co.total - co.shown, len(co.lines))
+        lines = list(co.lines)[len(co.lines) - n:] if n else []
+        co.shown = co.total
+    for fd, line in lines:
+        print(line, file=co.streams[fd])
+    sys.stdout.flush()
+    time.sleep(0.1)
+
+
 @neotasker.background_worker(interval=1)
 async def calc_bw(**kwargs):
+    octets = _d.channel.octets
+    octets_raw = _d.channel.octets_raw
+    target_time = _d.channel.target_time
+    _d.target_load = target_time - _d.target_time_prev
+    _d.target_time_prev = target_time
     with ifoctets_lock:
-        if _d.ifoctets >= _d.ifoctets_prev:
-            _d.ifbw = _d.ifoctets - _d.ifoctets_prev
+        _d.ifbw = octets - _d.ifoctets_prev
+        _d.ifbw_raw = octets_raw - _d.ifoctets_raw_prev
+        _d.ifoctets_prev = octets
+        _d.ifoctets_raw_prev = octets_raw
+
+
+# stops yappi profiler in process, plugins, which require it, start it again
+# when resumed
+stop_profiler_code = '''
+try:
+    import yappi
+    if yappi.is_running():
+        yappi.stop()
+except ImportError:
+    pass
+'''
+
+
+def pause_plugin(p, pause=True):
+    '''
+    Pause / resume plugin, the title is printed only if plugin is visible
+    '''
+    with scr.lock:
+        if p.is_visible():
+            p.pause() if pause else p.resume()
         else:
-            _d.ifbw = 1000000000 - _d.ifoctets_prev + _d.ifoctets
-        _d.ifoctets_prev = _d.ifoctets
+            p._paused = pause
+
+
+def apply_governor():
+    '''
+    Apply overhead governor level to plugins
+
+    Levels 1..stretch_levels stretch plugin intervals (x2 each level), the
+    next level pauses background plugins, the last one pauses plugins, which
+    require profiler, and switches profiler off
+    '''
+    gv = _d.governor
+    pause_bg = gv.level > gv.stretch_levels
+    pause_profiler = gv.level > gv.stretch_levels + 1
+    stop_profiler = pause_profiler and not gv.profiler_off
+    with plugin_lock:
+        current = _d.current_plugin
+    for plugin in plugins.values():
+        p = plugin.get('p')
+        if p is None:
+            # not loaded yet
+            continue
+        delay = gv.intervals.setdefault(p.name, p.delay) * gv.factor
+        if p.delay != delay:
+            p.delay = delay
+        if (pause_bg and plugin is not current and p.is_active()) or \
+                (pause_profiler and p.profiler):
+            if p.name not in gv.paused and not p.is_paused():
+                gv.paused.add(p.name)
+                pause_plugin(p)
+                if p.subscribed:
+                    _d.channel.unsubscribe(p.name)
+                    p.subscribed = False
+                    gv.unsubscribed.add(p.name)
+                if p.profiler:
+                    stop_profiler = True
+        elif p.name in gv.paused:
+            gv.paused.discard(p.name)
+            if p.name in gv.unsubscribed:
+                gv.unsubscribed.discard(p.name)
+                subscribe_plugin(plugin)
+            pause_plugin(p, False)
+    if stop_profiler:
+        command_group('.x', stop_profiler_code)
+    gv.profiler_off = pause_profiler
+
+
+def set_governor_level(level):
+    gv = _d.governor
+    gv.level = level
+    gv.factor = 2**min(level, gv.stretch_levels)
+    if not level:
+        gv.reason = None
+    elif level <= gv.stretch_levels:
+        gv.reason = 'x{}'.format(gv.factor)
+    elif level == gv.stretch_levels + 1:
+        gv.reason = 'x{}, bg paused'.format(gv.factor)
+    else:
+        gv.reason = 'x{}, bg paused, yappi off'.format(gv.factor)
+    log('overhead governor: level {}, load {:.2f}%, budget {}%'.format(
+        level, gv.load, gv.budget))
+    apply_governor()
+
+
+# don't make this async, it should always work in own thread
+@neotasker.background_worker
+def overhead_governor(**kwargs):
+    '''
+    Keep agent CPU time (% of one CPU core) within the budget
+
+    If the load is over the budget, the governor level is raised by one each
+    period. The level is lowered if the load is below half of the budget for
+    "hold" periods in a row (halving intervals roughly doubles the load)
+    '''
+    gv = _d.governor
+    try:
+        data = _d.channel.command('.overhead')
+        # wall time is accounted if process has no thread CPU clock
+        i = 2 if data['thread_cpu'] else 1
+        spent = sum(s[i] for s in data['stats'].values())
+        prev = gv.prev
+        gv.prev = (data['time'], spent)
+        if prev and data['time'] > prev[0]:
+            gv.load = (spent - prev[1]) / (data['time'] - prev[0]) * 100
+            level = gv.level
+            if gv.load > gv.budget:
+                gv.hold = 0
+                if level < gv.stretch_levels + 2:
+                    level += 1
+            elif gv.load * 2 < gv.budget and level:
+                gv.hold += 1
+                if gv.hold >= gv.hold_periods:
+                    gv.hold = 0
+                    level -= 1
+            else:
+                gv.hold = 0
+            if level != gv.level:
+                set_governor_level(level)
+                return
+        # plugins, started or switched since the level was set
+        apply_governor()
+    except:
+        log_traceback()
+    finally:
+        sleep_till_tick(gv.period)
 
 
 _d = SimpleNamespace(
     cli_first_time=True,
+    completions={},
     grab_stdout=False,
     stdout_buf='',
     current_plugin=None,
@@ -827,12 +1239,17 @@ _d = SimpleNamespace(
     process=None,
     protocol=None,
     force_protocol=None,
-    client_frame_id=0,
-    last_frame_id=0,
-    ifoctets=0,
     ifoctets_prev=0,
     ifbw=0,
+    ifoctets_raw_prev=0,
+    gil=None,
+    agent_threads={},
+    target_time_prev=0,
+    target_load=0,
+    ifbw_raw=0,
+    compression=None,
     pptop_dir=None,
+    channel=None,
     gdb=None,
     work_pid=None,
     need_inject_server=True,
@@ -843,7 +1260,16 @@ _d = SimpleNamespace(
     child_args='',
     status=None,
     console_json_mode=True,
-    exec_code=None,
+    codecs=[packers.CODEC_PICKLE],
+    bench_codecs=False,
+    overhead_budget=None,
+    first_frame=False,
+    detach=False,
+    governor=None,
+    group=None,
+    child_output=None,
+    resident=None,
+    agent_code=set(),
     output_as_json=False)
 
 
@@ -851,93 +1277,288 @@ def sigwinch_handler(signum=None, frame=None):
     resize_handler.trigger_threadsafe(force=True)
 
 
-def find_lib(name):
+def subscribe_plugin(plugin):
+    p = plugin['p']
+    if p.stream is not None:
+        try:
+            subscribe(p.name, p.on_push, p.stream)
+            p.subscribed = True
+        except:
+            log_traceback()
+            # fall back to polling
+            p.subscribed = False
+
+
+def injection_params(plugin, agent_code=None):
     '''
-    Find first library matching pattern
+    Plugin injection params, sources, already known by agent, are replaced with
+    their hashes
     '''
-    import glob
-    for d in sys.path:
-        lib = glob.glob('{}/{}'.format(d, name))
-        if lib:
-            return lib[0]
-
-
-def init_inject():
-    if _d.inject_method is None or _d.inject_method == 'auto':
-        _d.inject_method = 'native'
-        _d.inject_lib = find_lib('__pptop_injector.*.so')
-        if not _d.inject_lib:
-            _d.inject_method = 'loadcffi'
-            _d.inject_lib = find_lib('_cffi_backend.*.so')
-            if not _d.inject_lib:
-                _d.inject_method = 'unsafe'
-    else:
-        if _d.inject_method == 'native':
-            _d.inject_lib = find_lib('__pptop_injector.*.so')
-            if not _d.inject_lib:
-                raise RuntimeError(
-                    '__pptop_injector shared library not found.' +
-                    ' reinstall package or select different inject method')
-        elif _d.inject_method == 'loadcffi':
-            _d.inject_lib = find_lib('_cffi_backend.*.so')
-            if not _d.inject_lib:
-                raise RuntimeError(
-                    '_cffi_backend shared library not found.' +
-                    ' install "cffi" package or select different inject method')
-        else:
-            _d.inject_method = 'unsafe'
-
-
-def inject_server(gdb, p):
-    cmds = []
-    pid = p.pid
-    libpath = os.path.abspath(os.path.dirname(__file__) + '/..')
-    if _d.inject_method in ['native', 'loadcffi']:
-        cmds.append('call (void)dlopen("{}", 2)'.format(_d.inject_lib))
-    if _d.inject_method == 'native':
-        cmds.append('call (int)__pptop_start_injection("{}",{},{},"{}")'.format(
-            libpath, os.getpid(), _d.protocol,
-            log_config.fname if log_config.fname else ''))
-    else:
-        cmds += [
-            'call (PyGILState_STATE)PyGILState_Ensure()',
-            ('call (int)PyRun_SimpleString("' +
-             'import sys\\nif \\"{path}\\" not in sys.path: ' +
-             'sys.path.insert(0,\\"{path}\\")\\n' +
-             'import pptop.injection;pptop.injection.start(' +
-             '{mypid},{protocol}{lg})")').format(
-                 path=libpath,
-                 mypid=os.getpid(),
-                 lg='' if not log_config.fname else ',lg=\\"{}\\"'.format(
-                     log_config.fname),
-                 protocol=_d.protocol), ' call (void)PyGILState_Release($1)'
-        ]
-    args = [gdb, '-p', str(pid), '--batch'
-           ] + ['--eval-command={}'.format(c) for c in cmds]
-    log(args)
-    p = subprocess.Popen(args,
-                         shell=False,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    log(out)
-    log(err)
-    if p.returncode:
-        raise RuntimeError(err)
+    i = plugin['i']
+    if agent_code is None:
+        agent_code = _d.agent_code
+    return {
+        k: v
+        for k, v in i.items()
+        if k not in i['h'] or i['h'][k] not in agent_code
+    }
+
+
+def inject_plugins(plugin_list):
+    '''
+    Inject plugins with a single .batch command
+
+    Returns:
+        list of results (True if plugin is injected, False if failed)
+    '''
+    if not plugin_list:
+        return []
+    log('injecting plugins {}'.format([p['p'].name for p in plugin_list]))
+    try:
+        requests = _d.channel.batch_command([
+            ('.inject', injection_params(plugin)) for plugin in plugin_list
+        ])
+    except:
+        log_traceback()
+        return [False] * len(plugin_list)
+    result = []
+    for plugin, req in zip(plugin_list, requests):
+        try:
+            if req.status == 1:
+                # agent doesn't know the source, send it
+                _d.channel.command('.inject', plugin['i'])
+            else:
+                req.wait(0)
+            _d.agent_code.update(plugin['i']['h'].values())
+            subscribe_plugin(plugin)
+            result.append(True)
+        except:
+            log_traceback()
+            result.append(False)
+    if _d.group:
+        injected = [p for p, r in zip(plugin_list, result) if r]
+        with _d.group.lock:
+            members = list(_d.group.members.values())
+        for member in members:
+            inject_member(member, injected)
+    return result
+
+
+def inject_member(member, plugin_list):
+    '''
+    Inject plugins into process group member
+
+    Plugins are subscribed to streams of the main process only
+    '''
+    if not plugin_list:
+        return
+    channel = member.channel
+    try:
+        requests = channel.batch_command([
+            ('.inject', injection_params(plugin, member.agent_code))
+            for plugin in plugin_list
+        ])
+    except:
+        log_traceback()
+        return
+    for plugin, req in zip(plugin_list, requests):
+        try:
+            if req.status == 1:
+                channel.command('.inject', plugin['i'])
+            else:
+                req.wait(0)
+            member.agent_code.update(plugin['i']['h'].values())
+        except:
+            log_traceback()
 
 
 def inject_plugin(plugin):
     if plugin['p'].injected is False:
         log('injecting plugin {}'.format(plugin['p'].name))
         plugin['p'].injected = True
-        try:
-            command('.inject', plugin['i'])
+        if inject_plugins([plugin])[0]:
             return True
-        except:
+        else:
             print_message('Plugin injection failed', color=palette.ERROR)
             return False
 
 
+def attach_member(pid):
+    '''
+    Attach to process group member
+    '''
+    g = _d.group
+    process = psutil.Process(pid)
+    sock = connect_resident(pid)
+    if sock:
+        log('reattached to resident agent of {}'.format(pid))
+    else:
+        if not _d.gdb:
+            raise RuntimeError('gdb is required to attach to {}'.format(pid))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # agent socket is keyed by member pid, the client pid is used by
+        # the main process
+        attach.inject_server(pid,
+                             _d.gdb,
+                             _d.inject_method,
+                             _d.inject_lib,
+                             _d.protocol,
+                             key=pid)
+        attach.connect(sock, key=pid)
+    try:
+        protocol = attach.handshake(sock, _d.protocol,
+                                    _d.force_protocol is not None)
+    except:
+        sock.close()
+        raise
+    channel, result = open_channel(sock, protocol, ring=False)
+    member = SimpleNamespace(pid=pid,
+                             process=process,
+                             channel=channel,
+                             agent_code=set(result.get('code', ())))
+    # initialize cpu percent counter
+    process.cpu_percent()
+    injected = get_injected_plugins()
+    inject_member(member, injected)
+    with g.lock:
+        g.members[pid] = member
+    # plugins, injected while the member wasn't registered yet
+    inject_member(member,
+                  [p for p in get_injected_plugins() if p not in injected])
+    log('group member {} attached'.format(pid))
+
+
+def get_injected_plugins():
+    return [
+        plugin for plugin in plugins.values()
+        if 'p' in plugin and plugin['p'].injected
+    ]
+
+
+def set_group_focus(pid):
+    '''
+    Focus on process of the group (None - show aggregated data)
+    '''
+    g = _d.group
+    g.focus = pid
+    # delta-encoded results are cached per process
+    for plugin in plugins.values():
+        if 'p' in plugin:
+            plugin['p']._delta_seq = 0
+            plugin['p']._delta_rows = {}
+    show_process_info.trigger_threadsafe(force=True)
+    with plugin_lock:
+        current = _d.current_plugin
+    if current:
+        current['p'].trigger_threadsafe(force=True)
+
+
+def group_focus_next():
+    g = _d.group
+    with g.lock:
+        pids = [None, _d.process.pid] + sorted(g.members)
+    try:
+        i = pids.index(g.focus) + 1
+    except ValueError:
+        i = 0
+    set_group_focus(pids[i] if i < len(pids) else None)
+
+
+# don't make this async, attaching to processes blocks
+@neotasker.background_worker
+def update_group(**kwargs):
+    '''
+    Attach to new child processes, drop gone ones
+    '''
+    g = _d.group
+    try:
+        pids = set()
+        for p in _d.process.children(recursive=True):
+            try:
+                if attach.is_python_process(p):
+                    pids.add(p.pid)
+            except psutil.Error:
+                pass
+        with g.lock:
+            gone = [
+                m for pid, m in g.members.items()
+                if pid not in pids or m.channel.error
+            ]
+            for m in gone:
+                del g.members[m.pid]
+            new = pids - set(g.members)
+        for m in gone:
+            log('group member {} is gone'.format(m.pid))
+            m.channel.close()
+            if g.focus == m.pid:
+                set_group_focus(None)
+        for pid in sorted(new):
+            if pid in g.failed:
+                continue
+            try:
+                attach_member(pid)
+            except:
+                log_traceback()
+                # don't try to attach again
+                g.failed.add(pid)
+    except:
+        log_traceback()
+    finally:
+        time.sleep(g.rescan)
+
+
+def bench_codecs(iters=10):
+    ids = []
+    load_plugins(plugins.values())
+    pending = [
+        plugin for plugin in plugins.values()
+        if 'p' in plugin and plugin['p'].injected is False
+    ]
+    for plugin, result in zip(pending, inject_plugins(pending)):
+        if result:
+            plugin['p'].injected = True
+            ids.append(plugin['id'])
+        else:
+            print(err('plugin {}: injection failed'.format(plugin['id'])))
+    # let collectors collect some data
+    time.sleep(1)
+    result = command('.bench', {
+        'ids': ids,
+        'iters': iters
+    },
+                     timeout=socket_timeout * len(ids))
+    if _d.output_as_json:
+        print_json([{
+            'plugin': i,
+            'codec': packers.codec_names.get(c, c),
+            'size': r[0] if r else None,
+            'encode': r[1] if r else None,
+            'decode': r[2] if r else None,
+        } if c is not None else {
+            'plugin': i,
+            'error': r
+        } for i, c, r in result])
+        return
+    table = []
+    for i, c, r in result:
+        d = OrderedDict()
+        d['plugin'] = i
+        if c is None:
+            d['codec'] = err(r)
+            d['size'] = d['encode ms'] = d['decode ms'] = d['total ms'] = ''
+        else:
+            d['codec'] = packers.codec_names.get(c, c)
+            if r:
+                d['size'] = bytes_to_iso(r[0])
+                d['encode ms'] = '{:.3f}'.format(r[1])
+                d['decode ms'] = '{:.3f}'.format(r[2])
+                d['total ms'] = '{:.3f}'.format(r[1] + r[2])
+            else:
+                d['size'] = d['encode ms'] = d['decode ms'] = d['total ms'] = '-'
+        table.append(d)
+    print(rapidtables.make_table(table))
+
+
 def switch_plugin(new_plugin):
     if _d.current_plugin:
         if _d.current_plugin is new_plugin:
@@ -946,7 +1567,7 @@ def switch_plugin(new_plugin):
             _d.current_plugin['p'].stop(wait=False)
         else:
             _d.current_plugin['p'].hide()
-    p = new_plugin['p']
+    p = load_plugin(new_plugin)
     p._previous_plugin = _d.current_plugin
     p.key_event = None
     p.key_code = None
@@ -957,11 +1578,68 @@ def switch_plugin(new_plugin):
         _d.current_plugin = new_plugin
 
 
+def open_channel(sock, protocol, ring=True):
+    '''
+    Start channel to connected agent and say hello
+
+    Args:
+        ring: request shared memory ring, if enabled in config
+
+    Returns:
+        tuple (channel, hello response)
+    '''
+    channel = Channel(sock,
+                      protocol,
+                      timeout=socket_timeout,
+                      batch_window=float(config.get('batch-window', 0)) or
+                      None)
+    channel.start()
+    hello = packers.supported_codecs()
+    if config.get('gil-budget'):
+        hello['gil'] = float(config['gil-budget']) / 1000
+    if config.get('serialize'):
+        hello['limits'] = config['serialize']
+    z = config.get('compression')
+    if z and z.get('method') and z['method'] != 'none':
+        hello['z'] = {
+            'method': z['method'],
+            'level': z.get('level'),
+            'threshold': int(z.get('threshold', 65536))
+        }
+        # accept compressed frames as soon as server enables compression
+        channel.framer.decompression = z['method']
+    ring_size = int(config.get('shm', {}).get('size', 0))
+    if ring and ring_size and shm.available():
+        hello['shm'] = {'size': ring_size}
+    if _d.detach:
+        d = config.get('detach', {})
+        hello['detach'] = {
+            'timeout': float(d.get('timeout', 3600)),
+            'gil': float(d.get('gil-budget', 1)) / 1000
+        }
+    result = channel.command('.hello', hello)
+    if result.get('resident'):
+        log('agent is resident')
+    if result.get('shm'):
+        channel.attach_ring(result['shm'])
+        log('shm ring: {}'.format(result['shm']))
+    log('codecs: {}'.format(
+        [packers.codec_names.get(c, c) for c in result['codecs']]))
+    if result.get('z'):
+        channel.framer.set_compression(result['z'], hello['z']['level'],
+                                       hello['z']['threshold'])
+        log('compression: {}'.format(result['z']))
+    elif 'z' in hello:
+        log('compression {} is not supported by process'.format(
+            hello['z']['method']))
+    return channel, result
+
+
 def run():
 
     def autostart_plugins():
         for plugin in plugins_autostart:
-            if plugin['p'] is not _d.current_plugin.get('p'):
+            if 'p' in plugin and plugin is not _d.current_plugin:
                 log('autostarting {}'.format(plugin['m']))
                 inject_plugin(plugin)
                 p = plugin['p']
@@ -983,55 +1661,31 @@ def run():
 
         _d.process = p
 
-        client.settimeout(socket_timeout)
-        client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, socket_buf)
-        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_buf)
-        if _d.need_inject_server:
-            inject_server(_d.gdb, p)
-            log('server injected')
-        sock_path = '/tmp/.pptop.{}'.format(os.getpid())
-        for i in range(injection_timeout * 10):
-            if os.path.exists(sock_path):
-                break
-            time.sleep(0.1)
-        try:
-            client.connect(sock_path)
-        except:
-            log_traceback()
-            raise RuntimeError('Unable to connect to process')
+        sock = _d.resident or connect_resident(p.pid)
+        if sock:
+            _d.resident = sock
+            log('reattached to resident agent')
+        else:
+            sock = client
+            if _d.need_inject_server:
+                attach.inject_server(p.pid, _d.gdb, _d.inject_method,
+                                     _d.inject_lib, _d.protocol)
+                log('server injected')
+            attach.connect(sock)
 
         log('connected')
 
-        frame = b''
-        with client_lock:
-            time_start = time.time()
-            while len(frame) < 1:
-                data = client.recv(1)
-                if data:
-                    frame += data
-                    if time.time() > time_start + socket_timeout:
-                        raise CriticalException('Socket timeout')
-
-        server_protocol = struct.unpack('b', frame)[0]
-
-        if server_protocol < _d.protocol:
-            if _d.force_protocol:
-                raise RuntimeError(
-                    'Process doesn\'t support protocol {}'.format(_d.protocol))
-            else:
-                _d.protocol = server_protocol
-                log('Falling back to protocol {}'.format(_d.protocol))
+        _d.protocol = attach.handshake(sock, _d.protocol,
+                                       _d.force_protocol is not None)
+
+        _d.channel, result = open_channel(sock, _d.protocol)
+        _d.codecs = result['codecs']
+        _d.agent_code = set(result.get('code', ()))
+        _d.compression = result.get('z')
 
-        if _d.exec_code:
+        if _d.bench_codecs:
             end_curses()
-            result = command('.x', _d.exec_code)
-            if result[0] == 0:
-                if _d.output_as_json:
-                    print_json(result[1])
-                else:
-                    print(result[1] if result[1] else '')
-            else:
-                print(err('{}: {}'.format(result[1], result[2])))
+            bench_codecs()
             return
 
         init_curses(initial=True,
@@ -1043,14 +1697,34 @@ def run():
 
         calc_bw.start()
         update_status.start()
-        if _d.grab_stdout:
-            grab_stdout.start()
+
+        gv = config.get('governor', {})
+        if _d.overhead_budget is not None:
+            gv['budget'] = _d.overhead_budget
+        if gv.get('budget'):
+            _d.governor = SimpleNamespace(
+                budget=float(gv['budget']),
+                # max-stretch is rounded down to power of 2
+                stretch_levels=max(int(gv.get('max-stretch', 8)),
+                                   1).bit_length() - 1,
+                period=max(int(gv.get('period', 2)), 1),
+                hold_periods=int(gv.get('hold', 3)),
+                level=0,
+                factor=1,
+                reason=None,
+                load=0,
+                prev=None,
+                hold=0,
+                intervals={},
+                paused=set(),
+                unsubscribed=set(),
+                profiler_off=False)
 
         _d.process_path.clear()
         plugin_process_path.clear()
         if _d.grab_stdout:
             try:
-                command('.gs')
+                subscribe('.gs', push_stdout)
             except:
                 raise RuntimeError('Unable to set stdout grabber')
         ppath = []
@@ -1059,11 +1733,23 @@ def run():
         _d.process_path.extend(sorted(ppath, reverse=True))
         plugin_process_path.extend(_d.process_path)
         log('process path: {}'.format(_d.process_path))
+        # default and autostart plugins are injected with a single frame
+        startup = []
+        load_plugins(plugins_autostart)
+        for plugin in [_d.default_plugin] + plugins_autostart:
+            if plugin.get('p') and plugin['p'].injected is False and plugin not in startup:
+                plugin['p'].injected = True
+                startup.append(plugin)
+        inject_plugins(startup)
         switch_plugin(_d.default_plugin)
         recalc_info_col_pos()
         show_process_info.start(p=p)
         show_bottom_bar.start()
         neotasker.spawn(autostart_plugins)
+        if _d.governor:
+            overhead_governor.start()
+        if _d.group:
+            update_group.start()
         log('main loop started')
         while True:
             try:
@@ -1078,7 +1764,15 @@ def run():
                 if show_process_info.is_stopped():
                     return
                 elif k in plugin_shortcuts:
-                    switch_plugin(plugin_shortcuts[k])
+                    try:
+                        switch_plugin(plugin_shortcuts[k])
+                    except:
+                        log_traceback()
+                        print_message('Unable to load plugin',
+                                      color=palette.ERROR)
+                elif event == 'group-next':
+                    if _d.group:
+                        group_focus_next()
                 elif event == 'ready':
                     try:
                         result = command('.ready')
@@ -1091,10 +1785,7 @@ def run():
                             print_message('Command failed', color=palette.ERROR)
                 elif event == 'reinject' and \
                         _d.current_plugin['p'].injected is not None:
-                    try:
-                        result = command('.inject', _d.current_plugin['i'])
-                    except:
-                        result = None
+                    result = inject_plugins([_d.current_plugin])[0]
                     with scr.lock:
                         if result:
                             print_message('Plugin re-injected',
@@ -1120,11 +1811,17 @@ def run():
                         end_curses()
                         hide_cursor()
                         if _d.grab_stdout: print_stdout.start()
+                        if _d.child_output:
+                            # print scrollback, then follow the output
+                            with _d.child_output.lock:
+                                _d.child_output.shown = 0
+                            print_child_output.start()
                         try:
                             wait_key()
                         except KeyboardInterrupt:
                             pass
                         if _d.grab_stdout: print_stdout.stop()
+                        if _d.child_output: print_child_output.stop()
                         init_curses(after_resize=after_resize)
                         resize_term()
                 elif event == 'filter':
@@ -1151,6 +1848,8 @@ def run():
                             pass
                 else:
                     for i, plugin in plugins.items():
+                        if 'p' not in plugin:
+                            continue
                         try:
                             plugin['p'].handle_key_global_event(event, k)
                         except:
@@ -1169,7 +1868,140 @@ def run():
         end_curses()
 
 
-def start():
+def get_injection_sources(mod):
+    '''
+    Get plugin injection sources
+
+    Sources are extracted from plugin module once and cached on disk, until
+    the module file is modified
+
+    Returns:
+        dict l - injection load, i - injection, u - injection unload sources
+    '''
+    fname = getattr(mod, '__file__', None)
+    cache_file = None
+    if fname and _d.pptop_dir:
+        cache_file = '{}/cache/{}.json'.format(_d.pptop_dir, mod.__name__)
+        try:
+            mtime = os.path.getmtime(fname)
+            with open(cache_file) as fh:
+                cached = json.load(fh)
+            if cached['file'] == fname and cached['mtime'] == mtime:
+                return cached['sources']
+        except:
+            pass
+    sources = {}
+    for k, f in (('l', 'injection_load'), ('i', 'injection'),
+                 ('u', 'injection_unload')):
+        try:
+            sources[k] = inspect.getsource(getattr(mod, f))
+        except:
+            pass
+    if cache_file:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # written atomically, as several clients may start at once
+            tmp = '{}.{}'.format(cache_file, os.getpid())
+            with open(tmp, 'w') as fh:
+                json.dump(
+                    {
+                        'file': fname,
+                        'mtime': os.path.getmtime(fname),
+                        'sources': sources
+                    }, fh)
+            os.rename(tmp, cache_file)
+        except:
+            log_traceback()
+    return sources
+
+
+def load_plugin(plugin):
+    '''
+    Import plugin module and create plugin object, if not loaded yet
+
+    Plugins are loaded lazily: when shown first time, autostarted or by
+    background loader (plugins with bottom bar shortcuts)
+
+    Returns:
+        plugin object
+    '''
+    with plugin_load_lock:
+        if 'p' in plugin:
+            return plugin['p']
+        i = plugin['id']
+        v = plugin['v']
+        log('+ plugin ' + i)
+        try:
+            try:
+                mod = importlib.import_module('pptop.plugins.' + i)
+                mod.__version__ = 'built-in'
+            except ModuleNotFoundError:
+                mod = importlib.import_module('pptopcontrib.' + i)
+                try:
+                    mod.__version__
+                except:
+                    raise RuntimeError(
+                        'Please specify __version__ in plugin file')
+            plugin['m'] = mod
+            p = mod.Plugin(interval=float(
+                v.get('interval', mod.Plugin.default_interval)))
+            p.command = command
+            p.subscribe = subscribe
+            p.get_plugins = get_plugins
+            p.get_plugin = get_plugin
+            p.command_group = command_group
+            p.is_group_aggregate = is_group_aggregate
+            p.get_config_dir = get_config_dir
+            p.switch_plugin = switch_plugin
+            p.get_process = get_process
+            p.get_process_path = get_process_path
+            p.global_config = config
+            p._inject = partial(inject_plugin, plugin=plugin)
+            injection = get_injection_sources(mod)
+            injection['id'] = i
+            if len(injection) > 1:
+                p.injected = False
+                plugin['i'] = injection
+            else:
+                p.injected = None
+            p_cfg = v.get('config')
+            p.config = {} if p_cfg is None else p_cfg
+            p.on_load()
+            p._on_load()
+            if 'l' in injection:
+                injection['lkw'] = p.get_injection_load_params()
+            injection['h'] = {
+                k: source_hash(injection[k])
+                for k in ('l', 'i', 'u')
+                if k in injection
+            }
+            sh = plugin['shortcut']
+            if sh.startswith('KEY_F('):
+                try:
+                    f = int(sh[6:-1])
+                    if f <= 10:
+                        bottom_bar_help[f] = p.short_name
+                except:
+                    pass
+            if 'filter' in v:
+                p.filter = str(v['filter'])
+            if 'cursor' in v:
+                p._cursor_enabled_by_user = val_to_boolean(v['cursor'])
+        except Exception as e:
+            raise RuntimeError('plugin {}: {}'.format(i, e))
+        plugin['p'] = p
+        return p
+
+
+def load_plugins(plugin_list):
+    for plugin in plugin_list:
+        try:
+            load_plugin(plugin)
+        except:
+            log_traceback()
+
+
+def start(a=None):
 
     def format_plugin_option(dct, o, v):
         if o.find('.') != -1:
@@ -1179,146 +2011,29 @@ def start():
         else:
             dct[o] = v
 
-    _me = 'ppTOP version %s' % __version__
-
-    ap = argparse.ArgumentParser(description=_me)
-    ap.add_argument('-V',
-                    '--version',
-                    help='Print version and exit',
-                    action='store_true')
-    ap.add_argument('-R',
-                    '--raw',
-                    help='Raw mode (disable colors and unicode glyphs)',
-                    action='store_true')
-    ap.add_argument('--disable-glyphs',
-                    help='disable unicode glyphs',
-                    action='store_true')
-    ap.add_argument('file',
-                    nargs='?',
-                    help='File, PID file or PID',
-                    metavar='FILE/PID')
-    ap.add_argument('-a', '--args', metavar='ARGS', help='Child args (quoted)')
-    ap.add_argument('--python',
-                    metavar='FILE',
-                    help='Python interpreter to launch file')
-    ap.add_argument('--gdb', metavar='FILE', help='Path to gdb')
-    ap.add_argument('-p',
-                    '--protocol',
-                    metavar='VER',
-                    type=int,
-                    help=textwrap.dedent('''Pickle protocol, default is highest.
-                4: Python 3.4+,
-                3: Python 3.0+,
-                2: Python 2.3+,
-                1: vintage'''))
-    ap.add_argument('--inject-method',
-                    choices=['auto', 'native', 'loadcffi', 'unsafe'],
-                    help='Inject method')
-    ap.add_argument('-g',
-                    '--grab-stdout',
-                    help='Grab stdout/stderr of injected process',
-                    action='store_true')
-    ap.add_argument(
-        '-w',
-        '--wait',
-        metavar='SEC',
-        type=float,
-        help='If file is specified, wait seconds to start main code')
-    ap.add_argument(
-        '-f',
-        '--config-file',
-        help='Alternative config file (default: ~/.pptop/pptop.yml)',
-        metavar='CONFIG',
-        dest='config')
-    ap.add_argument('-d',
-                    '--default',
-                    help='Default plugin to launch',
-                    metavar='PLUGIN',
-                    dest='plugin')
-    ap.add_argument(
-        '-o',
-        '--plugin-option',
-        help='Override plugin config option, e.g. threads.filter=mythread',
-        metavar='NAME=VALUE',
-        action='append',
-        dest='plugin_options')
-    ap.add_argument('--log', metavar='FILE', help='Send debug log to file')
-    ap.add_argument(
-        '-x',
-        '--exec',
-        help='Exec code from a file ("-" for stdin) and exit '
-            ' (the code can put result to "out" var)',
-        metavar='FILE',
-        dest='_exec')
-    ap.add_argument('-J',
-                    '--json',
-                    help='Output exec result as JSON',
-                    action='store_true')
-
-    try:
-        import argcomplete
-        argcomplete.autocomplete(ap)
-    except:
-        pass
-
-    a = ap.parse_args()
+    if a is None:
+        a = cli.parse_args()
 
     if a.log:
-        log_config.fname = a.log
-        log_config.name = 'client:{}'.format(os.getpid())
+        # log file is set by cli.main, debug event loops as well
+        logging.getLogger().setLevel(logging.DEBUG)
         logging.getLogger('asyncio').setLevel(logging.DEBUG)
         logging.getLogger('neotasker').setLevel(logging.DEBUG)
-        logging.basicConfig(level=logging.DEBUG)
-        le = logging.getLogger()
-        le.addHandler(ppLoghandler())
-        list(map(le.removeHandler, le.handlers))
         neotasker.set_debug(True)
-        init_logging()
-
-    if a.version:
-        print(_me)
-        exit()
 
     log('initializing')
 
     if a.file:
-        try:
-            # pid?
-            _d.work_pid = int(a.file)
-        except:
-            # probably pid file
-            try:
-                with open(a.file) as fh:
-                    _d.work_pid = int(fh.read(128))
-            except:
-                # okay, program to launch
-                _d.child_cmd = os.path.abspath(a.file)
+        _d.work_pid = cli.get_pid(a.file)
+        if not _d.work_pid:
+            # okay, program to launch
+            _d.child_cmd = os.path.abspath(a.file)
 
-    _d.pptop_dir = os.path.expanduser('~/.pptop')
-
-    if a.config:
-        config_file = a.config
-        use_default_config = False
-    else:
-        config_file = _d.pptop_dir + '/pptop.yml'
-        use_default_config = True
+    _d.pptop_dir = cli.get_pptop_dir()
 
     sys.path.append(_d.pptop_dir + '/lib')
     config.clear()
-    if use_default_config and not os.path.isfile(config_file):
-        log('no user config, setting default')
-        try:
-            os.mkdir(_d.pptop_dir)
-        except:
-            pass
-        if not os.path.isdir(_d.pptop_dir + '/scripts'):
-            shutil.copytree(dir_me + '/config/scripts',
-                            _d.pptop_dir + '/scripts')
-        shutil.copy(dir_me + '/config/pptop.yml', _d.pptop_dir + '/pptop.yml')
-        if not os.path.isdir(_d.pptop_dir + '/lib'):
-            os.mkdir(_d.pptop_dir + '/lib')
-    with open(config_file) as fh:
-        config.update(yaml.safe_load(fh.read()))
+    config.update(cli.load_config(a))
 
     console = config.get('console')
     if console is None: console = {}
@@ -1328,211 +2043,121 @@ def start():
     _d.inject_method = a.inject_method if a.inject_method else config.get(
         'inject-method')
 
-    if config.get('display') is None:
-        config['display'] = {}
-
-    if a.raw:
-        config['display']['colors'] = False
-
     if a.grab_stdout:
         _d.grab_stdout = True
 
-    if a.raw or a.disable_glyphs:
-        config['display']['glyphs'] = False
-
-    if a._exec:
-        if a._exec == '-':
-            _d.exec_code = sys.stdin.read()
-        else:
-            with open(a._exec) as fd:
-                _d.exec_code = fd.read()
+    if a.bench_codecs:
+        _d.bench_codecs = True
         _d.output_as_json = a.json
 
-    else:
-        ebk = {}
-        global_keys = config.get('keys')
-        if global_keys:
-            for event, keys in global_keys.items():
-                for k, v in events_by_key.copy().items():
-                    if event == v:
-                        del events_by_key[k]
-                if keys is not None:
-                    for k in keys if isinstance(keys, list) else [keys]:
-                        ebk[str(k)] = str(event)
-
-        events_by_key.update(ebk)
-        plugin_options = {}
-
-        for x in a.plugin_options or []:
-            try:
-                o, v = x.split('=', 1)
-            except:
-                o = x
-                v = None
-            format_plugin_option(plugin_options, o, v)
-
-        if plugin_options:
-            config.update(merge_dict(config, {'plugins': plugin_options}))
-
-        log('loading plugins')
-
+    if a.detach:
+        _d.detach = True
+
+    if a.group:
+        g = config.get('group', {})
+        _d.group = SimpleNamespace(members=OrderedDict(),
+                                   focus=None,
+                                   failed=set(),
+                                   rescan=float(g.get('rescan', 5)),
+                                   lock=threading.Lock())
+
+    if a.budget is not None:
+        _d.overhead_budget = a.budget
+
+    ebk = {}
+    global_keys = config.get('keys')
+    if global_keys:
+        for event, keys in global_keys.items():
+            for k, v in events_by_key.copy().items():
+                if event == v:
+                    del events_by_key[k]
+            if keys is not None:
+                for k in keys if isinstance(keys, list) else [keys]:
+                    ebk[str(k)] = str(event)
+
+    events_by_key.update(ebk)
+    plugin_options = {}
+
+    for x in a.plugin_options or []:
         try:
-            plugins.clear()
-            for i, v in config.get('plugins', {}).items():
-                try:
-                    log('+ plugin ' + i)
-                    if v is None: v = {}
-                    try:
-                        mod = importlib.import_module('pptop.plugins.' + i)
-                        mod.__version__ = 'built-in'
-                    except ModuleNotFoundError:
-                        mod = importlib.import_module('pptopcontrib.' + i)
-                        try:
-                            mod.__version__
-                        except:
-                            raise RuntimeError(
-                                'Please specify __version__ in plugin file')
-                    plugin = {'m': mod}
-                    plugins[i] = plugin
-                    p = mod.Plugin(interval=float(
-                        v.get('interval', mod.Plugin.default_interval)))
-                    p.command = command
-                    p.get_plugins = get_plugins
-                    p.get_plugin = get_plugin
-                    p.get_config_dir = get_config_dir
-                    p.switch_plugin = switch_plugin
-                    p.get_process = get_process
-                    p.get_process_path = get_process_path
-                    p.global_config = config
-                    plugin['p'] = p
-                    plugin['id'] = i
-                    p._inject = partial(inject_plugin, plugin=plugin)
-                    injection = {'id': i}
-                    need_inject = False
-                    try:
-                        injection['l'] = inspect.getsource(mod.injection_load)
-                        need_inject = True
-                    except:
-                        pass
-                    try:
-                        injection['i'] = inspect.getsource(mod.injection)
-                        need_inject = True
-                    except:
-                        pass
-                    try:
-                        injection['u'] = inspect.getsource(mod.injection_unload)
-                        need_inject = True
-                    except:
-                        pass
-                    if need_inject:
-                        p.injected = False
-                        plugin['i'] = injection
-                    else:
-                        p.injected = None
-                    if not _d.default_plugin or val_to_boolean(
-                            v.get('default')) or i == a.plugin:
-                        _d.default_plugin = plugin
-                    p_cfg = v.get('config')
-                    p.config = {} if p_cfg is None else p_cfg
-                    p.on_load()
-                    p._on_load()
-                    if 'l' in injection:
-                        injection['lkw'] = p.get_injection_load_params()
-                    if 'shortcut' in v:
-                        sh = v['shortcut']
-                        plugin['shortcut'] = sh
-                        plugin_shortcuts[sh] = plugin
-                        if sh.startswith('KEY_F('):
-                            try:
-                                f = int(sh[6:-1])
-                                if f <= 10:
-                                    bottom_bar_help[f] = p.short_name
-                            except:
-                                pass
-                    else:
-                        plugin['shortcut'] = ''
-                    if 'filter' in v:
-                        p.filter = str(v['filter'])
-                    if 'cursor' in v:
-                        p._cursor_enabled_by_user = val_to_boolean(v['cursor'])
-                    if val_to_boolean(v.get('autostart')):
-                        plugins_autostart.append(plugin)
-                except Exception as e:
-                    raise RuntimeError('plugin {}: {}'.format(i, e))
+            o, v = x.split('=', 1)
         except:
-            log_traceback()
-            raise
+            o = x
+            v = None
+        format_plugin_option(plugin_options, o, v)
+
+    if plugin_options:
+        config.update(merge_dict(config, {'plugins': plugin_options}))
+
+    log('registering plugins')
+
+    plugins.clear()
+    for i, v in config.get('plugins', {}).items():
+        if v is None: v = {}
+        plugin = {'id': i, 'v': v, 'shortcut': v.get('shortcut', '')}
+        plugins[i] = plugin
+        if plugin['shortcut']:
+            plugin_shortcuts[plugin['shortcut']] = plugin
+        if not _d.default_plugin or val_to_boolean(
+                v.get('default')) or i == a.plugin:
+            _d.default_plugin = plugin
+        if val_to_boolean(v.get('autostart')):
+            plugins_autostart.append(plugin)
+    if _d.default_plugin:
+        load_plugin(_d.default_plugin)
     neotasker.task_supervisor.start()
     neotasker.task_supervisor.create_aloop('pptop', default=True, daemon=True)
     neotasker.task_supervisor.create_aloop('service', daemon=True)
     try:
+        if _d.work_pid:
+            _d.resident = connect_resident(_d.work_pid)
         if a.file and not _d.work_pid:
             # launch file
             _d.need_inject_server = False
-            if a.python:
-                python_path = a.python
-            else:
-                python_path = shutil.which('python3')
-                if not python_path:
-                    raise RuntimeError(
-                        'python3 not found in path, please specify manually')
-            args = (python_path, '-m', 'pptop.injection', a.file,
-                    str(os.getpid()))
-            if a.wait is not None:
-                args += ('-w', str(a.wait))
-            if a.protocol is not None:
-                args += ('-p', str(a.protocol))
-            if a.args:
-                args += ('-a', a.args)
-            if log_config.fname:
-                args += ('--log', log_config.fname)
-            log('starting child process')
-            _d.child = subprocess.Popen(args,
-                                        shell=False,
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
+            _d.child = attach.launch(_d.child_cmd,
+                                     python=a.python,
+                                     args=a.args,
+                                     wait=a.wait,
+                                     protocol=a.protocol)
             _d.work_pid = _d.child.pid
+            init_child_output(_d.child,
+                              config.get('child-output') or {},
+                              fname=a.output_file)
+            _d.protocol = pickle.HIGHEST_PROTOCOL
+        elif _d.resident:
+            # reattach to resident agent, gdb is not required
+            _d.need_inject_server = False
             _d.protocol = pickle.HIGHEST_PROTOCOL
         else:
-            if a.gdb:
-                _d.gdb = a.gdb
-            else:
-                _d.gdb = shutil.which('gdb')
-            if not _d.gdb or not os.path.isfile(_d.gdb):
-                raise RuntimeError('gdb not found')
-            # check yama ptrace scope
-            try:
-                with open('/proc/sys/kernel/yama/ptrace_scope') as fd:
-                    yps = int(fd.read().strip())
-            except:
-                yps = None
-            if yps:
-                raise RuntimeError(
-                    'yama ptrace scope is on. ' +
-                    'disable with "sudo sysctl -w kernel.yama.ptrace_scope=0"')
-            init_inject()
+            _d.protocol = attach.check_protocol(a.protocol)
+            _d.force_protocol = a.protocol
+            log('Pickle protocol: {}'.format(_d.protocol))
+        # group members are attached with gdb as well
+        if _d.need_inject_server or _d.group:
+            _d.gdb = attach.find_gdb(a.gdb)
+            _d.inject_method, _d.inject_lib = attach.init_inject(
+                _d.inject_method)
             log('inject method: {}'.format(_d.inject_method))
             log('inject library: {}'.format(_d.inject_lib))
-            if a.protocol is not None:
-                if a.protocol > pickle.HIGHEST_PROTOCOL or a.protocol < 1:
-                    raise ValueError('Protocol {} is not supported'.format(
-                        a.protocol))
-                _d.protocol = a.protocol
-                _d.force_protocol = a.protocol
-            else:
-                _d.protocol = pickle.HIGHEST_PROTOCOL
-            log('Pickle protocol: {}'.format(_d.protocol))
         run()
         log('terminating')
         for p, v in plugins.items():
-            v['p'].on_unload()
+            if 'p' in v:
+                v['p'].on_unload()
     except Exception as e:
         log_traceback()
         raise
     finally:
         try:
-            client.close()
+            if _d.channel:
+                _d.channel.close()
+            else:
+                client.close()
         except:
             pass
+        if _d.group:
+            for m in _d.group.members.values():
+                m.channel.close()
+        stop_gdb_controller()
         neotasker.task_supervisor.stop(wait=False, cancel_tasks=True)
     return 0
@@ -0,0 +1,210 @@
+'''
+Frame reader/writer, shared by client and injection server
+
+Frame format:
+
+    bytes 1-4 : frame length
+    bytes 5-8 : frame id and flags
+    bytes 9-N : frame
+
+Frame id flags (high bits):
+
+    0x80000000 : frame is compressed with negotiated method
+    0x40000000 : frame is continued, more frames with the same id follow
+
+Frames are received into a preallocated buffer with recv_into, so payload of
+any size is read in linear time without intermediate copies, and sent with
+scatter/gather (sendmsg), so header and payload parts are never concatenated.
+
+The module is loaded into injected process as well, so it must stay
+compatible with Python 2 and use standard library only.
+'''
+
+import socket
+import struct
+import threading
+import time
+
+header = struct.Struct('II')
+
+FLAG_COMPRESSED = 0x80000000
+FLAG_MORE = 0x40000000
+FRAME_ID_MASK = 0x3FFFFFFF
+
+compressors = {}
+
+try:
+    import zlib
+    compressors['zlib'] = (zlib.compress, zlib.decompress)
+except:
+    pass
+
+try:
+    import lzma
+    compressors['lzma'] = (lambda data, level: lzma.compress(data,
+                                                             preset=level),
+                           lzma.decompress)
+except:
+    pass
+
+# initial receive buffer
+default_buf_size = 65536
+# larger buffers are released after the frame is read
+max_keep_buf_size = 16 * 1024 * 1024
+
+# socket SO_SNDBUF/SO_RCVBUF limits
+min_socket_buf = 8192
+max_socket_buf = 4 * 1024 * 1024
+
+try:
+    TimeoutError
+except NameError:
+    TimeoutError = socket.timeout
+
+
+class Framer(object):
+    '''
+    Frame reader/writer for a connected stream socket
+
+    Reading and writing sides have separate state: recv may run in a reader
+    thread concurrently with send. Calls of recv must be serialized by
+    caller, as well as calls of send. tune may be called by both sides.
+    '''
+
+    def __init__(self, sock, timeout=None, buf_size=default_buf_size):
+        self.sock = sock
+        self.timeout = timeout
+        self.buf = bytearray(buf_size)
+        self.socket_buf = 0
+        self._tune_lock = threading.Lock()
+        # reading side
+        self.decompression = None
+        self.octets_received = 0  # on wire, including headers
+        self.octets_received_raw = 0  # decompressed
+        self._header = bytearray(header.size)
+        # writing side
+        self.compression = None
+        self.compression_level = None
+        self.compression_threshold = None
+        self._sendmsg = getattr(sock, 'sendmsg', None)
+        self.tune(min_socket_buf)
+
+    def set_compression(self, method, level=None, threshold=65536):
+        '''
+        Compress frames larger than threshold
+
+        Compressed frames are accepted as soon as decompression method is
+        set, so the receiving side may set it before compression is
+        negotiated
+
+        Args:
+            method: compression method (zlib or lzma), None to disable
+            level: compression level
+            threshold: minimal frame size to compress
+
+        Raises:
+            ValueError: if compression method is not supported
+        '''
+        if method is not None and method not in compressors:
+            raise ValueError(
+                'Compression method {} is not supported'.format(method))
+        self.compression = method
+        self.decompression = method
+        self.compression_level = level if level is not None else (
+            1 if method == 'zlib' else 0)
+        self.compression_threshold = threshold
+
+    def tune(self, size):
+        '''
+        Grow socket buffers to fit frame of the specified size
+
+        Thread-safe, called by both reading and writing sides
+        '''
+        size = min(max(size, min_socket_buf), max_socket_buf)
+        if size <= self.socket_buf:
+            return
+        with self._tune_lock:
+            if size > self.socket_buf:
+                try:
+                    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                         size)
+                    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                         size)
+                    self.socket_buf = size
+                except:
+                    self.socket_buf = max_socket_buf
+
+    def _recv_into(self, view, size, time_end):
+        pos = 0
+        while pos < size:
+            n = self.sock.recv_into(view[pos:], size - pos)
+            if not n:
+                return False
+            pos += n
+            if time_end and pos < size and time.time() > time_end:
+                raise TimeoutError
+        return True
+
+    def recv(self, detach=False):
+        '''
+        Receive frame
+
+        Args:
+            detach: receive frame into a new buffer, owned by caller
+
+        Returns:
+            tuple (frame_id, data) or None if connection is closed. frame_id
+            includes FLAG_MORE, if set. data is memoryview of the internal
+            buffer and is valid until next call, unless detach is requested
+        '''
+        h = self._header
+        if not self._recv_into(memoryview(h), header.size, None):
+            return None
+        l, frame_id = header.unpack(bytes(h))
+        self.octets_received += l + header.size
+        time_end = time.time() + self.timeout if self.timeout else None
+        if l > len(self.buf):
+            self.tune(l)
+            buf = bytearray(l)
+            if l <= max_keep_buf_size and not detach:
+                self.buf = buf
+        elif detach:
+            buf = bytearray(l)
+        else:
+            buf = self.buf
+        view = memoryview(buf)[:l]
+        if not self._recv_into(view, l, time_end):
+            return None
+        if frame_id & FLAG_COMPRESSED:
+            view = memoryview(compressors[self.decompression][1](bytes(view)))
+        self.octets_received_raw += len(view) + header.size
+        return frame_id & (FRAME_ID_MASK | FLAG_MORE), view
+
+    def send(self, frame_id, *chunks):
+        '''
+        Send frame, assembled from chunks (bytes-like objects)
+        '''
+        l = 0
+        for c in chunks:
+            l += len(c)
+        if self.compression and l >= self.compression_threshold:
+            data = compressors[self.compression][0](b''.join(chunks),
+                                                    self.compression_level)
+            if len(data) < l:
+                chunks = (data,)
+                l = len(data)
+                frame_id |= FLAG_COMPRESSED
+        if l > self.socket_buf:
+            self.tune(l)
+        h = header.pack(l, frame_id)
+        if self._sendmsg is None:
+            self.sock.sendall(h + b''.join(chunks))
+            return
+        bufs = [h] + [c for c in chunks if len(c)]
+        while bufs:
+            sent = self._sendmsg(bufs)
+            while bufs and sent >= len(bufs[0]):
+                sent -= len(bufs[0])
+                bufs.pop(0)
+            if sent:
+                bufs[0] = memoryview(bufs[0])[sent:]
@@ -0,0 +1,220 @@
+'''
+Persistent gdb/MI controller
+
+gdb is started once (with auto-load and shared library symbols reading
+disabled) and talks to client via machine interface. The controller attaches
+to and detaches from targets on demand, so re-injections and injections into
+several processes don't spawn new gdb and don't read symbols of the whole
+process: only symbols of the libraries, required for the call, are loaded.
+If a symbol is still not found, symbols of all libraries are loaded and the
+call is retried.
+
+Time of every phase is recorded and returned by the controller methods.
+'''
+
+import os
+import select
+import subprocess
+import time
+
+from pptop.logger import log
+
+# gdb commands, executed before anything else is loaded
+init_commands = ('set auto-load off', 'set auto-solib-add off',
+                 'set debuginfod enabled off', 'set pagination off',
+                 'set confirm off', 'set print thread-events off',
+                 'set print inferior-events off')
+
+# shared libraries with dlopen
+dl_libs = r'lib(c|dl)[-.]'
+
+default_timeout = 30
+
+
+def mi_quote(s):
+    '''
+    Quote gdb/MI command argument
+    '''
+    return '"{}"'.format(s.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def mi_unquote(s):
+    '''
+    Unquote gdb/MI c-string
+    '''
+    if not s.startswith('"'):
+        return s
+    s = s[1:-1] if s.endswith('"') else s[1:]
+    return s.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+
+
+class GDB(object):
+    '''
+    gdb/MI controller
+
+    Args:
+        path: path to gdb
+        timeout: default command timeout (seconds)
+    '''
+
+    def __init__(self, path, timeout=default_timeout):
+        self.path = path
+        self.timeout = timeout
+        self.token = 0
+        self.pid = None
+        self.buf = b''
+        t = time.time()
+        args = [path, '--quiet', '--interpreter=mi2']
+        for c in init_commands:
+            args += ['-iex', c]
+        log(args)
+        self.process = subprocess.Popen(args,
+                                        shell=False,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        try:
+            # wait for the first prompt
+            self._read_until(lambda line: line.startswith('(gdb)'))
+        except:
+            self.close()
+            raise
+        self.spawn_time = time.time() - t
+        log('gdb/MI controller started in {:.3f} sec'.format(self.spawn_time))
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def _readline(self, deadline):
+        while True:
+            pos = self.buf.find(b'\n')
+            if pos != -1:
+                line = self.buf[:pos]
+                self.buf = self.buf[pos + 1:]
+                return line.decode('utf-8', 'replace').rstrip('\r')
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise TimeoutError('gdb timed out')
+            fd = self.process.stdout.fileno()
+            if select.select([fd], [], [], timeout)[0]:
+                data = os.read(fd, 65536)
+                if not data:
+                    raise RuntimeError('gdb terminated')
+                self.buf += data
+
+    def _read_until(self, cond, timeout=None):
+        deadline = time.time() + (timeout or self.timeout)
+        output = []
+        while True:
+            line = self._readline(deadline)
+            if cond(line):
+                return line, output
+            if line[:1] in ('~', '&'):
+                output.append(mi_unquote(line[1:]))
+
+    def command(self, cmd, timeout=None):
+        '''
+        Execute MI command
+
+        Returns:
+            tuple (result record, console output)
+
+        Raises:
+            RuntimeError if command failed
+        '''
+        self.token += 1
+        token = str(self.token)
+        self.process.stdin.write('{}{}\n'.format(token, cmd).encode())
+        self.process.stdin.flush()
+        result, output = self._read_until(
+            lambda line: line.startswith(token + '^'), timeout)
+        result = result[len(token) + 1:]
+        if result.startswith('error'):
+            msg = result.split('msg=', 1)[-1].split(',code=', 1)[0]
+            raise RuntimeError(mi_unquote(msg))
+        return result, output
+
+    def console(self, cmd, timeout=None):
+        '''
+        Execute gdb CLI command
+        '''
+        return self.command('-interpreter-exec console ' + mi_quote(cmd),
+                            timeout)
+
+    def attach(self, pid):
+        '''
+        Attach to process, the process is stopped until detached
+
+        Returns:
+            attach time
+        '''
+        t = time.time()
+        self.command('-target-attach {}'.format(pid))
+        self.pid = pid
+        return time.time() - t
+
+    def detach(self):
+        '''
+        Detach from the current process
+
+        Returns:
+            detach time
+        '''
+        t = time.time()
+        try:
+            self.command('-target-detach')
+        finally:
+            self.pid = None
+        return time.time() - t
+
+    def load_symbols(self, regex=None):
+        '''
+        Load symbols of shared libraries, matching regex (all if not
+        specified)
+        '''
+        self.console('sharedlibrary {}'.format(regex) if regex else
+                     'sharedlibrary')
+
+    def call(self, cmd, libs=None):
+        '''
+        Execute call command in the attached process
+
+        Args:
+            cmd: gdb command
+            libs: regex of shared libraries, which symbols are required
+
+        Returns:
+            call time
+        '''
+        t = time.time()
+        if libs:
+            self.load_symbols(libs)
+        try:
+            self.console(cmd)
+        except RuntimeError as e:
+            if 'No symbol' not in str(e) and 'unknown return type' not in str(
+                    e):
+                raise
+            log('{}, loading all symbols'.format(e))
+            self.load_symbols()
+            self.console(cmd)
+        return time.time() - t
+
+    def close(self):
+        try:
+            if self.pid is not None:
+                self.detach()
+        except:
+            pass
+        try:
+            self.process.stdin.close()
+        except:
+            pass
+        try:
+            self.process.terminate()
+            self.process.wait(timeout=1)
+        except:
+            try:
+                self.process.kill()
+            except:
+                pass
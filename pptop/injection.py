@@ -3,11 +3,17 @@ Client-server communication
 
 After injection, client asks server to create socket /tmp/.pptop_<Client-PID>
 
-Server accepts only one connection to socket. After connection, server sends to
-client pickle protocol version (lower or equal to requested at start) as a
-single byte.
+Server accepts several concurrent connections to socket. After connection,
+server sends to client pickle protocol version (lower or equal to requested at
+start) as a single byte.
 
-Then client and server exchange data via simple binary/text protocol:
+Injections are shared by all clients: a plugin, injected by one client, is
+reused by others and unloaded when the last client, which injected it, is
+gone. Stdout/stderr grab buffers, streams, delta caches and exec globals are
+per-client.
+
+Then client and server exchange data via simple binary/text protocol. The
+first client command is usually .hello, which negotiates payload codecs.
 
 Client request:
 
@@ -18,7 +24,7 @@ Client request:
 Server response:
 
     bytes 1-4 : frame length
-    bytes 5-8 : server frame id
+    bytes 5-8 : client frame id (of the request)
     bytes 9-N : frame
 
     First frame byte: command status:
@@ -27,24 +33,87 @@ Server response:
         0x01 - Command not found
         0x02 - Command failed
 
-    Frame bytes 2-N: pickled response
+    Frame bytes 2-N: encoded response (see pptop.packers), followed by 24-byte
+    trailer:
+
+        bytes 1-4   : time the command was queued (microseconds)
+        bytes 5-8   : command execution time (microseconds)
+        bytes 9-12  : response serialization time (microseconds)
+        bytes 13-16 : response payload size (bytes, before compression)
+        bytes 17-20 : runner status (signed, -1 - waiting, 0 - finished,
+                      1 - running, -2 - error; always 1 if agent is injected)
+        bytes 21-24 : stdout/stderr bytes, grabbed, but not collected by
+                      client yet
+
+If plugin injection function is a generator, which yields batches (lists) of
+rows, batches are sent as soon as they're yielded: every batch except the last
+one is sent in a continuation frame (frame id has 0x40000000 flag set), the
+last batch is sent in the final frame. Client concatenates the batches.
+
+Commands .test, .status, .gs, .path, .le, .ready and .hello are executed
+immediately by connection thread. Other commands are put to queue and executed
+by worker pool, so responses may be sent in order different from requests.
+Commands for the same plugin are never executed in parallel.
+
+Server push frames (frame id 0) are sent for subscribed streams, frame bytes
+2-N contain encoded tuple (stream id, list of items, number of items dropped
+since the previous push), the first field of the trailer contains time the
+oldest item was waiting in stream buffer.
+
+.batch response frame bytes 2-N (before trailer):
+
+    bytes 1-4 : number of items
+
+    Then for each item:
+
+        byte 1      : command status
+        bytes 2-5   : response length
+        bytes 6-9   : command execution time (microseconds)
+        bytes 10-13 : response serialization time (microseconds)
+        bytes 14-N  : encoded response
 
 Commands:
 
     .test            Test server
     .status          Get process status
     .path            Get sys.path
-    .inject          Inject a plugin
+    .hello           Negotiate codecs, compression and shared memory ring,
+                     set collect budget and serialize limits of the client
+    .bench           Benchmark codecs on plugin responses
+    .inject          Inject a plugin (sources, known by agent, can be
+                     replaced with their hashes)
     .le              Get last exception
     .x               Exec code
     .exec            Exec command
     .gs              Grab stdout
+    .obj             Browse object with opaque handles: open (evaluate
+                     expression), len, keys, slice, attr, attrs, dir, release
+                     (handle, list of handles or all)
+    .gil             Get the longest GIL hold by collectors since the
+                     previous call and overall (ms), collect budget of the
+                     client and number of agent threads
+    .overhead        Get agent self-overhead per command / plugin (calls,
+                     wall, thread CPU and serialization time, payload bytes)
+                     and process CPU time
+    .batch           Execute list of (cmd, params) pairs, returns results of
+                     all commands in a single frame
+    .delta           Command for plugin, delta-encoded response
+    .subscribe       Subscribe to plugin (or .gs) stream, items are pushed as
+                     soon as batch size or latency threshold is reached
+    .unsubscribe     Unsubscribe from stream
     <plugin_id>      Command for plugin
-    .bye             End communcation
+    .bye             End communcation, "stop" param stops resident agent
 
 If client closes connection, connection is timed out (default: 10 sec) or
-server receives "bye" command, it immediately terminate itself and loaded
-plugins.
+server receives "bye" command, plugins it holds are released. When the last
+client is gone, server terminates itself.
+
+If client asks agent to detach (.hello "detach" param), the agent becomes
+resident: its socket is moved to /tmp/.pptop.agent.<PID>, plugins of gone
+clients are kept and keep collecting data (with "gil" collect budget), so the
+next client reattaches with no injection. Resident agent terminates itself
+after "timeout" seconds with no clients (0 - never), when stopped (.bye with
+"stop" param) or when the last client, which hasn't asked to detach, is gone.
 '''
 
 __injection_version__ = '0.6.15'
@@ -55,6 +124,11 @@ import socket
 import sys
 import os
 import time
+import types
+import hashlib
+
+from collections import deque, OrderedDict
+from itertools import islice
 
 # try all variations on older versions
 try:
@@ -69,14 +143,104 @@ except:
         import pickle
         PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from pptop.logger import config as log_config, log, log_traceback
+from pptop.framing import Framer, FLAG_MORE
+from pptop import packers
+from pptop import shm
 
 socket_timeout = 10
 
-socket_buf = 8192
+# heavy commands (plugin injections, code execution) are executed by workers
+max_workers = 2
+
+# max concurrent clients
+max_clients = 8
+
+# agent threads per client: connection thread, workers, pusher
+client_threads = max_workers + 2
+
+# prefix of agent thread names
+thread_prefix = '__pptop'
+
+# if all clients are gone, agent is finished in (seconds)
+accept_interval = 1
+
+# socket of resident (detached) agent, clients reattach to it with no
+# injection
+resident_address = '/tmp/.pptop.agent.{}'
+
+# client id, which holds injections, kept by resident agent, ids of clients
+# start from 1
+resident_client_id = 0
+
+# commands, executed directly by connection thread, never queued
+fast_commands = ('.test', '.status', '.gs', '.path', '.le', '.ready',
+                 '.hello', '.subscribe', '.unsubscribe', '.gil', '.overhead')
+
+# thread CPU time (Python 3.7+), on older versions overhead CPU time is not
+# accounted
+thread_time = getattr(time, 'thread_time', None)
+
+RESPONSE_OK = b'\x00'
+RESPONSE_NOT_FOUND = b'\x01'
+RESPONSE_FAILED = b'\x02'
+
+# response trailer: queue time, exec time, serialize time (microseconds),
+# payload size, runner status, stdout/stderr bytes pending for client
+response_meta = struct.Struct('IIIIiI')
+
+# .batch response: number of items, then for each: status, payload length,
+# exec time, serialize time (microseconds)
+batch_header = struct.Struct('I')
+batch_item = struct.Struct('cIII')
+
+# frame id of server push frames
+push_frame_id = 0
+
+# default safe_serialize limits: max items per container, max nesting, max
+# string length, approximate max result size (bytes), clients may override
+# them for own requests
+serialize_limits = {'items': 100, 'depth': 5, 'str': 1000, 'size': 65536}
+
+# max object handles per client, least recently used are released. Handles
+# hold strong references, so objects can't be garbage-collected until their
+# handles are released
+max_handles = 500
+
+# max preview length of objects, browsed with handles
+handle_preview = 100
+
+# default page size of object browser
+handle_page = 100
+
+# default max time collectors may hold GIL without a pause (seconds), clients
+# may override it for own requests
+collect_budget = 0.005
+
+# default stream params: max items per push, max push latency (seconds), max
+# items buffered (older are dropped)
+stream_defaults = {'items': 100, 'latency': 0.1, 'buffer': 10000}
 
 # compat. with Python 2
 
+text_type = type(u'')
+
+try:
+    integer_types = (int, long)
+    string_types = (str, unicode)
+except NameError:
+    integer_types = (int,)
+    string_types = (str,)
+
+container_types = (list, tuple, set, frozenset, dict, deque)
+
+scalar_types = integer_types + string_types + (float, complex, bool, bytes)
+
 
 class SimpleNamespace:
 
@@ -87,13 +251,60 @@ class SimpleNamespace:
 # don't use threading.Event to hide presence
 
 g = SimpleNamespace(clients=0,
+                    _runner_mode=False,
                     _runner_status=-1,
                     _runner_ready=False,
                     _server_finished=False,
+                    _resident=None,
+                    _resident_address=None,
+                    _last_client_id=resident_client_id,
                     _last_exception=())
 
 _g_lock = threading.Lock()
 
+_clock = getattr(time, 'perf_counter', time.time)
+
+# the longest collector slices (seconds): overall and since the last .gil of
+# each client (client id - slice)
+_gil = SimpleNamespace(max=0, ticks={})
+
+# per-thread: state of the client, served by the thread
+_client = threading.local()
+
+
+def _client_budget():
+    st = getattr(_client, 'st', None)
+    if st is not None:
+        return st.budget
+    resident = g._resident
+    if resident and resident.get('gil') and not g.clients:
+        # collectors keep working while detached, with lower budget
+        return resident['gil']
+    return collect_budget
+
+
+def _client_limits():
+    st = getattr(_client, 'st', None)
+    return st.limits if st is not None else serialize_limits
+
+
+def agent_threads():
+    '''
+    Number of agent threads
+    '''
+    return len(
+        [t for t in threading.enumerate() if t.name.startswith(thread_prefix)])
+
+
+def _next_client_id():
+    '''
+    Allocate client id, unique for all agents of the process, as injections
+    are shared between them
+    '''
+    with _g_lock:
+        g._last_client_id += 1
+        return g._last_client_id
+
 
 def init_logging(fname):
     log_config.fname = fname
@@ -104,120 +315,1273 @@ def stop_logging():
     log_config.fname = None
 
 
-def safe_serialize(obj):
-    if obj is None or \
-            isinstance(obj, str) or \
-            isinstance(obj, float) or \
-            isinstance(obj, int) or \
-            isinstance(obj, bool):
-        result = obj
-    elif isinstance(obj, list):
-        result = []
-        for o in obj.copy():
-            result.append(safe_serialize(o))
-    elif isinstance(obj, dict):
-        result = {}
-        for o, v in obj.copy().items():
-            result[safe_serialize(o)] = safe_serialize(v)
-    else:
-        result = str(obj)
+def collect(items, func, budget=None):
+    '''
+    Collect data in slices, releasing GIL between them
+
+    Injections should use it for long loops, so target threads are not
+    blocked for longer than the budget
+
+    Args:
+        items: iterable to process
+        func: function(item), returned value is appended to the result, unless
+            it's None
+        budget: max slice duration (seconds), default: budget of the client,
+            served by the current thread
+
+    Returns:
+        list of results
+    '''
+    if budget is None:
+        budget = _client_budget()
+    result = []
+    longest = 0
+    t_slice = _clock()
+    for item in items:
+        r = func(item)
+        if r is not None:
+            result.append(r)
+        t = _clock() - t_slice
+        if t >= budget:
+            if t > longest:
+                longest = t
+            # let other threads run
+            time.sleep(0)
+            t_slice = _clock()
+    t = _clock() - t_slice
+    if t > longest:
+        longest = t
+    with _g_lock:
+        # slices pause all target threads, so they're reported to all clients
+        for k, v in _gil.ticks.items():
+            if longest > v:
+                _gil.ticks[k] = longest
+        if longest > _gil.max:
+            _gil.max = longest
     return result
 
 
-def loop(cpid, protocol, runner_mode=False):
+def _truncate_str(s, max_len):
+    if len(s) > max_len:
+        return '{}...({} chars)'.format(s[:max_len], len(s))
+    return s
 
-    class STD:
-        pass
 
-    class ppStdout(object):
+def safe_serialize(obj, max_items=None, max_depth=None, max_str=None,
+                   max_size=None):
+    '''
+    Convert object to structure of primitives, which can be safely sent to
+    client
+
+    Lists, tuples, sets and dicts are converted to lists and dicts, other
+    objects to strings. Objects are walked iteratively, breadth-first, and
+    never copied, so the cost doesn't depend on object size. Truncated
+    containers and strings get markers with the original lengths, the marker
+    key of truncated dicts is "...", with dots appended if the dict already
+    has such key
 
-        write_through = False
-        mode = 'w'
+    Args:
+        max_items: max items per container
+        max_depth: max container nesting
+        max_str: max string length
+        max_size: approximate max size of the result (bytes), objects,
+            which don't fit, are replaced with "..." markers
 
-        def __init__(self, name, real, std):
-            self.name = '<{}>'.format(name)
-            self.real = real
-            self.std = std
+    Defaults are taken from limits of the client, served by the current
+    thread
+    '''
+    limits = _client_limits()
+    if max_items is None:
+        max_items = limits['items']
+    if max_depth is None:
+        max_depth = limits['depth']
+    if max_str is None:
+        max_str = limits['str']
+    if max_size is None:
+        max_size = limits['size']
+    result = [None]
+    budget = max_size
+    # object, target container, key in target, depth
+    queue = deque([(obj, result, 0, 0)])
+    while queue:
+        if budget <= 0:
+            for o, target, key, depth in queue:
+                target[key] = '...'
+            break
+        o, target, key, depth = queue.popleft()
+        if o is None or isinstance(o, (bool, float) + integer_types):
+            v = o
+            budget -= 8
+        elif isinstance(o, string_types):
+            v = _truncate_str(o, max_str)
+            budget -= len(v)
+        elif isinstance(o, bytes):
+            v = _truncate_str(repr(o[:max_str + 1])[:max_str + 3], max_str + 3)
+            if len(o) > max_str:
+                v += '...({} bytes)'.format(len(o))
+            budget -= len(v)
+        elif isinstance(o, container_types):
+            l = len(o)
+            if depth >= max_depth or budget < 8 * min(l, max_items):
+                v = '<{} of {} items>'.format(type(o).__name__, l)
+                budget -= len(v)
+            else:
+                try:
+                    if isinstance(o, dict):
+                        v = {}
+                        for k, x in islice(o.items(), max_items):
+                            if not (k is None or isinstance(
+                                    k, (bool, float) + integer_types +
+                                    string_types)):
+                                k = str(k)
+                            if isinstance(k, string_types):
+                                k = _truncate_str(k, max_str)
+                            v[k] = None
+                            queue.append((x, v, k, depth + 1))
+                        if l > max_items:
+                            # marker key must not replace a real one
+                            marker = '...'
+                            while marker in v:
+                                marker += '.'
+                            v[marker] = '({} items)'.format(l)
+                    else:
+                        v = [None] * min(l, max_items)
+                        for i, x in enumerate(islice(o, max_items)):
+                            queue.append((x, v, i, depth + 1))
+                        if l > max_items:
+                            v.append('...({} items)'.format(l))
+                except RuntimeError:
+                    # changed by other thread
+                    v = '<{} of {} items, changed during iteration>'.format(
+                        type(o).__name__, l)
+                budget -= 8 * (len(v) + 1)
+        else:
             try:
-                self.encoding = real.encoding
+                v = _truncate_str(str(o), max_str)
             except:
-                self.encoding = 'UTF-8'
-            self.flush = real.flush
-            self.isatty = real.isatty
+                v = '<{}>'.format(type(o).__name__)
+            budget -= len(v)
+        target[key] = v
+    return result[0]
 
-        def writable(self):
-            return True
 
-        def write(self, text):
-            with self.std.lock:
-                self.std.buf += text
-            return self.real.write(text)
+class Handles(object):
+    '''
+    Opaque handles of remote objects
 
-        def writelines(self, lines):
-            with self.std.lock:
-                for l in lines:
-                    self.std.buf += l
-            return self.real.writelines(lines)
+    Client gets a handle instead of serialized object and browses the object
+    page by page, so inspecting huge structures costs a page per request. The
+    same object always gets the same handle, least recently used handles are
+    released when max_handles is reached
+    '''
 
-    def send_frame(conn, frame_id, data):
-        conn.sendall(
-            struct.pack('I', len(data)) + struct.pack('I', frame_id) + data)
-        # log('{}: frame {}, {} bytes sent'.format(cpid, frame_id, len(data)))
+    def __init__(self, size=None):
+        self.objects = OrderedDict()
+        self.ids = {}
+        self.size = size or max_handles
+        self.counter = 0
 
-    def send_serialized(conn, frame_id, data):
-        send_frame(conn, frame_id,
-                   b'\x00' + pickle.dumps(data, protocol=protocol))
+    def put(self, obj):
+        h = self.ids.get(id(obj))
+        if h is not None:
+            self.objects[h] = self.objects.pop(h)
+            return h
+        self.counter += 1
+        h = self.counter
+        self.objects[h] = obj
+        self.ids[id(obj)] = h
+        while len(self.objects) > self.size:
+            self.ids.pop(id(self.objects.popitem(last=False)[1]), None)
+        return h
 
-    def send_ok(conn, frame_id):
-        send_frame(conn, frame_id, b'\x00')
+    def get(self, h):
+        try:
+            obj = self.objects.pop(h)
+        except KeyError:
+            raise KeyError('handle {} is released'.format(h))
+        self.objects[h] = obj
+        return obj
 
-    def format_injection_unload_code(injection_id, src):
-        return compile(u + '\ninjection_unload()',
-                       '__pptop_injection_unload_' + injection_id, 'exec')
+    def release(self, h=None):
+        '''
+        Release handle or list of handles, all handles if not specified
+        '''
+        if h is None:
+            self.objects.clear()
+            self.ids.clear()
+        else:
+            for x in h if isinstance(h, (list, tuple)) else (h,):
+                obj = self.objects.pop(x, None)
+                if obj is not None:
+                    self.ids.pop(id(obj), None)
 
-    server_address = '/tmp/.pptop.{}'.format(cpid)
+    def describe(self, obj):
+        '''
+        Object descriptor
+
+        Returns:
+            dict with fields h (handle, None for scalars), type, kind (map,
+            seq, obj or None for scalars), len (None if unknown) and value
+            (short preview)
+        '''
+        d = {'type': type(obj).__name__, 'len': None}
+        if obj is None or isinstance(obj, scalar_types):
+            if isinstance(obj, string_types + (bytes,)):
+                d['len'] = len(obj)
+                d['value'] = _truncate_str(obj, _client_limits()['str'])
+            else:
+                d['value'] = obj
+            d['h'] = None
+            d['kind'] = None
+            return d
+        d['h'] = self.put(obj)
+        try:
+            d['len'] = len(obj)
+        except:
+            pass
+        if isinstance(obj, type):
+            d['kind'] = 'obj'
+        elif hasattr(obj, 'keys') and hasattr(obj, '__getitem__'):
+            d['kind'] = 'map'
+        elif hasattr(obj, '__iter__'):
+            d['kind'] = 'seq'
+        else:
+            d['kind'] = 'obj'
+        if d['len'] is not None:
+            # never repr containers, they may be huge
+            d['value'] = '<{} of {} items>'.format(d['type'], d['len'])
+        else:
+            try:
+                d['value'] = _truncate_str(repr(obj), handle_preview)
+            except:
+                d['value'] = '<{}>'.format(d['type'])
+        return d
+
+    def keys(self, obj, offset=0, limit=None):
+        '''
+        Page of mapping items: (key preview, value descriptor)
+        '''
+        result = []
+        stop = None if limit is None else offset + limit
+        for k in islice(obj.keys(), offset, stop):
+            try:
+                v = self.describe(obj[k])
+            except:
+                e = sys.exc_info()
+                v = self.describe('!ERROR {}: {}'.format(
+                    e[0].__name__, str(e[1])))
+            result.append((_truncate_str(repr(k), handle_preview), v))
+        return result
+
+    def slice(self, obj, offset=0, limit=None):
+        '''
+        Page of sequence (or any iterable) items: (index, item descriptor)
+        '''
+        stop = None if limit is None else offset + limit
+        try:
+            # sequences are sliced with no iteration
+            items = obj[offset:stop]
+            iter(items)
+        except:
+            items = islice(obj, offset, stop)
+        return [(i, self.describe(x)) for i, x in enumerate(items, offset)]
+
+    def attrs(self, obj, offset=0, limit=None):
+        '''
+        Page of object attributes: (name, value descriptor)
+        '''
+        result = []
+        stop = None if limit is None else offset + limit
+        for name in dir(obj)[offset:stop]:
+            try:
+                v = self.describe(getattr(obj, name))
+            except:
+                e = sys.exc_info()
+                v = self.describe('!ERROR {}: {}'.format(
+                    e[0].__name__, str(e[1])))
+            result.append((name, v))
+        return result
+
+
+def eval_namespace(ns):
+    '''
+    Namespace to evaluate expressions in: top-level modules, already imported
+    by process, overridden with ns
+    '''
+    result = dict((k, v) for k, v in sys.modules.copy().items()
+                  if v is not None and '.' not in k)
+    result.update(ns)
+    return result
+
+
+class Stream(object):
+    '''
+    Stream of items, pushed to client
+
+    Injections push items with stream.push(item), items are buffered and sent
+    by agent pusher thread in batches
+    '''
+
+    def __init__(self, stream_id, notify, items, latency, buffer):
+        self.stream_id = stream_id
+        self.notify = notify
+        self.items = items
+        self.latency = latency
+        self.buf = deque(maxlen=buffer)
+        self.dropped = 0
+        self.time_first = None
+        self.lock = threading.Lock()
+
+    def push(self, item):
+        with self.lock:
+            if len(self.buf) == self.buf.maxlen:
+                self.dropped += 1
+            self.buf.append(item)
+            if self.time_first is None:
+                self.time_first = time.time()
+                first = True
+            else:
+                first = False
+            full = len(self.buf) >= self.items
+        # pusher sleeps until any stream has data
+        if full or first:
+            self.notify()
+
+    def collect(self, t):
+        '''
+        Collect buffered items, if batch is full or latency is reached
+
+        Returns:
+            tuple (items, dropped, time first item pushed) or None
+        '''
+        with self.lock:
+            if not self.buf or (len(self.buf) < self.items and
+                                t - self.time_first < self.latency):
+                return None
+            result = (list(self.buf), self.dropped, self.time_first)
+            self.buf.clear()
+            self.dropped = 0
+            self.time_first = None
+        return result
+
+
+class ShmStream(Stream):
+    '''
+    Stream, which is flushed to shared memory ring instead of socket, each
+    batch of items is written as a single ring record
+    '''
+
+    def __init__(self, stream_id, notify, items, latency, buffer, ring, n,
+                 codecs, protocol):
+        Stream.__init__(self, stream_id, notify, items, latency, buffer)
+        self.ring = ring
+        self.n = n
+        self.codecs = codecs
+        self.protocol = protocol
+
+    def flush(self, items, dropped):
+        if dropped:
+            self.ring.add_overruns(dropped)
+        for i in items:
+            if not isinstance(i, text_type):
+                self.ring.write(self.n, shm.KIND_ENCODED,
+                                packers.dumps(items, self.codecs,
+                                              self.protocol), len(items))
+                return
+        self.ring.write(self.n, shm.KIND_TEXT,
+                        u''.join(items).encode('utf-8'), len(items))
+
+
+class Chunked(object):
+    '''
+    Result of injection function, which yields batches (lists) of rows
+
+    Injection lock is held until all batches are collected
+    '''
+
+    def __init__(self, gen, key, lock):
+        self.gen = gen
+        self.key = key
+        self.lock = lock
+        self.locked = True
+
+    def __iter__(self):
+        for batch in self.gen:
+            yield batch if isinstance(batch, list) else list(batch)
+
+    def release(self):
+        if self.locked:
+            self.locked = False
+            self.lock.release()
+
+    def collect(self):
+        '''
+        Collect all batches into a single list
+        '''
+        result = []
+        try:
+            for batch in self:
+                result.extend(batch)
+        finally:
+            self.release()
+        return result
+
+
+def delta_encode(cache, injection_id, result, seq, key):
+    '''
+    Encode injection result as delta to the result sent previously
+
+    Args:
+        cache: delta cache dict
+        injection_id: injection id
+        result: injection result, list of rows (tuples)
+        seq: sequence number of the result client has
+        key: row key columns (indexes)
+
+    Returns:
+        tuple (seq, result, inserted/updated rows, removed row keys). If the
+        result can't be delta-encoded or client has no previous result,
+        result is sent as-is, otherwise it is set to None. seq is 0 if result
+        is not cached
+    '''
     try:
-        os.unlink(server_address)
+        if not isinstance(result, list):
+            raise ValueError
+        rows = {}
+        for r in result:
+            rows[tuple(r[i] for i in key)] = r
+        if len(rows) != len(result):
+            # row keys are not unique
+            raise ValueError
     except:
-        pass
-    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    server.bind(server_address)
-    os.chmod(server_address, 0o600)
-    server.listen(0)
-    server.settimeout(socket_timeout)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, socket_buf)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_buf)
-    injections = {}
-    real_stdout = None
-    real_stderr = None
-    log('Pickle protocol: {}'.format(protocol))
-    log('listening')
+        cache.pop(injection_id, None)
+        return 0, result, None, None
+    prev_seq, prev_rows = cache.get(injection_id, (0, None))
+    new_seq = prev_seq + 1
+    cache[injection_id] = (new_seq, rows)
+    if not seq or seq != prev_seq:
+        return new_seq, result, None, None
+    upserted = []
+    for k, r in rows.items():
+        if prev_rows.get(k) != r:
+            upserted.append(r)
+    removed = [k for k in prev_rows if k not in rows]
+    return new_seq, None, upserted, removed
+
+
+class STD(object):
+    '''
+    Per-client stdout/stderr capture
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buf = ''
+        self.stream = None
+
+    def write(self, text):
+        stream = self.stream
+        if stream is not None:
+            stream.push(text)
+        else:
+            with self.lock:
+                self.buf += text
+
+    def collect(self):
+        with self.lock:
+            buf = self.buf
+            self.buf = ''
+        return buf
+
+
+class ppStdout(object):
+
+    write_through = False
+    mode = 'w'
+
+    def __init__(self, name, real):
+        self.name = '<{}>'.format(name)
+        self.real = real
+        try:
+            self.encoding = real.encoding
+        except:
+            self.encoding = 'UTF-8'
+        self.flush = real.flush
+        self.isatty = real.isatty
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        for std in _std.sinks:
+            std.write(text)
+        return self.real.write(text)
+
+    def writelines(self, lines):
+        for std in _std.sinks:
+            for l in lines:
+                std.write(l)
+        return self.real.writelines(lines)
+
+
+# stdout/stderr grabber, shared by clients. the list of sinks is replaced on
+# change, so writers can iterate it without locking
+_std = SimpleNamespace(real_stdout=None, real_stderr=None, sinks=[])
+
+
+def add_std_sink(std):
+    with _g_lock:
+        if _std.real_stdout is None:
+            _std.real_stdout = sys.stdout
+            _std.real_stderr = sys.stderr
+            sys.stdout = ppStdout('stdout', _std.real_stdout)
+            sys.stderr = ppStdout('stderr', _std.real_stderr)
+        _std.sinks = _std.sinks + [std]
+
+
+def remove_std_sink(std):
+    with _g_lock:
+        _std.sinks = [s for s in _std.sinks if s is not std]
+        if not _std.sinks and _std.real_stdout is not None:
+            sys.stdout = _std.real_stdout
+            sys.stderr = _std.real_stderr
+            _std.real_stdout = None
+            _std.real_stderr = None
+
+
+class StreamGroup(object):
+    '''
+    Streams of all clients, subscribed to the same injection
+    '''
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def push(self, item):
+        for s in self.streams:
+            s.push(item)
+
+
+# injections are shared by clients and reference-counted: injection, loaded
+# by one client, is reused by others and unloaded when the last client,
+# which holds it, is gone
+_injections = {}
+_locks = {}
+
+# injection sources by hash and compiled code objects by (hash, kind,
+# injection id), kept for re-injections and reconnects
+_sources = {}
+_code_cache = {}
+
+
+def get_lock(key):
+    with _g_lock:
+        try:
+            return _locks[key]
+        except KeyError:
+            lock = threading.Lock()
+            _locks[key] = lock
+            return lock
+
+
+def command_key(cmd, params):
+    '''
+    Self-overhead accounting key: delta-encoded plugin commands are accounted
+    to their plugins
+    '''
+    if cmd == '.delta':
+        try:
+            return params['id']
+        except:
+            pass
+    return cmd
+
+
+def source_hash(src):
+    '''
+    Injection source hash (the same is calculated by client)
+    '''
+    return hashlib.sha1(src.encode('utf-8')).hexdigest()
+
+
+def compile_injection(injection_id, kind, src, h=None):
+    '''
+    Compile injection code, compiled code objects are cached by source hash
+
+    Args:
+        injection_id: injection id
+        kind: l - load, i - injection, u - unload
+        src: injection source
+        h: source hash, calculated if not specified
+    '''
+    key = (h or source_hash(src), kind, injection_id)
+    code = _code_cache.get(key)
+    if code is None:
+        if kind == 'l':
+            code = compile(src + '\ninjection_load(**load_kw)',
+                           '__pptop_injection_load_' + injection_id, 'exec')
+        elif kind == 'i':
+            code = compile(src + '\n_r = injection(**kw)',
+                           '__pptop_injection_' + injection_id, 'exec')
+        else:
+            code = compile(src + '\ninjection_unload()',
+                           '__pptop_injection_unload_' + injection_id, 'exec')
+        _code_cache[key] = code
+    return code
+
+
+def _unload_injection(injection_id, injection):
+    code = injection.get('u')
+    if code:
+        try:
+            exec(code, injection['g'])
+            log('injection removed: {}'.format(injection_id))
+        except:
+            log_traceback()
+
+
+def _update_injection_stream(injection):
+    streams = list(injection['streams'].values())
+    if not streams:
+        stream = None
+    elif len(streams) == 1:
+        stream = streams[0]
+    else:
+        stream = StreamGroup(streams)
+    injection['g']['stream'] = stream
+
+
+def acquire_injection(client_id, params):
+    '''
+    Inject plugin
+
+    If the plugin is already injected by another client with the same source,
+    the injection is reused. If the client re-injects the plugin, it is
+    reloaded for all clients
+
+    Sources, already known by agent, can be omitted, if their hashes are
+    specified in params "h". If neither source nor its hash is known,
+    KeyError is raised
+
+    Must be called with injection lock acquired
+    '''
+    injection_id = params['id']
+    hashes = params.get('h', {})
+    sources = {}
+    for kind in ('l', 'i', 'u'):
+        if kind in params:
+            h = hashes.get(kind) or source_hash(params[kind])
+            with _g_lock:
+                _sources[h] = params[kind]
+            sources[kind] = (params[kind], h)
+        elif kind in hashes:
+            h = hashes[kind]
+            with _g_lock:
+                if h not in _sources:
+                    raise KeyError('source {} is unknown'.format(h))
+                sources[kind] = (_sources[h], h)
+    src = tuple(sources[k][1] if k in sources else None for k in 'liu')
+    injection = _injections.get(injection_id)
+    if injection is not None:
+        if injection['src'] == src and client_id not in injection['refs']:
+            injection['refs'].add(client_id)
+            log('injection reused: {}, clients: {}'.format(
+                injection_id, len(injection['refs'])))
+            return
+        _unload_injection(injection_id, injection)
+        refs = injection['refs']
+        streams = injection['streams']
+    else:
+        refs = set()
+        streams = {}
+    refs.add(client_id)
+    injection = {
+        'g': {
+            'g': SimpleNamespace(),
+            'mg': g,
+            'stream': None
+        },
+        'u': compile_injection(injection_id, 'u', *sources['u'])
+             if 'u' in sources else None,
+        'src': src,
+        'refs': refs,
+        'streams': streams
+    }
+    _update_injection_stream(injection)
+    if 'l' in sources:
+        injection['g']['load_kw'] = params.get('lkw', {})
+        exec(compile_injection(injection_id, 'l', *sources['l']),
+             injection['g'])
+    if 'i' in sources:
+        injection['i'] = compile_injection(injection_id, 'i', *sources['i'])
+    else:
+        injection['i'] = compile('_r = None',
+                                 '__pptop_injection_' + injection_id, 'exec')
+    _injections[injection_id] = injection
+    log('injection completed: {}'.format(injection_id))
+
+
+def release_injection(client_id, injection_id, keep=False):
+    '''
+    Release injection, held by client, unload it if not used by other clients
+
+    If keep is True, the injection is passed to resident agent
+    '''
+    with get_lock(injection_id):
+        injection = _injections.get(injection_id)
+        if injection is None or client_id not in injection['refs']:
+            return
+        injection['refs'].discard(client_id)
+        if keep:
+            injection['refs'].add(resident_client_id)
+        if injection['streams'].pop(client_id, None) is not None:
+            _update_injection_stream(injection)
+        if not injection['refs']:
+            _unload_injection(injection_id, injection)
+            del _injections[injection_id]
+        else:
+            log('injection released: {}, clients: {}'.format(
+                injection_id, len(injection['refs'])))
+
+
+def release_resident():
+    '''
+    Stop being resident, unload injections, kept by resident agent
+    '''
+    with _g_lock:
+        g._resident = None
+        g._resident_address = None
+    for injection_id in list(_injections):
+        release_injection(resident_client_id, injection_id)
+    log('resident agent released')
+
+
+def serve(connection, cpid, client_id, protocol):
+    '''
+    Serve client connection
+    '''
+
+    def send_frame(conn, frame_id, status, data, time_queued, time_started):
+        time_finished = time.time()
+        time_serialize = tl.time_serialize
+        std = st.std
+        l = sum([len(chunk) for chunk in data])
+        tl.payload += l
+        meta = response_meta.pack(
+            int((time_started - time_queued) * 1000000),
+            int(max(time_finished - time_started - time_serialize, 0) *
+                1000000), int(time_serialize * 1000000), l,
+            g._runner_status if g._runner_mode else 1,
+            len(std.buf) if std is not None else 0)
+        with send_lock:
+            conn.send(frame_id, *((status,) + data + (meta,)))
+        # log('{}: frame {} sent'.format(cpid, frame_id))
+
+    def account(key, wall, cpu, time_serialize, payload):
+        with stats_lock:
+            s = overhead.get(key)
+            if s is None:
+                overhead[key] = [1, wall, cpu, time_serialize, payload]
+            else:
+                s[0] += 1
+                s[1] += wall
+                s[2] += cpu
+                s[3] += time_serialize
+                s[4] += payload
+
+    def serialize(data, key=None):
+        t = time.time()
+        try:
+            return st.encoder.encode(data, key)
+        finally:
+            tl.time_serialize += time.time() - t
+
+    def run_injection(injection_id, params):
+        log('command {}, data: {}'.format(injection_id, params))
+        gl = _injections[injection_id]['g']
+        gl['kw'] = params
+        exec(_injections[injection_id]['i'], gl)
+        return gl['_r']
+
+    def run_locked(injection_id, params):
+        '''
+        Run injection, holding its lock
+
+        Returns:
+            injection result. If injection function is a generator, Chunked
+            object is returned, the lock is held until it's released
+        '''
+        lock = get_lock(injection_id)
+        lock.acquire()
+        try:
+            result = run_injection(injection_id, params)
+        except:
+            lock.release()
+            raise
+        if isinstance(result, types.GeneratorType):
+            return Chunked(result, injection_id, lock)
+        lock.release()
+        return result
+
+    def execute(cmd, params):
+        '''
+        Execute command
+
+        Returns:
+            tuple (status, response data chunks)
+        '''
+        if cmd == '.test':
+            return RESPONSE_OK, ()
+        elif cmd == '.gs':
+            if st.std is None:
+                st.std = STD()
+                add_std_sink(st.std)
+                buf = ''
+            else:
+                buf = st.std.collect()
+            return RESPONSE_OK, serialize(buf)
+        elif cmd == '.status':
+            return RESPONSE_OK, serialize(
+                g._runner_status if g._runner_mode else 1)
+        elif cmd == '.path':
+            return RESPONSE_OK, serialize(sys.path)
+        elif cmd == '.hello':
+            with _g_lock:
+                known = list(_sources)
+            local = packers.supported_codecs()
+            codecs = packers.negotiate(local, params)
+            z = params.get('z')
+            if z:
+                try:
+                    framer.set_compression(z['method'], z.get('level'),
+                                           z['threshold'])
+                    log('compression: {}'.format(z))
+                except:
+                    log_traceback()
+            ring = params.get('shm')
+            if ring and shm.available():
+                path = '{}/.pptop.{}.{}'.format(shm.shm_dir, cpid, client_id)
+                try:
+                    try:
+                        os.unlink(path)
+                    except:
+                        pass
+                    st.ring = shm.Ring(path, ring['size'])
+                    log('shm ring: {}'.format(path))
+                except:
+                    log_traceback()
+            data = serialize({
+                'codecs': codecs,
+                'v': local['v'],
+                'z': framer.compression,
+                'shm': st.ring.path if st.ring else None,
+                'resident': g._resident is not None,
+                'code': known
+            })
+            st.encoder = packers.Encoder(codecs, protocol)
+            if params.get('gil'):
+                st.budget = params['gil']
+            if params.get('limits'):
+                st.limits = dict(serialize_limits)
+                st.limits.update(params['limits'])
+            if params.get('detach'):
+                with _g_lock:
+                    g._resident = params['detach']
+                log('agent is resident: {}'.format(params['detach']))
+            elif g._resident:
+                # client hasn't asked to detach, resident agent terminates
+                # itself when the last client is gone
+                with _g_lock:
+                    g._resident = None
+                log('agent is not resident anymore')
+            log('codecs: {}'.format(codecs))
+            return RESPONSE_OK, data
+        elif cmd == '.bench':
+            result = []
+            for injection_id in params['ids']:
+                try:
+                    data = run_locked(injection_id, {})
+                    if isinstance(data, Chunked):
+                        data = data.collect()
+                except:
+                    log_traceback()
+                    e = sys.exc_info()
+                    result.append((injection_id, None, '{}: {}'.format(
+                        e[0].__name__, str(e[1]))))
+                    continue
+                codecs = st.encoder.codecs
+                for codec in codecs:
+                    result.append((injection_id, codec,
+                                   packers.bench(data, codec, codecs, protocol,
+                                                 params['iters'])))
+            return RESPONSE_OK, serialize(result)
+        elif cmd == '.x':
+            x = {}
+            try:
+                exec(params, x)
+                result = (0, x.get('out'))
+            except:
+                log_traceback()
+                e = sys.exc_info()
+                result = (1, e[0].__name__, str(e[1]))
+            return RESPONSE_OK, serialize(result)
+        elif cmd == '.exec':
+            try:
+                if params.startswith('help'):
+                    raise RuntimeError('Help on remote is not supported')
+                if params.startswith('try: __result '):
+                    src = params
+                else:
+                    p1 = params.split(' ', 1)[0]
+                    prfunc = '_print' if sys.version_info < (3, 0) else 'print'
+                    if p1 in [
+                            'import', 'def', 'class', 'for', 'while', 'raise',
+                            'if', 'with', 'from', 'try:'
+                    ]:
+                        src = ('def {}(*args):\n' +
+                               ' __resultl.append(\' \'.join(str(a) ' +
+                               'for a in args))\n__resultl=[]\n{}' +
+                               '\n__result = \'\\n\'.join(__resultl) ' +
+                               'if __resultl else None').format(prfunc, params)
+                    else:
+                        src = ('def {}(*args): ' + 'return \' \'.join(str(a) ' +
+                               'for a in args)\n' + '__result = {}').format(
+                                   prfunc, params)
+                with exec_lock:
+                    exec(src, exec_globals)
+                    result = exec_globals.get('__result')
+                try:
+                    data = serialize((0, safe_serialize(result)))
+                except:
+                    log_traceback()
+                    data = serialize((0, str(result)))
+                return RESPONSE_OK, data
+            except:
+                log_traceback()
+                e = sys.exc_info()
+                with _g_lock:
+                    g._last_exception = (e[0].__name__, str(e[1]), [''])
+                return RESPONSE_OK, serialize((-1, e[0].__name__, str(e[1])))
+        elif cmd == '.obj':
+            op = params['op']
+            try:
+                with exec_lock:
+                    if op == 'release':
+                        st.handles.release(params.get('h'))
+                        result = None
+                    elif 'expr' in params:
+                        obj = eval(params['expr'],
+                                   eval_namespace(exec_globals))
+                    else:
+                        obj = st.handles.get(params['h'])
+                    if op == 'open':
+                        result = st.handles.describe(obj)
+                    elif op == 'len':
+                        result = len(obj)
+                    elif op == 'attr':
+                        result = st.handles.describe(
+                            getattr(obj, params['name']))
+                    elif op == 'dir':
+                        result = dir(obj)
+                    elif op in ('keys', 'slice', 'attrs'):
+                        result = getattr(st.handles, op)(
+                            obj, params.get('offset', 0),
+                            params.get('limit', handle_page))
+                    elif op != 'release':
+                        return RESPONSE_NOT_FOUND, ()
+                return RESPONSE_OK, serialize((0, result))
+            except:
+                log_traceback()
+                e = sys.exc_info()
+                return RESPONSE_OK, serialize((-1, e[0].__name__, str(e[1])))
+        elif cmd == '.gil':
+            with _g_lock:
+                tick = _gil.ticks.get(client_id, 0)
+                _gil.ticks[client_id] = 0
+            return RESPONSE_OK, serialize({
+                'tick': tick * 1000,
+                'max': _gil.max * 1000,
+                'budget': st.budget * 1000,
+                'threads': agent_threads()
+            })
+        elif cmd == '.overhead':
+            t = os.times()
+            with stats_lock:
+                stats = dict((k, tuple(v)) for k, v in overhead.items())
+            return RESPONSE_OK, serialize({
+                'time': time.time(),
+                'cpu': t[0] + t[1],
+                'thread_cpu': thread_time is not None,
+                'stats': stats
+            })
+        elif cmd == '.le':
+            with _g_lock:
+                return RESPONSE_OK, serialize(g._last_exception)
+        elif cmd == '.ready':
+            g._runner_ready = True
+            return RESPONSE_OK, ()
+        elif cmd == '.inject':
+            log(params)
+            injection_id = params['id']
+            unsubscribe(injection_id)
+            with get_lock(injection_id):
+                try:
+                    acquire_injection(client_id, params)
+                except KeyError:
+                    # client should send source
+                    log_traceback()
+                    return RESPONSE_NOT_FOUND, ()
+                held.add(injection_id)
+            return RESPONSE_OK, ()
+        elif cmd == '.delta':
+            injection_id = params['id']
+            if injection_id not in _injections:
+                return RESPONSE_NOT_FOUND, ()
+            result = run_locked(injection_id, params.get('kw', {}))
+            if isinstance(result, Chunked):
+                # chunked results are sent as-is
+                delta_cache.pop(injection_id, None)
+                return RESPONSE_OK, result
+            with get_lock(injection_id):
+                return RESPONSE_OK, serialize(
+                    delta_encode(delta_cache, injection_id, result,
+                                 params['seq'], params['key']), injection_id)
+        elif cmd == '.subscribe':
+            stream_id = params['id']
+            if stream_id == '.gs':
+                if st.std is None:
+                    execute('.gs', None)
+            elif stream_id not in _injections:
+                return RESPONSE_NOT_FOUND, ()
+            kw = stream_defaults.copy()
+            for k in kw:
+                if k in params:
+                    kw[k] = params[k]
+            if params.get('shm') and st.ring:
+                stream = ShmStream(stream_id, push_event.set,
+                                   ring=st.ring,
+                                   n=params['n'],
+                                   codecs=st.encoder.codecs,
+                                   protocol=protocol,
+                                   **kw)
+            else:
+                stream = Stream(stream_id, push_event.set, **kw)
+            with _g_lock:
+                streams[stream_id] = stream
+            if stream_id == '.gs':
+                st.std.stream = stream
+            else:
+                with get_lock(stream_id):
+                    injection = _injections[stream_id]
+                    injection['streams'][client_id] = stream
+                    _update_injection_stream(injection)
+            log('stream subscribed: {}'.format(stream_id))
+            return RESPONSE_OK, ()
+        elif cmd == '.unsubscribe':
+            unsubscribe(params['id'])
+            return RESPONSE_OK, ()
+        elif cmd == '.batch':
+            data = (batch_header.pack(len(params)),)
+            for c, p in params:
+                t = time.time()
+                cpu = thread_time() if thread_time else 0
+                ts = tl.time_serialize
+                try:
+                    if c in ('.batch', '.bye'):
+                        status, d = RESPONSE_NOT_FOUND, ()
+                    else:
+                        status, d = execute(c, p)
+                        if isinstance(d, Chunked):
+                            d = serialize(d.collect(), d.key)
+                except:
+                    log_traceback()
+                    status, d = RESPONSE_FAILED, ()
+                l = 0
+                for chunk in d:
+                    l += len(chunk)
+                ts = tl.time_serialize - ts
+                t = time.time() - t
+                data += (batch_item.pack(status, l,
+                                         int(max(t - ts, 0) * 1000000),
+                                         int(ts * 1000000)),) + d
+                account(
+                    command_key(c, p), t,
+                    thread_time() - cpu if thread_time else 0, ts, l)
+            return RESPONSE_OK, data
+        elif cmd in _injections:
+            result = run_locked(cmd, params)
+            if isinstance(result, Chunked):
+                return RESPONSE_OK, result
+            return RESPONSE_OK, serialize(result, cmd)
+        else:
+            return RESPONSE_NOT_FOUND, ()
+
+    def unsubscribe(stream_id):
+        with _g_lock:
+            stream = streams.pop(stream_id, None)
+        if stream is None:
+            return
+        if stream_id == '.gs':
+            if st.std is not None:
+                st.std.stream = None
+        else:
+            with get_lock(stream_id):
+                injection = _injections.get(stream_id)
+                if injection is not None and \
+                        injection['streams'].pop(client_id, None) is not None:
+                    _update_injection_stream(injection)
+
+    def pusher():
+        _client.st = st
+        timeout = None
+        while True:
+            # wait till batch is full or the nearest stream latency is reached
+            push_event.wait(timeout)
+            push_event.clear()
+            if st.finished:
+                break
+            with _g_lock:
+                s = list(streams.values())
+            t = time.time()
+            timeout = None
+            for stream in s:
+                data = stream.collect(t)
+                if data is None:
+                    time_first = stream.time_first
+                    if time_first is not None:
+                        w = max(time_first + stream.latency - t, 0)
+                        if timeout is None or w < timeout:
+                            timeout = w
+                else:
+                    try:
+                        tl.time_serialize = 0
+                        tl.payload = 0
+                        time_started = time.time()
+                        cpu = thread_time() if thread_time else 0
+                        if isinstance(stream, ShmStream):
+                            stream.flush(data[0], data[1])
+                        else:
+                            send_frame(
+                                framer, push_frame_id, RESPONSE_OK,
+                                serialize((stream.stream_id, data[0], data[1]),
+                                          stream.stream_id), data[2], t)
+                        account(stream.stream_id, time.time() - time_started,
+                                thread_time() - cpu if thread_time else 0,
+                                tl.time_serialize, tl.payload)
+                    except:
+                        log_traceback('unable to push stream data')
+
+    def process(frame_id, cmd, params, time_queued):
+        time_started = time.time()
+        cpu = thread_time() if thread_time else 0
+        tl.time_serialize = 0
+        tl.payload = 0
+        try:
+            status, data = execute(cmd, params)
+        except:
+            log_traceback()
+            status, data = RESPONSE_FAILED, ()
+        try:
+            if isinstance(data, Chunked):
+                status, data = send_chunked(frame_id, data, time_queued,
+                                            time_started)
+            send_frame(framer, frame_id, status, data, time_queued,
+                       time_started)
+        except:
+            log_traceback('unable to send response')
+        # batch items are accounted separately
+        if cmd != '.batch':
+            account(command_key(cmd, params),
+                    time.time() - time_started,
+                    thread_time() - cpu if thread_time else 0,
+                    tl.time_serialize, tl.payload)
+
+    def send_chunked(frame_id, data, time_queued, time_started):
+        '''
+        Send batches as continuation frames
+
+        Returns:
+            status and the last batch, to be sent in the final frame
+        '''
+        batch = None
+        try:
+            for b in data:
+                if batch is not None:
+                    send_frame(framer, frame_id | FLAG_MORE, RESPONSE_OK,
+                               serialize(batch, data.key), time_queued,
+                               time_started)
+                batch = b
+        except:
+            log_traceback()
+            return RESPONSE_FAILED, ()
+        finally:
+            data.release()
+        return RESPONSE_OK, serialize(batch if batch is not None else [],
+                                      data.key)
+
+    def worker():
+        _client.st = st
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            process(*task)
+
+    # per-client state
+    held = set()
+    streams = {}
+    delta_cache = {}
+    exec_globals = {}
+    exec_lock = threading.Lock()
+    push_event = threading.Event()
+    st = SimpleNamespace(std=None,
+                         finished=False,
+                         ring=None,
+                         handles=Handles(),
+                         budget=collect_budget,
+                         limits=serialize_limits,
+                         encoder=packers.Encoder([packers.CODEC_PICKLE],
+                                                 protocol))
+    send_lock = threading.Lock()
+    # self-overhead: key - [calls, wall, cpu, serialize, payload bytes]
+    overhead = {}
+    stats_lock = threading.Lock()
+    # per-thread: response serialization time and payload bytes sent
+    tl = threading.local()
+    tasks = queue.Queue()
+    workers = []
+    _client.st = st
+    with _g_lock:
+        _gil.ticks[client_id] = 0
+    log('client {} connected'.format(client_id))
     try:
-        connection, client_address = server.accept()
-        log('connected')
         connection.sendall(struct.pack('b', protocol))
-        with _g_lock:
-            g.clients += 1
         connection.settimeout(socket_timeout)
-        exec_globals = {}
+        framer = Framer(connection, timeout=socket_timeout)
+        for i in range(max_workers):
+            t = threading.Thread(name='__pptop_injection_worker_{}_{}_{}'.format(
+                cpid, client_id, i),
+                                 target=worker)
+            t.setDaemon(True)
+            t.start()
+            workers.append(t)
+        t = threading.Thread(name='__pptop_injection_pusher_{}_{}'.format(
+            cpid, client_id),
+                             target=pusher)
+        t.setDaemon(True)
+        t.start()
+        workers.append(t)
         while True:
             try:
-                time_start = time.time()
-                data = connection.recv(4)
-                frame_id = struct.unpack('I', connection.recv(4))[0]
-                if data:
-                    l = struct.unpack('I', data)[0]
-                    frame = b''
-                    while len(frame) != l:
-                        if time.time() > time_start + socket_timeout:
-                            raise TimeoutError
-                        frame += connection.recv(socket_buf)
-                else:
+                data = framer.recv()
+                if data is None:
                     break
+                frame_id, frame = data[0], bytes(data[1])
             except:
                 log_traceback('invalid data received or client is gone')
                 break
             if frame:
+                time_queued = time.time()
                 try:
                     cmd, params = frame.split(b'\xff', 1)
                     cmd = cmd.decode()
@@ -225,182 +1589,135 @@ def loop(cpid, protocol, runner_mode=False):
                 except:
                     cmd = frame.decode()
                     params = {}
-                try:
-                    if cmd == '.test':
-                        send_ok(connection, frame_id)
-                    elif cmd == '.bye':
-                        break
-                    elif cmd == '.gs':
-                        if real_stdout is None:
-                            std = STD()
-                            std.lock = threading.Lock()
-                            std.buf = ''
-                            with std.lock:
-                                real_stdout = sys.stdout
-                                real_stderr = sys.stderr
-                                sys.stdout = ppStdout('stdout', real_stdout,
-                                                      std)
-                                sys.stderr = ppStdout('stderr', real_stderr,
-                                                      std)
-                                buf = ''
-                        else:
-                            with std.lock:
-                                buf = std.buf
-                                std.buf = ''
-                        send_serialized(connection, frame_id, buf)
-                    elif cmd == '.status':
-                        send_serialized(connection, frame_id,
-                                        g._runner_status if runner_mode else 1)
-                    elif cmd == '.path':
-                        send_serialized(connection, frame_id, sys.path)
-                    elif cmd == '.x':
-                        x = {}
-                        try:
-                            exec(params, x)
-                            result = (0, x.get('out'))
-                        except:
-                            log_traceback()
-                            e = sys.exc_info()
-                            result = (1, e[0].__name__, str(e[1]))
-                        send_serialized(connection, frame_id, result)
-                    elif cmd == '.exec':
-                        try:
-                            if params.startswith('help'):
-                                raise RuntimeError(
-                                    'Help on remote is not supported')
-                            if params.startswith('try: __result '):
-                                src = params
-                            else:
-                                p1 = params.split(' ', 1)[0]
-                                prfunc = '_print' if sys.version_info < (
-                                    3, 0) else 'print'
-                                if p1 in [
-                                        'import', 'def', 'class', 'for',
-                                        'while', 'raise', 'if', 'with', 'from',
-                                        'try:'
-                                ]:
-                                    src = (
-                                        'def {}(*args):\n' +
-                                        ' __resultl.append(\' \'.join(str(a) ' +
-                                        'for a in args))\n__resultl=[]\n{}' +
-                                        '\n__result = \'\\n\'.join(__resultl) '
-                                        + 'if __resultl else None').format(
-                                            prfunc, params)
-                                else:
-                                    src = ('def {}(*args): ' +
-                                           'return \' \'.join(str(a) ' +
-                                           'for a in args)\n' +
-                                           '__result = {}').format(
-                                               prfunc, params)
-                            exec(src, exec_globals)
-                            result = exec_globals.get('__result')
-                            try:
-                                data = pickle.dumps((0, safe_serialize(result)),
-                                                    protocol=protocol)
-                            except:
-                                log_traceback()
-                                data = pickle.dumps((0, str(result)),
-                                                    protocol=protocol)
-                            send_frame(connection, frame_id, b'\x00' + data)
-                        except:
-                            log_traceback()
-                            e = sys.exc_info()
-                            with _g_lock:
-                                g._last_exception = (e[0].__name__, str(e[1]),
-                                                     [''])
-                            send_serialized(connection, frame_id,
-                                            (-1, e[0].__name__, str(e[1])))
-                    elif cmd == '.le':
+                if cmd == '.bye':
+                    if params.get('stop'):
                         with _g_lock:
-                            send_serialized(connection, frame_id,
-                                            g._last_exception)
-                    elif cmd == '.ready':
-                        g._runner_ready = True
-                        send_ok(connection, frame_id)
-                    elif cmd == '.inject':
-                        log(params)
-                        injection_id = params['id']
-                        if injection_id in injections:
-                            u = injections[injection_id].get('u')
-                            if u:
-                                try:
-                                    code = format_injection_unload_code(
-                                        injection_id, u)
-                                    exec(code, injections[injection_id]['g'])
-                                    log('injection removed: {}'.format(
-                                        injection_id))
-                                except:
-                                    log_traceback()
-                        injections[injection_id] = {
-                            'g': {
-                                'g': SimpleNamespace(),
-                                'mg': g
-                            },
-                            'u': params.get('u')
-                        }
-                        if 'l' in params:
-                            code = compile(
-                                params['l'] + '\ninjection_load(**load_kw)',
-                                '__pptop_injection_load_' + injection_id,
-                                'exec')
-                            injections[injection_id]['g'][
-                                'load_kw'] = params.get('lkw', {})
-                            exec(code, injections[injection_id]['g'])
-                        if 'i' in params:
-                            src = params['i'] + '\n_r = injection(**kw)'
-                        else:
-                            src = '_r = None'
-                        injections[injection_id]['i'] = compile(
-                            src, '__pptop_injection_' + injection_id, 'exec')
-                        log('injection completed: {}'.format(injection_id))
-                        send_ok(connection, frame_id)
-                    elif cmd in injections:
-                        log('command {}, data: {}'.format(cmd, params))
-                        gl = injections[cmd]['g']
-                        gl['kw'] = params
-                        exec(injections[cmd]['i'], gl)
-                        send_serialized(connection, frame_id, gl['_r'])
-                    else:
-                        send_frame(connection, frame_id, b'\x01')
-                except:
-                    log_traceback()
-                    send_frame(connection, frame_id, b'\x02')
+                            g._resident = None
+                        log('agent stop requested')
+                    break
+                elif cmd in fast_commands or (cmd == '.batch' and all(
+                        c[0] in fast_commands for c in params)):
+                    process(frame_id, cmd, params, time_queued)
+                else:
+                    tasks.put((frame_id, cmd, params, time_queued))
             else:
                 break
     except Exception as e:
         log_traceback()
-    for i, v in injections.items():
-        u = v.get('u')
-        if u:
-            try:
-                code = format_injection_unload_code(i, u)
-                exec(code, v['g'])
-                log('injection removed: {}'.format(i))
-            except:
-                log_traceback()
+    for t in range(max_workers):
+        tasks.put(None)
+    st.finished = True
+    push_event.set()
+    for t in workers:
+        t.join(socket_timeout)
+    for i in list(streams):
+        unsubscribe(i)
+    with _g_lock:
+        resident = g._resident
+    for i in list(held):
+        release_injection(client_id, i, keep=resident is not None)
+    if st.std is not None:
+        remove_std_sink(st.std)
+    if st.ring is not None:
+        st.ring.unlink()
+        st.ring.close()
+    st.handles.release()
     try:
-        server.close()
+        connection.close()
     except:
         pass
+    with _g_lock:
+        _gil.ticks.pop(client_id, None)
+    log('client {} disconnected'.format(client_id))
+
+
+def loop(cpid, protocol, runner_mode=False):
+    server_address = '/tmp/.pptop.{}'.format(cpid)
     try:
-        with _g_lock:
-            g.clients -= 1
+        os.unlink(server_address)
+    except:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(server_address)
+    os.chmod(server_address, 0o600)
+    server.listen(max_clients)
+    server.settimeout(socket_timeout)
+    with _g_lock:
+        g._runner_mode = g._runner_mode or runner_mode
+    clients = []
+    resident = False
+    time_idle = None
+    log('Pickle protocol: {}'.format(protocol))
+    log('listening')
+    try:
+        while True:
+            try:
+                connection, client_address = server.accept()
+            except socket.timeout:
+                clients = [t for t in clients if t.is_alive()]
+                if not resident:
+                    with _g_lock:
+                        if g._resident and not g._resident_address:
+                            # move socket, so clients can find it by pid
+                            path = resident_address.format(os.getpid())
+                            os.rename(server_address, path)
+                            server_address = path
+                            g._resident_address = path
+                            resident = True
+                            log('resident agent socket: {}'.format(path))
+                if clients:
+                    time_idle = None
+                    continue
+                if resident:
+                    if g._resident:
+                        # detached, wait for clients to reattach
+                        if time_idle is None:
+                            time_idle = time.time()
+                        timeout = g._resident.get('timeout')
+                        if not timeout or time.time() - time_idle < timeout:
+                            continue
+                    # timed out, stopped or the last client hasn't detached
+                    release_resident()
+                # the first client hasn't connected or all clients are gone
+                break
+            with _g_lock:
+                g.clients += 1
+            client_id = _next_client_id()
+            t = threading.Thread(name='__pptop_injection_client_{}_{}'.format(
+                cpid, client_id),
+                                 target=_serve_client,
+                                 args=(connection, cpid, client_id, protocol))
+            t.setDaemon(True)
+            t.start()
+            clients.append(t)
+            # check for gone clients more often
+            server.settimeout(accept_interval)
+    except Exception as e:
+        log_traceback()
+    try:
+        server.close()
     except:
         pass
-    if real_stdout is not None:
-        sys.stdout = real_stdout
-    if real_stderr is not None:
-        sys.stderr = real_stderr
     try:
         os.unlink(server_address)
     except:
         pass
     log('finished')
-    if runner_mode:
+    with _g_lock:
+        finished = g.clients == 0
+    if runner_mode and finished:
         g._server_finished = True
         os._exit(0)
 
 
+def _serve_client(connection, cpid, client_id, protocol):
+    try:
+        serve(connection, cpid, client_id, protocol)
+    finally:
+        with _g_lock:
+            g.clients -= 1
+
+
 def start(cpid, protocol=None, lg=None, runner_mode=False):
     if lg:
         init_logging(lg)
@@ -485,4 +1802,7 @@ def main():
 
 
 if __name__ == '__main__':
+    # injections import helpers from pptop.injection, make sure they get the
+    # running module, not a new copy
+    sys.modules['pptop.injection'] = sys.modules[__name__]
     main()
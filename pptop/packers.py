@@ -0,0 +1,231 @@
+'''
+Payload codecs
+
+Codecs are negotiated at handshake, each payload starts with a byte with id
+of codec it's encoded with:
+
+    0x00 - pickle
+    0x01 - marshal (plain primitives, client and server Python versions must
+           be the same)
+    0x02 - columnar: list of equal-length tuples is transposed to columns,
+           which are encoded with marshal (if possible) or pickle
+
+The module is loaded into injected process as well, so it must stay
+compatible with Python 2 and use standard library only.
+'''
+
+import marshal
+import sys
+import time
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+CODEC_PICKLE = 0
+CODEC_MARSHAL = 1
+CODEC_COLUMNAR = 2
+
+codec_names = {
+    CODEC_PICKLE: 'pickle',
+    CODEC_MARSHAL: 'marshal',
+    CODEC_COLUMNAR: 'columnar'
+}
+
+# tables with less rows are not transposed
+columnar_min_rows = 10
+
+_codec_bytes = dict((c, bytes(bytearray([c]))) for c in codec_names)
+
+
+def supported_codecs():
+    '''
+    Get codecs, supported by the current Python
+
+    Returns:
+        dict with keys "codecs" (list) and "v" (Python version)
+    '''
+    return {'codecs': sorted(codec_names), 'v': tuple(sys.version_info[:2])}
+
+
+def negotiate(local, remote):
+    '''
+    Select codecs, supported by both sides
+
+    Args:
+        local: supported_codecs() result of the local side
+        remote: supported_codecs() result of the remote side
+
+    Returns:
+        list of codec ids
+    '''
+    result = [c for c in local['codecs'] if c in remote['codecs']]
+    if CODEC_MARSHAL in result and tuple(local['v']) != tuple(remote['v']):
+        # marshal format is Python version-specific
+        result.remove(CODEC_MARSHAL)
+    return result
+
+
+def _is_table(obj):
+    if not isinstance(obj, list) or len(obj) < columnar_min_rows:
+        return False
+    row = obj[0]
+    if not isinstance(row, tuple):
+        return False
+    l = len(row)
+    for row in obj:
+        if not isinstance(row, tuple) or len(row) != l:
+            return False
+    return l > 0
+
+
+def _dumps_primitive(obj, codecs, protocol):
+    if CODEC_MARSHAL in codecs:
+        try:
+            return CODEC_MARSHAL, marshal.dumps(obj)
+        except ValueError:
+            pass
+    return CODEC_PICKLE, pickle.dumps(obj, protocol)
+
+
+def encode(obj, codecs=(CODEC_PICKLE,), protocol=2, codec=None):
+    '''
+    Encode object with the fastest of codecs available
+
+    Args:
+        obj: object to encode
+        codecs: negotiated codecs
+        protocol: pickle protocol
+        codec: force codec
+
+    Returns:
+        tuple of bytes-like chunks, the first one is codec id
+    '''
+    if codec is None:
+        if CODEC_COLUMNAR in codecs and _is_table(obj):
+            codec = CODEC_COLUMNAR
+        else:
+            codec, data = _dumps_primitive(obj, codecs, protocol)
+    elif codec == CODEC_MARSHAL:
+        data = marshal.dumps(obj)
+    elif codec == CODEC_PICKLE:
+        data = pickle.dumps(obj, protocol)
+    if codec == CODEC_COLUMNAR:
+        inner, data = _dumps_primitive(list(zip(*obj)), codecs, protocol)
+        return _codec_bytes[codec], _codec_bytes[inner], data
+    return _codec_bytes[codec], data
+
+
+class Encoder(object):
+    '''
+    Encoder, which selects the fastest codec for each payload source
+
+    For payloads of the same source (e.g. plugin), all suitable codecs are
+    probed once per probe_interval calls and the one with the least encoding
+    time is used until the next probe
+
+    Args:
+        codecs: negotiated codecs
+        protocol: pickle protocol
+        probe_interval: re-probe codecs every N calls
+    '''
+
+    def __init__(self, codecs, protocol=2, probe_interval=100):
+        self.codecs = codecs
+        self.protocol = protocol
+        self.probe_interval = probe_interval
+        self.selected = {}
+
+    def _probe(self, obj, key):
+        best = None
+        for codec in self.codecs:
+            if codec == CODEC_COLUMNAR and not _is_table(obj):
+                continue
+            t_start = time.time()
+            try:
+                data = encode(obj, self.codecs, self.protocol, codec)
+            except ValueError:
+                continue
+            spent = time.time() - t_start
+            if best is None or spent < best[0]:
+                best = (spent, codec, data)
+        self.selected[key] = [best[1], 0]
+        return best[2]
+
+    def encode(self, obj, key=None):
+        '''
+        Encode object
+
+        Args:
+            obj: object to encode
+            key: payload source
+
+        Returns:
+            tuple of bytes-like chunks
+        '''
+        if key is None or len(self.codecs) < 2:
+            return encode(obj, self.codecs, self.protocol)
+        sel = self.selected.get(key)
+        if sel is None or sel[1] >= self.probe_interval:
+            return self._probe(obj, key)
+        sel[1] += 1
+        try:
+            if sel[0] == CODEC_COLUMNAR and not _is_table(obj):
+                raise ValueError
+            return encode(obj, self.codecs, self.protocol, sel[0])
+        except ValueError:
+            return self._probe(obj, key)
+
+
+def dumps(obj, codecs=(CODEC_PICKLE,), protocol=2, codec=None):
+    '''
+    Encode object, same as encode, but returns single bytes object
+    '''
+    return b''.join(encode(obj, codecs, protocol, codec))
+
+
+def loads(data):
+    '''
+    Decode object
+
+    Args:
+        data: encoded object (bytes-like), prefixed with codec id
+    '''
+    codec = data[0]
+    if not isinstance(codec, int):
+        # Python 2
+        codec = ord(codec)
+    if codec == CODEC_PICKLE:
+        return pickle.loads(data[1:])
+    elif codec == CODEC_MARSHAL:
+        return marshal.loads(data[1:])
+    elif codec == CODEC_COLUMNAR:
+        return list(zip(*loads(data[1:])))
+    else:
+        raise ValueError('Unsupported codec: {}'.format(codec))
+
+
+def bench(obj, codec, codecs=(CODEC_PICKLE,), protocol=2, iters=10):
+    '''
+    Measure codec performance
+
+    Returns:
+        tuple (encoded size, encode time, decode time), times are in
+        milliseconds. None if object can not be encoded with the codec
+    '''
+    if codec == CODEC_COLUMNAR and not _is_table(obj):
+        return None
+    try:
+        data = dumps(obj, codecs, protocol, codec)
+    except ValueError:
+        return None
+    t_start = time.time()
+    for i in range(iters):
+        dumps(obj, codecs, protocol, codec)
+    t_enc = (time.time() - t_start) / iters * 1000
+    t_start = time.time()
+    for i in range(iters):
+        loads(data)
+    t_dec = (time.time() - t_start) / iters * 1000
+    return len(data), t_enc, t_dec
@@ -10,6 +10,7 @@ import os
 import threading
 import shutil
 import subprocess
+import time
 
 from types import SimpleNamespace
 from collections import OrderedDict
@@ -24,6 +25,9 @@ from pptop.ui.console import palette, glyph, print_message, scr
 
 process_path = []
 
+# min interval between rendering partially loaded chunked data (seconds)
+partial_render_interval = 0.5
+
 
 class GenericPlugin(BackgroundIntervalWorker):
 
@@ -62,6 +66,7 @@ class GenericPlugin(BackgroundIntervalWorker):
         self.selectable = False  # show item selector arrow
         self.background = False  # shouldn't be stopped when switched
         self.background_loader = False  # for heavy plugins - load data in bg
+        self.profiler = False  # requires yappi profiler running in process
         self.need_status_line = False  # reserve status line
         self.append_data = False  # default load_data method will append data
         self.data_records_max = None  # max data records
@@ -70,6 +75,17 @@ class GenericPlugin(BackgroundIntervalWorker):
         self.key_code = None  # last key pressed, for custom key event handling
         self.key_event = None  # last key event
         self.injected = False  # is plugin injected
+        self.delta_key = None  # row key columns for delta-encoded responses
+        self._delta_seq = 0
+        self._delta_rows = {}
+        self.stream = None  # stream params, if data can be pushed by server
+        self.subscribed = False  # is plugin subscribed to server stream
+        # injection function yields batches of rows, data is loaded in
+        # background and rendered while being received
+        self.chunked = False
+        self.group_merge = False  # merge_data merges process group responses
+        self._partial = None
+        self._partial_rendered = 0
 
     def on_load(self):
         '''
@@ -106,13 +122,44 @@ class GenericPlugin(BackgroundIntervalWorker):
         '''
         return None
 
-    def command(cmd, params=None):
+    def command(cmd, params=None, on_chunk=None, pid=None):
         '''
         Execute command on connected process
 
         Args:
             cmd: command to execute
             params: command params (optional, free format dict)
+            on_chunk: function(batch), called for each batch of chunked
+                response (optional)
+            pid: process of the group (-G) to execute command on (default:
+                the focused one)
+        '''
+        return None
+
+    def command_group(cmd, params=None):
+        '''
+        Execute command on all processes of the group (-G)
+
+        Returns:
+            dict pid: response, processes where command failed are skipped
+        '''
+        return None
+
+    def is_group_aggregate():
+        '''
+        Is aggregated data of process group displayed (-G, no process is
+        focused)
+        '''
+        return False
+
+    def subscribe(stream_id, callback, params=None):
+        '''
+        Subscribe to stream of connected process
+
+        Args:
+            stream_id: stream id
+            callback: function(items, dropped), called when data is pushed
+            params: stream params (optional)
         '''
         return None
 
@@ -301,7 +348,54 @@ class GenericPlugin(BackgroundIntervalWorker):
         Raises:
             RuntimeError: if command failed
         '''
-        return self.command(self.name, params=kwargs)
+        return self.command(self.name,
+                            params=kwargs,
+                            on_chunk=self._on_chunk if self.chunked else None)
+
+    def injection_delta_command(self, **kwargs):
+        '''
+        Execute injected function with specified params, request
+        delta-encoded response
+
+        If self.delta_key is set and injected function returns list of rows,
+        server sends only rows inserted, updated and removed since the
+        previous call. The full result is restored from rows, cached by
+        plugin
+
+        Returns:
+            injected function response
+        Raises:
+            RuntimeError: if command failed
+        '''
+        if not self.delta_key or self.chunked:
+            return self.injection_command(**kwargs)
+        result = self.command('.delta',
+                              params={
+                                  'id': self.name,
+                                  'seq': self._delta_seq,
+                                  'key': self.delta_key,
+                                  'kw': kwargs
+                              })
+        if isinstance(result, list):
+            # chunked results are never delta-encoded
+            self._delta_rows = {}
+            self._delta_seq = 0
+            return result
+        seq, result, upserted, removed = result
+        key = self.delta_key
+        if result is None:
+            rows = self._delta_rows
+            for k in removed:
+                rows.pop(k, None)
+            for r in upserted:
+                rows[tuple(r[i] for i in key)] = r
+            result = list(rows.values())
+        elif seq:
+            self._delta_rows = {tuple(r[i] for i in key): r for r in result}
+        else:
+            self._delta_rows = {}
+        self._delta_seq = seq
+        return result
 
     def get_injection_load_params(self):
         '''
@@ -344,7 +438,22 @@ class GenericPlugin(BackgroundIntervalWorker):
         '''
         Load data from connected process
         '''
-        return self.injection_command()
+        if self.group_merge and self.is_group_aggregate():
+            return self.merge_data(self.command_group(self.name))
+        return self.injection_delta_command()
+
+    def merge_data(self, results):
+        '''
+        Merge injected function responses of process group, called if
+        self.group_merge is True
+
+        Args:
+            results: dict pid: response
+
+        Returns:
+            merged data, in format of a single process response
+        '''
+        return [d for data in results.values() for d in data]
 
     def load_data(self):
         '''
@@ -354,31 +463,21 @@ class GenericPlugin(BackgroundIntervalWorker):
 
         Returns:
             if False is returned, the plugin is stopped (doesn't works if
-            self.background_loader=True)
+            self.background_loader=True or self.chunked=True)
         '''
         try:
-            result = self.load_remote_data()
-            processed = self.process_data(result)
-            if isinstance(processed, list):
-                result = processed
-            if result is False or processed is False:
-                return False
-            if isinstance(result, list):
-                d = result
-            else:
-                d = []
-            with self.data_lock:
-                if self.append_data:
-                    self.data += d
-                else:
-                    self.data = d
-                if self.data_records_max and len(
-                        self.data) > self.data_records_max:
-                    self.data = self.data[len(self.data) -
-                                          self.data_records_max:]
-            self._error = False
-            self._display_ui()
-            return True
+            if self.subscribed:
+                # data is pushed by server
+                self._display_ui()
+                return True
+            if self.chunked:
+                self._partial = []
+                self._partial_rendered = 0
+            try:
+                result = self.load_remote_data()
+            finally:
+                self._partial = None
+            return self._store_data(result)
         except Exception as e:
             log_traceback()
             self.data = []
@@ -388,6 +487,75 @@ class GenericPlugin(BackgroundIntervalWorker):
                 if self._visible:
                     self.print_title()
 
+    def _store_data(self, result):
+        processed = self.process_data(result)
+        if isinstance(processed, list):
+            result = processed
+        if result is False or processed is False:
+            return False
+        if isinstance(result, list):
+            d = result
+        else:
+            d = []
+        with self.data_lock:
+            if self.append_data:
+                self.data += d
+            else:
+                self.data = d
+            if self.data_records_max and len(
+                    self.data) > self.data_records_max:
+                self.data = self.data[len(self.data) -
+                                      self.data_records_max:]
+        self._error = False
+        self._display_ui()
+        return True
+
+    def _on_chunk(self, batch):
+        # called by channel reader thread, which must not be blocked: collect
+        # the batch and let the plugin worker render partially loaded data
+        partial = self._partial
+        if partial is None:
+            return
+        partial.extend(batch)
+        t = time.time()
+        if self.append_data or \
+                t - self._partial_rendered < partial_render_interval:
+            return
+        self._partial_rendered = t
+        self.trigger_threadsafe(force=True)
+
+    def _store_partial(self):
+        partial = self._partial
+        if partial is None:
+            return
+        data = list(partial)
+        processed = self.process_data(data)
+        if isinstance(processed, list):
+            data = processed
+        with self.data_lock:
+            # skip if loading is already finished
+            if self._partial is partial:
+                self.data = data
+
+    def on_push(self, items, dropped):
+        '''
+        Called by core when data is pushed by server, if plugin is subscribed
+        to stream (self.stream is set)
+
+        Default method processes items as loaded data
+
+        Args:
+            items: list of pushed items
+            dropped: number of items, dropped by server since the previous
+                push because of stream buffer overflow
+        '''
+        if dropped:
+            log('{}: {} stream items dropped'.format(self.name, dropped))
+        try:
+            self._store_data(items)
+        except:
+            log_traceback()
+
     def process_data(self, data):
         '''
         Format loaded data into table
@@ -627,12 +795,14 @@ class GenericPlugin(BackgroundIntervalWorker):
             if (not self.key_event or self.key_event == 'reload'
                ) and not self._paused and not self._loader_active:
                 self._loader_active = True
-                if self.background_loader:
+                if self.background_loader or self.chunked:
                     spawn(self._load_data)
                     return
                 else:
                     if self._load_data() is False:
                         return False
+            elif self._loader_active and self._partial is not None:
+                self._store_partial()
             return self._display_ui()
         except Exception as e:
             log_traceback()
@@ -17,18 +17,20 @@ class Plugin(GenericPlugin):
         self.sorting_col = 'time'
         self.sorting_rev = True
         self.background = True
+        # records are pushed by server as soon as they're emitted
+        self.stream = {'items': 100, 'latency': 0.1, 'buffer': 10000}
 
     def process_data(self, data):
         result = []
         for record in data:
             r = OrderedDict()
-            r['logger'] = record.name
-            r['time'] = record.created
-            r['level'] = record.levelno
-            r['module'] = record.module
-            r['thread'] = record.threadName
-            r['file'] = '{}:{}'.format(abspath(record.pathname), record.lineno)
-            r['message'] = record.getMessage().replace('\n', ' ')
+            r['logger'] = record[0]
+            r['time'] = record[1]
+            r['level'] = record[2]
+            r['module'] = record[3]
+            r['thread'] = record[4]
+            r['file'] = '{}:{}'.format(abspath(record[5]), record[6])
+            r['message'] = record[7].replace('\n', ' ')
             result.append(r)
         return result
 
@@ -61,23 +63,38 @@ class Plugin(GenericPlugin):
 def injection_load(**kwargs):
     import logging
     import threading
+    from collections import deque
 
     class LogHandler(logging.Handler):
 
         def __init__(self, *args, **kwargs):
             logging.Handler.__init__(self, *args, **kwargs)
-            self.records = []
+            # bounded, as resident agent may collect with no client for hours
+            self.records = deque(maxlen=10000)
             self.records_lock = threading.Lock()
 
         def emit(self, record):
             if record:
-                with self.records_lock:
-                    self.records.append(record)
+                # records are sent as plain tuples, which are cheaper to
+                # serialize and never contain unpicklable args
+                try:
+                    msg = record.getMessage()
+                except:
+                    msg = str(record.msg)
+                record = (record.name, record.created, record.levelno,
+                          record.module, record.threadName, record.pathname,
+                          record.lineno, msg)
+                s = stream
+                if s is not None:
+                    s.push(record)
+                else:
+                    with self.records_lock:
+                        self.records.append(record)
 
         def get_collected(self):
             with self.records_lock:
-                rec = self.records
-                self.records = []
+                rec = list(self.records)
+                self.records.clear()
             return rec
 
     g.log_handler = LogHandler()
@@ -20,13 +20,15 @@ class Plugin(GenericPlugin):
         self.set_title()
         self.sorting_col = 'size'
         self.background_loader = True
+        # file, line
+        self.delta_key = (0, 1)
 
     def set_title(self):
         self.title = 'Memory allocation ({})'.format(
             self.grouping_types[self.current_grouping])
 
     def load_remote_data(self):
-        return self.injection_command(
+        return self.injection_delta_command(
             key_type=self.grouping_types[self.current_grouping])
 
     def handle_key_event(self, event, key, dtd):
@@ -95,13 +97,15 @@ def injection(key_type=None, **kwargs):
         tracemalloc.stop()
         tracemalloc.start()
         return
-    result = []
+    import linecache
+    from pptop.injection import collect
     # make sure it's started
     tracemalloc.start()
     snap = tracemalloc.take_snapshot()
-    for s in snap.statistics(key_type):
+
+    def stat_info(s):
         f, ln = str(s.traceback).split(':')
-        import linecache
         cmd = linecache.getline(f, int(ln)).strip()
-        result.append((f, ln, s.size, s.count, cmd))
-    return result
+        return (f, ln, s.size, s.count, cmd)
+
+    return collect(snap.statistics(key_type), stat_info)
@@ -0,0 +1,207 @@
+from pptop.plugin import GenericPlugin, palette
+from pptop.logger import log_traceback
+
+from collections import OrderedDict
+
+
+class Plugin(GenericPlugin):
+    '''
+    objects plugin: remote object explorer
+
+    Objects are never serialized as a whole: the agent returns opaque handles
+    and client requests containers page by page, so exploring huge structures
+    is cheap. Handles keep objects alive, so handles of a page are released
+    when it is left.
+
+    Shortcuts:
+
+        i      : inspect object (Python expression, top-level modules are
+                 imported automatically)
+        ENTER  : expand selected item
+        q, ESC : back to parent object
+        a      : toggle attributes / items view
+        n      : next page
+        b      : previous page
+    '''
+
+    def on_load(self):
+        self.title = 'Object explorer'
+        self.short_name = 'Objcts'
+        self.description = 'Remote object explorer'
+        self.sorting_enabled = False
+        self.selectable = True
+        self.page = int(self.config.get('page', 100))
+        # stack of dicts: label, descriptor, page offset, attrs view
+        self.path = []
+        self.children = {}
+        self.inputs = {'i': None}
+
+    def obj(self, op, **kwargs):
+        kwargs['op'] = op
+        result = self.command('.obj', kwargs)
+        if result[0]:
+            raise RuntimeError('{}: {}'.format(result[1], result[2]))
+        return result[1]
+
+    def on_unload(self):
+        try:
+            self.obj('release')
+        except:
+            log_traceback()
+
+    def release(self, handles=()):
+        '''
+        Release handles of the current page and specified ones, except
+        handles of the path
+        '''
+        keep = set(p['d']['h'] for p in self.path)
+        hs = set(d['h'] for d in self.children.values()) | set(handles)
+        hs = [h for h in hs if h is not None and h not in keep]
+        self.children = {}
+        if hs:
+            try:
+                self.obj('release', h=hs)
+            except:
+                log_traceback()
+
+    def open(self, expr):
+        if self.path:
+            self.path = []
+            self.children = {}
+            self.obj('release')
+        self.path = [{
+            'label': expr,
+            'd': self.obj('open', expr=expr),
+            'offset': 0,
+            'attrs': False
+        }]
+
+    def format_title(self):
+        label = ''.join(p['label'] for p in self.path)
+        cur = self.path[-1]
+        d = cur['d']
+        if d['h'] is None:
+            return '{} ({})'.format(label, d['type'])
+        if cur['attrs'] or d['kind'] == 'obj':
+            view = 'attributes'
+            size = ''
+        else:
+            view = 'items'
+            size = '' if d['len'] is None else ' of {}'.format(d['len'])
+        return '{} ({}, {} {}-{}{})'.format(label, d['type'], view,
+                                           cur['offset'] + 1,
+                                           cur['offset'] + len(self.children),
+                                           size)
+
+    def load_remote_data(self):
+        if not self.path:
+            self.title = 'Object explorer (press "i" to inspect an object)'
+            self.children = {}
+            return []
+        cur = self.path[-1]
+        d = cur['d']
+        if d['h'] is None:
+            items = [('', d)]
+        else:
+            if cur['attrs'] or d['kind'] == 'obj':
+                op = 'attrs'
+            elif d['kind'] == 'map':
+                op = 'keys'
+            else:
+                op = 'slice'
+            items = self.obj(op,
+                             h=d['h'],
+                             offset=cur['offset'],
+                             limit=self.page)
+            fmt = '.{}' if op == 'attrs' else '[{}]'
+            items = [(fmt.format(k), v) for k, v in items]
+        self.children = OrderedDict(items)
+        self.title = self.format_title()
+        return items
+
+    def process_data(self, data):
+        result = []
+        for k, d in data:
+            r = OrderedDict()
+            r['key'] = k
+            r['type'] = d['type']
+            r['len'] = '' if d['len'] is None else d['len']
+            r['value'] = str(d['value']).replace('\n', ' ')
+            result.append(r)
+        return result
+
+    def handle_key_event(self, event, key, dtd):
+        if event == 'select':
+            row = self.get_selected_row()
+            if not row: return
+            d = self.children.get(row['key'])
+            if not d or d['h'] is None: return
+            self.save_cursor()
+            self.cursor = 0
+            self.shift = 0
+            self.path.append({
+                'label': row['key'],
+                'd': d,
+                'offset': 0,
+                'attrs': False
+            })
+            self.release()
+        elif event == 'back':
+            if len(self.path) < 2: return
+            self.release((self.path.pop()['d']['h'],))
+            self.restore_cursor()
+        elif event in ['n', 'b'] and self.path:
+            cur = self.path[-1]
+            if event == 'n':
+                if len(self.children) < self.page: return
+                cur['offset'] += self.page
+            else:
+                if not cur['offset']: return
+                cur['offset'] = max(cur['offset'] - self.page, 0)
+            self.release()
+            self.cursor = 0
+            self.shift = 0
+        elif event == 'a' and self.path:
+            cur = self.path[-1]
+            if cur['d']['kind'] not in ['map', 'seq']: return
+            cur['attrs'] = not cur['attrs']
+            cur['offset'] = 0
+            self.release()
+            self.cursor = 0
+            self.shift = 0
+        else:
+            return
+        self.trigger_threadsafe(force=True)
+
+    def handle_pager_event(self, dtd):
+        if self.key_event != 'back':
+            super().handle_pager_event(dtd)
+
+    def get_input_prompt(self, var):
+        if var == 'i':
+            return 'inspect: '
+
+    def handle_input(self, var, value, prev_value):
+        if var == 'i' and value:
+            try:
+                self.open(value)
+            except Exception as e:
+                self.print_error(e)
+                return
+            self.cursor = 0
+            self.shift = 0
+            self._cursors.clear()
+            self.trigger_threadsafe(force=True)
+
+    def get_table_col_color(self, element, key, value):
+        if key == 'key':
+            return palette.BOLD
+        elif key == 'type':
+            return palette.CYAN
+        elif key == 'value':
+            if value.startswith('!ERROR'):
+                return palette.RED
+            return palette.YELLOW
+
+    async def run(self, *args, **kwargs):
+        super().run(*args, **kwargs)
@@ -0,0 +1,93 @@
+from pptop.plugin import GenericPlugin, palette, bytes_to_iso
+
+from collections import OrderedDict, deque
+
+
+class Plugin(GenericPlugin):
+    '''
+    overhead plugin: pptop self-overhead in the target process
+
+    Agent accounts every command, plugin injection call and stream push of
+    the current client:
+
+        plugin: plugin (or agent command)
+        calls: calls / stream pushes
+        wall: wall time total (seconds)
+        cpu: agent thread CPU time total (seconds, Python 3.7+ targets only)
+        pickle: response serialization time total (seconds)
+        bytes: payload bytes sent
+        avg: average wall time per call (ms)
+        load: CPU time (wall time if CPU time isn't available) per second,
+              within the rolling window (ms/s)
+        %cpu: share of the target process CPU time within the rolling window
+    '''
+
+    def on_load(self):
+        self.title = 'pptop self-overhead'
+        self.short_name = 'Ovrhd'
+        self.description = 'pptop self-overhead per plugin'
+        self.sorting_col = '%cpu'
+        self.rolling_window = float(self.config.get('window', 10))
+        # snapshots within the rolling window
+        self.snapshots = deque()
+
+    def load_remote_data(self):
+        return self.command('.overhead')
+
+    def process_data(self, data):
+        snapshots = self.snapshots
+        snapshots.append(data)
+        while len(snapshots) > 2 and \
+                data['time'] - snapshots[1]['time'] >= self.rolling_window:
+            snapshots.popleft()
+        prev = snapshots[0]
+        # index of time, accounted in "load" and "%cpu"
+        i = 2 if data['thread_cpu'] else 1
+        period = data['time'] - prev['time']
+        target_cpu = data['cpu'] - prev['cpu']
+        plugins = self.get_plugins()
+        result = []
+        for key, s in data['stats'].items():
+            p = prev['stats'].get(key)
+            spent = s[i] - p[i] if p and p is not s else 0
+            r = OrderedDict()
+            r['plugin'] = plugins[key]['p'].title if 'p' in plugins.get(
+                key, {}) else key
+            r['calls'] = s[0]
+            r['wall'] = s[1]
+            r['cpu'] = s[2]
+            r['pickle'] = s[3]
+            r['bytes'] = s[4]
+            r['avg'] = s[1] / s[0] * 1000
+            r['load'] = spent / period * 1000 if period > 0 else 0
+            r['%cpu'] = min(spent / target_cpu *
+                            100, 100) if target_cpu > 0 else 0
+            result.append(r)
+        return result
+
+    def format_dtd(self, dtd):
+        for d in dtd:
+            z = d.copy()
+            for k in ('wall', 'cpu', 'pickle'):
+                z[k] = '{:.3f}'.format(z[k])
+            z['bytes'] = bytes_to_iso(z['bytes'])
+            z['avg'] = '{:.3f}'.format(z['avg'])
+            z['load'] = '{:.2f}'.format(z['load'])
+            z['%cpu'] = '{:.1f}'.format(z['%cpu'])
+            yield z
+
+    def get_table_col_color(self, element, key, value):
+        if key == 'plugin':
+            return palette.BOLD
+        elif key == '%cpu':
+            v = float(value)
+            if v >= 10:
+                return palette.RED
+            elif v >= 1:
+                return palette.YELLOW
+            return palette.GREEN
+        else:
+            return palette.CYAN
+
+    async def run(self, *args, **kwargs):
+        super().run(*args, **kwargs)
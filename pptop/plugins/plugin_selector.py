@@ -18,7 +18,12 @@ class Plugin(GenericPlugin):
 
     def load_data(self):
         self.data.clear()
-        for plugin_id, plugin in self.get_plugins().items():
+        for plugin_id in list(self.get_plugins()):
+            # plugins are loaded lazily, load all to get their titles
+            try:
+                plugin = self.get_plugin(plugin_id)
+            except:
+                continue
             p = plugin['p']
             if p.name not in ['plugin_selector', 'help']:
                 sh = format_shortcut(plugin['shortcut'])
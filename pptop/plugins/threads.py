@@ -13,6 +13,9 @@ class Plugin(GenericPlugin):
         ttot: time spent total
         scnt: schedule count
 
+    for process group (-G) threads of all processes are listed, with
+    process pid
+
     select thread to view its strack trace
 
     requires yappi profiler module for times and schedule count
@@ -24,18 +27,32 @@ class Plugin(GenericPlugin):
         self.sorting_col = 'ttot'
         self.description = 'Process active threads'
         self.background_loader = True
+        self.profiler = True
         self.thread_stack_info = None
         self.selectable = True
+        self.delta_key = (0,)
+        self.group_merge = True
 
     def load_remote_data(self):
         if self.thread_stack_info is None:
             self.title = 'Threads'
             return super().load_remote_data()
         else:
+            ident, name, pid = self.thread_stack_info
             self.title = 'Thread {name} [{ident}] stack trace'.format(
-                ident=self.thread_stack_info[0], name=self.thread_stack_info[1])
-            return self.injection_command(
-                thread_stack_info=self.thread_stack_info[0])
+                ident=ident, name=name)
+            if pid is None:
+                return self.injection_command(thread_stack_info=ident)
+            # thread of process group member
+            self.title += ', process {}'.format(pid)
+            return self.command(self.name,
+                                params={'thread_stack_info': ident},
+                                pid=pid)
+
+    def merge_data(self, results):
+        return [
+            tuple(d) + (pid,) for pid, data in results.items() for d in data
+        ]
 
     def process_data(self, data):
         result = []
@@ -49,6 +66,8 @@ class Plugin(GenericPlugin):
         else:
             for d in data:
                 r = OrderedDict()
+                if len(d) > 8:
+                    r['pid'] = d[8]
                 r['ident'] = d[0]
                 r['daemon'] = 'daemon' if d[1] else ''
                 r['name'] = d[2] if d[2] else ''
@@ -69,7 +88,8 @@ class Plugin(GenericPlugin):
                 self.selectable = False
                 self.disable_cursor()
                 self.hshift = 0
-                self.thread_stack_info = (row['ident'], row['name'])
+                self.thread_stack_info = (row['ident'], row['name'],
+                                          row.get('pid'))
         elif event == 'back':
             self.sorting_enabled = True
             self.selectable = True
@@ -151,6 +171,7 @@ def injection(thread_stack_info=None, **kwargs):
     result = []
     if thread_stack_info is None:
         import inspect
+        from pptop.injection import collect
         yi = {}
         try:
             import yappi
@@ -160,7 +181,9 @@ def injection(thread_stack_info=None, **kwargs):
                 yi[d[2]] = (d[3], d[4])
         except:
             pass
-        for t in threading.enumerate():
+        frames = sys._current_frames()
+
+        def thread_info(t):
             if not t.name.startswith('__pptop_injection'):
                 try:
                     target = '{}.{}'.format(
@@ -172,14 +195,16 @@ def injection(thread_stack_info=None, **kwargs):
                 r = (t.ident, t.daemon, t.name, target, y[0] if y else 0,
                      y[1] if y else 0)
                 try:
-                    x = inspect.getframeinfo(sys._current_frames()[t.ident])
+                    x = inspect.getframeinfo(frames[t.ident])
                     r += (' '.join(x.code_context).strip(),
                           '{}:{}'.format(x.filename, x.lineno))
                 except:
                     # from pptop.logger import log_traceback
                     # log_traceback()
                     r += (None, None)
-                result.append(r)
+                return r
+
+        result = collect(threading.enumerate(), thread_info)
     else:
         try:
             import traceback
@@ -24,6 +24,9 @@ class Plugin(GenericPlugin):
     To modify result, use standard Python code, e.g.
 
     my.module::my_function(1,2,3)['field'] - valid result
+
+    Items are compiled once, when added, time column contains item evaluation
+    time (ms)
     '''
 
     def on_load(self):
@@ -50,6 +53,7 @@ class Plugin(GenericPlugin):
             v = OrderedDict()
             v['name'] = d['name']
             v['value'] = d['value']
+            v['time'] = d['time']
             result.append(v)
         return result
 
@@ -133,6 +137,12 @@ class Plugin(GenericPlugin):
             self.injection_command(cmd='clear')
             self.print_message('Variable list cleared', color=palette.WARNING)
 
+    def format_dtd(self, dtd):
+        for t in dtd:
+            z = t.copy()
+            z['time'] = '{:.3f}'.format(z['time'] * 1000)
+            yield z
+
     async def run(self, *args, **kwargs):
         super().run(*args, **kwargs)
 
@@ -144,22 +154,13 @@ class Plugin(GenericPlugin):
             return palette.BOLD
         elif key == 'value':
             return palette.YELLOW
+        elif key == 'time':
+            return palette.RED if float(value) >= 1 else None
 
 
 def injection_load(v=None, **kwargs):
-    g.vars = []
-    if v:
-        for var in v:
-            try:
-                if var[var.find(':') + 1] == ':':
-                    var = var.replace('::', ':', 1).strip()
-            except:
-                pass
-            mod, var = var.split(':', 1)
-            g.vars.append((mod, var))
-
-
-def injection(cmd=None, var=None):
+    import sys
+    import time
 
     def parse_var(var):
         try:
@@ -167,37 +168,61 @@ def injection(cmd=None, var=None):
                 var = var.replace('::', ':', 1).strip()
         except:
             pass
-        mod, var = var.split(':', 1)
-        return mod, var
+        return var.split(':', 1)
+
+    def compile_var(var):
+        # watch: name, module name, compiled expression, eval globals, error
+        mod, var = parse_var(var)
+        w = ['{}::{}'.format(mod, var), mod, None, None, None]
+        try:
+            w[2] = compile('__pptop_m.' + var, w[0], 'eval')
+        except:
+            e = sys.exc_info()
+            w[4] = '!ERROR {}: {}'.format(e[0].__name__, str(e[1]))
+        return w
+
+    g.compile_var = compile_var
+    g.clock = getattr(time, 'perf_counter', time.time)
+    g.vars = [compile_var(var) for var in v] if v else []
+
 
+def injection(cmd=None, var=None):
     if cmd == 'add':
-        g.vars.append(parse_var(var))
+        g.vars.append(g.compile_var(var))
     elif cmd == 'del':
-        g.vars.remove(parse_var(var))
+        name = g.compile_var(var)[0]
+        for i, w in enumerate(g.vars):
+            if w[0] == name:
+                del g.vars[i]
+                break
     elif cmd == 'clear':
         g.vars = []
     elif cmd == 'replace':
-        g.vars = []
-        for v in var:
-            g.vars.append(parse_var(v))
+        g.vars = [g.compile_var(v) for v in var]
     else:
+        import sys
         import importlib
-        from pptop.injection import safe_serialize
-        result = []
-        for v in g.vars:
-            mod = v[0]
-            var = v[1]
-            r = {'name': '{}::{}'.format(mod, var)}
-            try:
-                ge = {'__pptop_sserl': safe_serialize}
-                src = 'import {}; out=__pptop_sserl({}.{})'.format(
-                    mod, mod, var)
-                exec(src, ge)
-                val = ge['out']
-                r['value'] = ge['out']
-            except:
-                import sys
-                e = sys.exc_info()
-                r['value'] = '!ERROR {}: {}'.format(e[0].__name__, str(e[1]))
-            result.append(r)
-        return result
+        from pptop.injection import safe_serialize, collect
+
+        def watch(w):
+            r = {'name': w[0]}
+            t = g.clock()
+            if w[4]:
+                r['value'] = w[4]
+            else:
+                try:
+                    if w[3] is None:
+                        # module is resolved once
+                        mod = sys.modules.get(w[1])
+                        if mod is None:
+                            mod = importlib.import_module(w[1])
+                        w[3] = {'__pptop_m': mod}
+                    r['value'] = safe_serialize(eval(w[2], w[3]))
+                except:
+                    e = sys.exc_info()
+                    r['value'] = '!ERROR {}: {}'.format(
+                        e[0].__name__, str(e[1]))
+            r['time'] = g.clock() - t
+            return r
+
+        return collect(list(g.vars), watch)
@@ -8,6 +8,8 @@ class Plugin(GenericPlugin):
     '''
     yappi plugin: function profiler
 
+    for process group (-G) stats of all processes are summed
+
     requires yappi profiler module https://github.com/sumerc/yappi
     '''
 
@@ -16,13 +18,36 @@ class Plugin(GenericPlugin):
         self.title = 'Function profiler (yappi)'
         self.sorting_col = 'ttot'
         self.background_loader = True
+        self.profiler = True
+        # function name, module, line
+        self.delta_key = (0, 6, 7)
+        self.group_merge = True
 
     def handle_key_event(self, event, key, dtd, **kwargs):
         if event == 'reset':
-            self.injection_command(cmd='reset')
+            if self.is_group_aggregate():
+                self.command_group(self.name, {'cmd': 'reset'})
+            else:
+                self.injection_command(cmd='reset')
             self.print_message('Profiler stats were reset',
                                color=palette.WARNING)
 
+    def merge_data(self, results):
+        # function stats are summed across processes of the group
+        stats = OrderedDict()
+        for data in results.values():
+            for s in data:
+                key = (s[0], s[6], s[7])
+                m = stats.get(key)
+                if m is None:
+                    stats[key] = list(s)
+                else:
+                    for i in range(1, 5):
+                        m[i] += s[i]
+        for m in stats.values():
+            m[5] = m[3] / m[2] if m[2] else 0
+        return list(stats.values())
+
     def process_data(self, data):
         sess = []
         for s in data:
@@ -85,8 +110,8 @@ def injection(cmd=None, **kwargs):
     else:
         if not yappi.is_running():
             yappi.start()
-        result = []
-        for f in yappi.get_func_stats():
-            result.append((f.name, f.ncall, f.nactualcall, f.ttot, f.tsub,
-                           f.tavg, f.module, f.lineno, f.builtin))
-        return result
+        from pptop.injection import collect
+        return collect(
+            yappi.get_func_stats(), lambda f:
+            (f.name, f.ncall, f.nactualcall, f.ttot, f.tsub, f.tavg, f.module,
+             f.lineno, f.builtin))
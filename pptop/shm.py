@@ -0,0 +1,176 @@
+'''
+Shared memory ring buffer for high-volume streams
+
+Ring file is created by injection server under /dev/shm, mapped by both sides
+and unlinked by client as soon as it's mapped. The socket remains the control
+channel, batches of stream items are written by server into the ring instead
+of push frames and read by client with no syscalls.
+
+Ring layout:
+
+    bytes 1-8   : write position (total bytes written, set by server)
+    bytes 9-16  : read position (total bytes read, set by client)
+    bytes 17-24 : overruns (items dropped because ring or stream buffer was
+                  full)
+    bytes 25-32 : ring capacity
+    bytes 65-N  : ring data
+
+Record:
+
+    bytes 1-4 : record data length
+    bytes 5-6 : stream number
+    byte 7    : data kind (0 - utf-8 text, 1 - encoded list of items, see
+                pptop.packers)
+    bytes 8-N : record data
+
+The module is loaded into injected process as well, so it must stay
+compatible with Python 2 and use standard library only.
+'''
+
+import mmap
+import os
+import struct
+import threading
+
+header_size = 64
+pos = struct.Struct('<Q')
+rec_header = struct.Struct('<IHB')
+
+WRITE_POS = 0
+READ_POS = 8
+OVERRUNS = 16
+CAPACITY = 24
+
+KIND_TEXT = 0
+KIND_ENCODED = 1
+
+shm_dir = '/dev/shm'
+
+
+def available():
+    '''
+    Is shared memory transport available on this system
+    '''
+    return os.path.isdir(shm_dir)
+
+
+class Ring(object):
+    '''
+    Shared memory ring
+
+    Single writer (thread-safe), single reader
+
+    Args:
+        path: ring file path
+        size: ring capacity, if specified, new file is created
+    '''
+
+    def __init__(self, path, size=None):
+        self.path = path
+        if size:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                os.ftruncate(fd, header_size + size)
+                self.mm = mmap.mmap(fd, header_size + size)
+            finally:
+                os.close(fd)
+            pos.pack_into(self.mm, CAPACITY, size)
+        else:
+            fd = os.open(path, os.O_RDWR)
+            try:
+                self.mm = mmap.mmap(fd, 0)
+            finally:
+                os.close(fd)
+        self.capacity = pos.unpack_from(self.mm, CAPACITY)[0]
+        self.write_pos = pos.unpack_from(self.mm, WRITE_POS)[0]
+        self.read_pos = pos.unpack_from(self.mm, READ_POS)[0]
+        self.lock = threading.Lock()
+
+    def _put(self, p, data):
+        off = p % self.capacity
+        l = len(data)
+        first = min(l, self.capacity - off)
+        self.mm[header_size + off:header_size + off + first] = data[:first]
+        if first < l:
+            self.mm[header_size:header_size + l - first] = data[first:]
+
+    def _get(self, p, l):
+        off = p % self.capacity
+        first = min(l, self.capacity - off)
+        data = self.mm[header_size + off:header_size + off + first]
+        if first < l:
+            data += self.mm[header_size:header_size + l - first]
+        return data
+
+    def write(self, n, kind, data, count=1):
+        '''
+        Write record
+
+        Args:
+            n: stream number
+            kind: data kind
+            data: record data
+            count: items in record, counted as overruns if ring is full
+
+        Returns:
+            True if written, False if ring is full (overrun is counted)
+        '''
+        l = rec_header.size + len(data)
+        with self.lock:
+            if self.mm is None:
+                return False
+            w = self.write_pos
+            if w + l - pos.unpack_from(self.mm, READ_POS)[0] > self.capacity:
+                pos.pack_into(self.mm, OVERRUNS,
+                              pos.unpack_from(self.mm, OVERRUNS)[0] + count)
+                return False
+            self._put(w, rec_header.pack(len(data), n, kind))
+            self._put(w + rec_header.size, data)
+            self.write_pos = w + l
+            # publish the record after its data is written
+            pos.pack_into(self.mm, WRITE_POS, self.write_pos)
+        return True
+
+    def read(self):
+        '''
+        Read all available records
+
+        Returns:
+            list of tuples (stream number, kind, data)
+        '''
+        w = pos.unpack_from(self.mm, WRITE_POS)[0]
+        r = self.read_pos
+        result = []
+        while r < w:
+            l, n, kind = rec_header.unpack(self._get(r, rec_header.size))
+            r += rec_header.size
+            result.append((n, kind, self._get(r, l)))
+            r += l
+        if r != self.read_pos:
+            self.read_pos = r
+            pos.pack_into(self.mm, READ_POS, r)
+        return result
+
+    def add_overruns(self, n):
+        with self.lock:
+            if self.mm is not None:
+                pos.pack_into(self.mm, OVERRUNS,
+                              pos.unpack_from(self.mm, OVERRUNS)[0] + n)
+
+    @property
+    def overruns(self):
+        return pos.unpack_from(self.mm, OVERRUNS)[0]
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except:
+            pass
+
+    def close(self):
+        with self.lock:
+            try:
+                self.mm.close()
+            except:
+                pass
+            self.mm = None